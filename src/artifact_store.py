@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+artifact_store.py -- Shared local store of the PhylomeDB files
+
+The downloaded files (trees, phylome information and names) are kept in a
+directory shared by several working directories, keyed by their content hash
+(objects/<sha256[:2]>/<sha256>). A json manifest maps each (phylome,
+artifact) to its hash, size, download time and last use. The files are hard
+linked into the working directories (copied if the store is in another file
+system) and, when the store goes over its size limit, the least recently used
+objects are removed.
+'''
+
+# Import libraries ----
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from utils import create_folder
+
+
+# Definitions ----
+def file_hash(path, chunk=2 ** 20):
+    '''
+    Get the sha256 of a file
+    '''
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as ihandle:
+        for block in iter(lambda: ihandle.read(chunk), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def link_file(src, dest):
+    '''
+    Hard link src to dest, or copy it if they are in different file systems
+    '''
+
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+class artifact_store(object):
+    '''
+    Content addressed store with a manifest and LRU eviction
+
+    Args:
+        root (str): store directory
+        max_size (int): maximum bytes of the objects, None for no limit
+    '''
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        create_folder(root)
+        create_folder(os.path.join(root, 'objects'))
+
+    def object_path(self, sha):
+        return os.path.join(self.root, 'objects', sha[:2], sha)
+
+    @contextmanager
+    def manifest(self):
+        '''
+        Read the manifest holding the store lock and write it back, so
+        several processes can share the store
+        '''
+
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = dict()
+            if os.path.isfile(self.manifest_path):
+                with open(self.manifest_path) as ihandle:
+                    entries = json.load(ihandle)
+            yield entries
+            tmp = '%s.%d.tmp' % (self.manifest_path, os.getpid())
+            with open(tmp, 'w') as ohandle:
+                json.dump(entries, ohandle, indent=1, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+
+    def get(self, phylome, artifact, dest):
+        '''
+        Link the stored artifact to dest
+
+        Returns:
+            bool: whether the artifact was in the store
+        '''
+
+        key = '%s/%s' % (phylome, artifact)
+        with self.manifest() as entries:
+            entry = entries.get(key)
+            if entry is None:
+                return False
+            path = self.object_path(entry['hash'])
+            if not os.path.isfile(path):
+                del entries[key]
+                return False
+            link_file(path, dest)
+            entry['used'] = time.time()
+
+        return True
+
+    def put(self, phylome, artifact, path):
+        '''
+        Add a downloaded file to the store, it is hard linked when possible
+        so it does not take space twice
+
+        Returns:
+            str: the content hash
+        '''
+
+        sha = file_hash(path)
+        obj = self.object_path(sha)
+        if not os.path.isfile(obj):
+            create_folder(os.path.dirname(obj))
+            link_file(path, obj)
+
+        now = time.time()
+        with self.manifest() as entries:
+            entries['%s/%s' % (phylome, artifact)] = {
+                'hash': sha, 'size': os.path.getsize(obj), 'fetched': now,
+                'used': now}
+            self.evict(entries)
+
+        return sha
+
+    def evict(self, entries):
+        '''
+        Remove the least recently used objects until the store is under its
+        size limit, an object is as recent as its latest used entry
+        '''
+
+        if self.max_size is None:
+            return
+
+        objects = dict()
+        for key, entry in entries.items():
+            size, used = objects.get(entry['hash'], (entry['size'], 0))
+            objects[entry['hash']] = (size, max(used, entry['used']))
+
+        total = sum(size for size, used in objects.values())
+        for sha, (size, used) in sorted(objects.items(),
+                                        key=lambda x: x[1][1]):
+            if total <= self.max_size:
+                break
+            if os.path.isfile(self.object_path(sha)):
+                os.remove(self.object_path(sha))
+            for key in [key for key, entry in entries.items()
+                        if entry['hash'] == sha]:
+                del entries[key]
+            total -= size
+            print('Evicted from the store: %s (%d bytes)' % (sha, size))
@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+batchtrees.py -- Rooting, annotation and normalisation of whole shards
+
+The trees of a shard are parsed without ete3, midpoint rooted as ete3 does
+(get_midpoint_outgroup and set_outgroup, so the nodes order and the branch
+lengths are the same) and packed in flat arrays: all the nodes of all the
+trees in preorder with per tree offsets. The speciation and duplication
+labelling (species overlap with species bitsets), the normalising groups
+annotation, the normalising MRCA search and its statistics are computed for
+the whole batch at once with numpy, level by level, so the Python work per
+tree is only the parsing, the rooting and the statistics of its normalising
+clade (computed as treefuns.tree_stats, so they are the same to the last
+bit). The results are tables with a row per seed, and the arrays of each
+tree can be given to pairfuns for the sequence pairs.
+
+Requirements: numpy, pandas, treefuns.py and pairfuns.py
+'''
+
+# Import libraries ----
+import hashlib
+import re
+import numpy as np
+import pandas as pd
+
+from treefuns import get_species, dist_stats
+from pairfuns import lca_tables, path_length
+
+
+# Definitions ----
+TOKENS = re.compile(r'[(),;]|:[^(),;]*|[^(),;:]+')
+# ete3 branch length when it is not in the newick
+DEFAULT_DIST = 1.0
+STATS = ['leafno', 'median', 'mean', 'width', 'sum', 'kurt', 'skew']
+
+
+def parse_newick(newick):
+    '''
+    Parse a newick tree
+
+    Args:
+        newick (str): newick tree, the internal nodes labels (supports) are
+        not kept
+
+    Returns:
+        tuple: parent, children, dist and names lists, the root is node 0
+    '''
+
+    parent = [-1]
+    children = [list()]
+    dist = [0.0]
+    names = ['']
+    node = 0
+    for token in TOKENS.findall(newick):
+        if token == '(' or token == ',':
+            up = node if token == '(' else parent[node]
+            new = len(parent)
+            parent.append(up)
+            children[up].append(new)
+            children.append(list())
+            dist.append(DEFAULT_DIST)
+            names.append('')
+            node = new
+        elif token == ')':
+            node = parent[node]
+        elif token == ';':
+            break
+        elif token[0] == ':':
+            dist[node] = float(token[1:])
+        else:
+            names[node] = token.strip()
+
+    return parent, children, dist, names
+
+
+def preorder(children, root=0):
+    order = list()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(reversed(children[node]))
+
+    return order
+
+
+def farthest_leaf(order, parent, dist, is_leaf):
+    '''
+    Farthest leaf under a node and its distance, as ete3 get_farthest_leaf:
+    the branch lengths are added and subtracted along the traversal, so the
+    distance is the same to the last bit (the first leaf in preorder on ties)
+
+    Args:
+        order (iterable): the node and its descendants in preorder
+        parent (list): parent of each node
+        dist (list): branch length of each node
+        is_leaf (list): whether each node is a leaf
+
+    Returns:
+        tuple: (leaf, distance)
+    '''
+
+    order = iter(order)
+    top = next(order)
+    far, far_dist = top, None
+    opened = [top]
+    d = 0.0
+    for node in order:
+        while opened[-1] != parent[node]:
+            d -= dist[opened.pop()]
+        if is_leaf[node]:
+            total = d + dist[node]
+            if far_dist is None or total > far_dist:
+                far, far_dist = node, total
+        else:
+            d += dist[node]
+            opened.append(node)
+
+    return far, 0.0 if far_dist is None else far_dist
+
+
+def midpoint_outgroup(parent, children, dist):
+    '''
+    Node that divides the tree in two distance balanced parts, as ete3
+    get_midpoint_outgroup (the first farthest leaf in preorder on ties)
+    '''
+
+    is_leaf = [not kids for kids in children]
+
+    # Farthest node from the root farthest leaf
+    leaf_a = farthest_leaf(preorder(children), parent, dist, is_leaf)[0]
+    a2b = 0.0
+    prev = leaf_a
+    cdist = dist[leaf_a]
+    current = parent[leaf_a]
+    while current != -1:
+        for child in children[current]:
+            if child != prev:
+                height = farthest_leaf(preorder(children, child), parent,
+                                       dist, is_leaf)[1]
+                if cdist + (height + dist[child]) > a2b:
+                    a2b = cdist + (height + dist[child])
+        prev = current
+        cdist += dist[prev]
+        current = parent[prev]
+
+    cdist = 0
+    current = leaf_a
+    while current != -1:
+        cdist += dist[current]
+        if cdist > a2b / 2.0:
+            break
+        current = parent[current]
+
+    if current == -1:
+        current = children[0][0]
+
+    return current
+
+
+def set_outgroup(parent, children, dist, outgroup):
+    '''
+    Root the tree (node 0) in the branch of outgroup, as ete3 set_outgroup,
+    the lists are changed in place
+    '''
+
+    root = 0
+    parent_out = parent[outgroup]
+    side = outgroup
+    while parent[side] != root:
+        side = parent[side]
+
+    children[root].remove(side)
+    if len(children[root]) != 1:
+        connector = len(parent)
+        parent.append(root)
+        children.append(children[root])
+        dist.append(0.0)
+        for child in children[connector]:
+            parent[child] = connector
+        children[root] = list()
+    else:
+        connector = children[root][0]
+
+    if parent_out != root:
+        # Parent-child swapping up to the root
+        new_parent = parent_out
+        new_child = parent[parent_out]
+        old_parent = -1
+        buffered = dist[parent_out]
+        while new_child != root:
+            children[new_parent].append(new_child)
+            children[new_child].remove(new_parent)
+            buffered, dist[new_child] = dist[new_child], buffered
+            parent[new_parent] = old_parent
+            old_parent = new_parent
+            new_parent = new_child
+            new_child = parent[new_parent]
+
+        children[new_parent].append(connector)
+        parent[connector] = new_parent
+        parent[new_parent] = old_parent
+        dist[connector] += buffered
+        outgroup2 = parent_out
+        children[parent_out].remove(outgroup)
+        dist[outgroup2] = 0.0
+    else:
+        outgroup2 = connector
+
+    parent[outgroup] = root
+    parent[outgroup2] = root
+    children[root] = [outgroup, outgroup2]
+    middist = (dist[outgroup2] + dist[outgroup]) / 2
+    dist[outgroup] = middist
+    dist[outgroup2] = middist
+
+
+def subtree_hashes(children, dist, names):
+    '''
+    Canonical hash of each subtree, from its leaves names, topology and
+    branch lengths, so it does not depend on the order of the children in
+    the newick
+
+    Returns:
+        list: hexadecimal hash per node
+    '''
+
+    hashes = [None] * len(children)
+    for node in reversed(preorder(children)):
+        if children[node]:
+            key = '(%s)' % ','.join(sorted('%s:%r' % (hashes[child],
+                                                      dist[child])
+                                           for child in children[node]))
+        else:
+            key = names[node]
+        hashes[node] = hashlib.blake2b(key.encode(),
+                                       digest_size=16).hexdigest()
+
+    return hashes
+
+
+def order_hash(thash, children, names, tnames):
+    '''
+    Hash of a rooted tree and of the order of its leaves: in the newick,
+    which sets the direction of the pairs and the order of the rows, and in
+    the rooted tree, which sets the order the distances are added in
+
+    Args:
+        thash (str): canonical hash of the rooted tree
+        children (list): children of each node of the rooted tree
+        names (list): name of each node
+        tnames (list): leaves names in the newick order
+
+    Returns:
+        str: hexadecimal hash
+    '''
+
+    rooted = [names[node] for node in preorder(children)
+              if not children[node]]
+    key = '\t'.join([thash, ','.join(tnames), ','.join(rooted)])
+
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def tree_hash(newick, rooted=True, ordered=False):
+    '''
+    Canonical hash of a tree, after midpoint rooting it (as ete3) if rooted,
+    so two seeds with the same tree get the same hash. If ordered, the order
+    of its leaves is hashed too (see order_hash), so only the seeds with the
+    same tree written in the same order get the same hash
+    '''
+
+    parent, children, dist, names = parse_newick(newick)
+    tnames = [names[node] for node in preorder(children)
+              if not children[node]]
+    if rooted:
+        set_outgroup(parent, children, dist,
+                     midpoint_outgroup(parent, children, dist))
+
+    thash = subtree_hashes(children, dist, names)[0]
+    if ordered:
+        return order_hash(thash, children, names, tnames)
+
+    return thash
+
+
+class tree_batch(object):
+    '''
+    Midpoint rooted trees packed in flat arrays
+
+    The nodes of each tree are in preorder, from offsets[k] to
+    offsets[k + 1], so the subtree of a node is the range from the node to
+    node + size. The trees filtered out as in seq2seq_cladenorm (10 species
+    or less, or 3 leaves per species or more), not binary or without a
+    normalising clade are in skipped, as (seed, reason) tuples. positions has
+    the position of each tree in rows and hashes the hash of each rooted
+    tree and of the order of its leaves (see tree_hash).
+
+    Args:
+        rows (list): best_trees rows
+        registry (species_registry): species codes
+    '''
+
+    def __init__(self, rows, registry):
+        self.registry = registry
+        self.seeds = list()
+        self.positions = list()
+        self.tnames = list()
+        self.leaves = list()
+        self.hashes = list()
+        self.skipped = list()
+        parents = list()
+        dists = list()
+        levels = list()
+        depths = list()
+        leaf_names = list()
+
+        for position, row in enumerate(rows):
+            if '\t' in row:
+                fields = row.split('\t')
+                seed, newick = fields[0], fields[3]
+            else:
+                seed, newick = 'sp', row
+            parent, children, dist, names = parse_newick(newick)
+            leaves = [node for node in preorder(children)
+                      if not children[node]]
+            tnames = [names[node] for node in leaves]
+            nspecies = len(set(get_species(name) for name in tnames))
+            if not (nspecies > 10 and len(tnames) < 3 * nspecies):
+                self.skipped.append((seed, 'filtered'))
+                continue
+
+            set_outgroup(parent, children, dist,
+                         midpoint_outgroup(parent, children, dist))
+            if any(len(kids) not in (0, 2) for kids in children):
+                self.skipped.append((seed, 'not binary'))
+                continue
+
+            self.hashes.append(order_hash(
+                subtree_hashes(children, dist, names)[0], children, names,
+                tnames))
+            order = preorder(children)
+            index = {node: i for i, node in enumerate(order)}
+            local = [index.get(parent[node], -1) for node in order]
+            level = [0] * len(order)
+            depth = [0.0] * len(order)
+            for i in range(1, len(order)):
+                level[i] = level[local[i]] + 1
+                depth[i] = depth[local[i]] + dist[order[i]]
+            parents.append(local)
+            dists.append([dist[node] for node in order])
+            levels.append(level)
+            depths.append(depth)
+            leaf_names.append([names[node] if not children[node] else None
+                               for node in order])
+            self.seeds.append(seed)
+            self.positions.append(position)
+            self.tnames.append(tnames)
+            self.leaves.append(np.array([index[node] for node in leaves],
+                                        dtype=np.int32))
+
+        sizes = [len(parent) for parent in parents]
+        self.offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(sizes)
+        nno = int(self.offsets[-1])
+        self.tree = np.repeat(np.arange(len(sizes)), sizes)
+        local = np.concatenate(parents) if parents else np.zeros(0)
+        self.parent = np.where(local >= 0,
+                               local + self.offsets[self.tree], -1) \
+            .astype(np.int64)
+        self.dist = np.concatenate(dists) if dists else np.zeros(0)
+        self.dist[self.parent < 0] = 0.0
+        self.names = [name for names in leaf_names for name in names]
+        self.is_leaf = np.array([name is not None for name in self.names],
+                                dtype=bool)
+        self.species = np.full(nno, -1, dtype=np.int32)
+        leaves = np.flatnonzero(self.is_leaf)
+        self.species[leaves] = registry.leaf_codes([self.names[i]
+                                                    for i in leaves])
+        self.valid = np.ones(len(sizes), dtype=bool)
+
+        # Nodes grouped by level, for the level by level reductions
+        self.level = np.array([level for tree in levels for level in tree],
+                              dtype=np.int32)
+        self.depth = np.array([depth for tree in depths for depth in tree],
+                              dtype=np.float64)
+        self.by_level = np.argsort(self.level, kind='stable')
+        self.level_ends = np.searchsorted(self.level[self.by_level],
+                                          np.arange(self.level.max() + 2
+                                                    if nno else 1))
+
+        self.size = self.up_reduce(np.add, np.ones(nno, dtype=np.int64))
+        self.leafno = self.up_reduce(np.add, self.is_leaf.astype(np.int64))
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def levels(self, reverse=False):
+        '''
+        Nodes of each level, but the roots
+        '''
+
+        levels = range(1, len(self.level_ends) - 1)
+        if reverse:
+            levels = reversed(levels)
+        for level in levels:
+            yield self.by_level[self.level_ends[level]:
+                                self.level_ends[level + 1]]
+
+    def up_reduce(self, ufunc, values):
+        '''
+        Reduce the values of each subtree with a ufunc (add, maximum...)
+        '''
+
+        values = values.copy()
+        for nodes in self.levels(reverse=True):
+            ufunc.at(values, self.parent[nodes], values[nodes])
+
+        return values
+
+    def down_add(self, values):
+        '''
+        Cumulative sum of the values from the root to each node
+        '''
+
+        values = values.copy()
+        for nodes in self.levels():
+            values[nodes] += values[self.parent[nodes]]
+
+        return values
+
+    def evol_events(self):
+        '''
+        Label the internal nodes as duplications when the species of their
+        children overlap, as ete3 get_descendant_evol_events does
+
+        Returns:
+            array: is_dup per node (int8)
+        '''
+
+        words = (len(self.registry) + 63) // 64
+        bits = np.zeros((len(self.parent), max(words, 1)), dtype=np.uint64)
+        leaves = np.flatnonzero(self.is_leaf)
+        codes = self.species[leaves]
+        bits[leaves, codes // 64] = np.left_shift(
+            np.uint64(1), (codes % 64).astype(np.uint64))
+        bits = self.up_reduce(np.bitwise_or, bits)
+
+        inner = np.flatnonzero(~self.is_leaf)
+        first = inner + 1
+        second = first + self.size[first]
+        self.is_dup = np.zeros(len(self.parent), dtype=np.int8)
+        self.is_dup[inner] = (bits[first] & bits[second]).any(axis=1)
+
+        # Speciations and duplications from the root to each node
+        is_s = (~self.is_leaf).astype(np.int32) - self.is_dup
+        self.cum_s = self.down_add(is_s)
+        self.cum_d = self.down_add(self.is_dup.astype(np.int32))
+
+        return self.is_dup
+
+    def annotate(self, gnmdf, spcol, col):
+        '''
+        Group code of each leaf from a normalising groups table column, -1 for
+        the missing values. The trees with species out of the table are
+        skipped, as annotate_tree fails for them.
+
+        Returns:
+            tuple: (group per node, group names)
+        '''
+
+        groups = gnmdf[col].astype(object).where(gnmdf[col].notna(), None)
+        names = sorted(set(value for value in groups if value is not None))
+        gcodes = {value: k for k, value in enumerate(names)}
+        codes = [self.registry.code(sp) for sp in gnmdf[spcol].astype(str)]
+        # The first row of a species is kept, as in annotate_tree
+        table = np.full(len(self.registry), -2, dtype=np.int64)
+        for code, value in zip(codes[::-1], groups.tolist()[::-1]):
+            table[code] = -1 if value is None else gcodes[value]
+
+        group = np.full(len(self.parent), -1, dtype=np.int64)
+        leaves = np.flatnonzero(self.is_leaf)
+        group[leaves] = table[self.species[leaves]]
+        for k in np.unique(self.tree[leaves[group[leaves] == -2]]):
+            self.skip(k, 'species not in the %s column' % spcol)
+        group[group == -2] = -1
+
+        return group, names
+
+    def skip(self, k, reason):
+        if self.valid[k]:
+            self.valid[k] = False
+            self.skipped.append((self.seeds[k], reason))
+
+    def group_mrca(self, group):
+        '''
+        Greatest clade of each tree with all its leaves in the same group, as
+        get_group_mrca: more than one leaf, not the whole tree and with
+        width, the first in level order on ties
+
+        Returns:
+            array: node per tree, -1 if there is none
+        '''
+
+        low = self.up_reduce(np.minimum, np.where(self.is_leaf, group,
+                                                  np.iinfo(np.int64).max))
+        high = self.up_reduce(np.maximum, np.where(self.is_leaf, group, -1))
+        far = self.up_reduce(np.maximum, self.depth)
+        roots = self.offsets[:-1]
+        ok = ((low == high) & (low >= 0) & (self.leafno > 1) &
+              (self.leafno != self.leafno[roots][self.tree]) &
+              (far - self.depth != 0))
+
+        nodes = np.flatnonzero(ok)
+        order = np.lexsort((nodes, self.level[nodes], -self.leafno[nodes],
+                            self.tree[nodes]))
+        nodes = nodes[order]
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = self.tree[nodes][1:] != self.tree[nodes][:-1]
+
+        mrca = np.full(len(self), -1, dtype=np.int64)
+        mrca[self.tree[nodes[first]]] = nodes[first]
+
+        return mrca
+
+    def subtree_stats(self, nodes):
+        '''
+        Root to tip distances statistics of some nodes subtrees, as
+        treefuns.tree_stats
+
+        Returns:
+            dict: STATS arrays aligned with nodes
+        '''
+
+        leafno = self.leafno[nodes]
+        size = self.size[nodes]
+        # All the nodes of the subtrees, with their subtree index
+        owner = np.repeat(np.arange(len(nodes)), size)
+        start = np.repeat(np.cumsum(size) - size, size)
+        member = np.repeat(nodes, size) + np.arange(size.sum()) - start
+        keep = self.is_leaf[member]
+        # The leaves distances as tree.get_distance(leaf), in preorder
+        arrays = {'parent': self.parent, 'dist': self.dist,
+                  'level': self.level}
+        x = path_length(arrays, member[keep], nodes[owner[keep]],
+                        np.zeros(int(keep.sum())))
+
+        # The statistics are computed as tree_stats, so they are the same
+        # to the last bit
+        parent = self.parent.tolist()
+        dist = self.dist.tolist()
+        is_leaf = self.is_leaf.tolist()
+        ends = np.cumsum(leafno)
+        rows = list()
+        for node, first, last, nno in zip(nodes.tolist(),
+                                          (ends - leafno).tolist(),
+                                          ends.tolist(), size.tolist()):
+            width = farthest_leaf(range(node, node + nno), parent, dist,
+                                  is_leaf)[1]
+            rows.append(dist_stats(x[first:last].tolist(), width))
+
+        return {key: np.array([row[key] for row in rows]) for key in STATS}
+
+    def norm_table(self, gnmdf, spcol='Proteome', col='Normalising group'):
+        '''
+        Normalising clade statistics of each tree (the nlist rows of
+        seq2seq_cladenorm), the trees without a normalising clade are skipped
+
+        Returns:
+            DataFrame: tree and STATS columns, a row per valid tree
+        '''
+
+        group = self.annotate(gnmdf, spcol, col)[0]
+        mrca = self.group_mrca(group)
+        for k in np.flatnonzero(mrca < 0):
+            self.skip(k, 'no normalising clade')
+
+        trees = np.flatnonzero(self.valid)
+        stats = self.subtree_stats(mrca[trees])
+        table = pd.DataFrame({'tree': [self.seeds[k] for k in trees]})
+        for key in STATS:
+            table[key] = stats[key]
+        table.index = trees
+
+        return table
+
+    def tree_arrays(self, k):
+        '''
+        Arrays of a tree for pairfuns (see pairfuns.tree_arrays) with its
+        leaves species codes, evol_events has to be run before
+
+        Returns:
+            dict: numpy arrays, with local nodes indexes
+        '''
+
+        start, end = self.offsets[k], self.offsets[k + 1]
+        parent = np.where(self.parent[start:end] >= 0,
+                          self.parent[start:end] - start, -1)
+        level = self.level[start:end]
+        first, sparse = lca_tables(parent, level)
+        leaf = self.leaves[k]
+
+        return {'parent': parent.astype(np.int32),
+                'dist': self.dist[start:end],
+                'level': level,
+                'is_dup': self.is_dup[start:end],
+                'cum_s': self.cum_s[start:end],
+                'cum_d': self.cum_d[start:end],
+                'first': first, 'sparse': sparse, 'leaf': leaf,
+                'species': self.species[start:end][leaf]}
+
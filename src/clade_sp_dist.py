@@ -22,6 +22,14 @@ import pandas as pd
 from multiprocessing import Process, Manager
 from treefuns import get_species, root, annotate_tree, \
     tree_stats, get_group_mrca, count_dupl_specs
+from stage_trace import tree_trace, write_trace
+from metrics import metrics_writer
+from scheduler import scheduler, task, estimate_memory, plan_rows, \
+    heavy_queue
+from phylome_catalogue import phylome_catalogue, catalogue_error
+from ordered_output import ordered_results, table_stream, check_format, \
+    FORMATS
+from ingest import read_rows, shard_name
 
 # Path configuration to import utils ----
 filedir = os.path.abspath(__file__)
@@ -32,29 +40,41 @@ from utils import file_exists, create_folder
 
 
 # Definitions ----
-def get_ndists(tree, phylome_id, gnmdf):
+def get_ndists(tree, phylome_id, gnmdf, trace=None):
     treel = tree.split('\t')
     print('Calculating: ', treel[0])
+    if trace is None:
+        trace = tree_trace(treel[0], False)
+
     t = ete3.PhyloTree(treel[3], sp_naming_function=get_species)
+    trace.mark('parse')
+    if trace.enabled:
+        trace.size(len(t), len(t.get_species()))
 
     root(t, root_dict[int(phylome_id)])
+    trace.mark('root')
     t.get_descendant_evol_events()
+    trace.mark('evol_events')
 
     annotate_tree(t, gnmdf, 'Proteome', ['Normalising group',
                                          'Vertebrate',
                                          'Metazoan'])
+    trace.mark('annotate')
 
     norm_group = get_group_mrca(t, treel[0], 'Normalising group', 'A')
+    trace.mark('norm_mrca')
 
     norm_stats = tree_stats(norm_group['node'])
     nsd = count_dupl_specs(norm_group['node'])
     nfactor = norm_stats['median']
+    trace.mark('norm_stats')
 
     vert_dict = get_group_mrca(t, treel[0], 'Vertebrate',
                                'vertebrate', treel[0])
 
     met_dict = get_group_mrca(t, treel[0], 'Metazoan',
                               'metazoan', treel[0])
+    trace.mark('event_mrca')
 
     odict = dict()
     odict['seed'] = treel[0]
@@ -73,21 +93,32 @@ def get_ndists(tree, phylome_id, gnmdf):
              **{'norm_' + k: v for k, v in norm_stats.items()},
              **{'whole_' + k: v for k, v in tree_stats(t).items()},
              **{'whole_' + k: v for k, v in count_dupl_specs(t).items()}}
+    trace.mark('whole_stats')
 
     return odict
 
 
 class dist_process(Process):
-    def __init__(self, tree_row, phylome_id, gnmdf, olist):
+    def __init__(self, tree_row, index, phylome_id, gnmdf, results,
+                 tlist=None, counters=None):
         Process.__init__(self)
         self.tree_row = tree_row
+        self.index = index
         self.phylome_id = phylome_id
         self.gnmdf = gnmdf
-        self.olist = olist
+        self.results = results
+        self.tlist = tlist
+        self.counters = counters
 
     def run(self):
-        odict = get_ndists(self.tree_row, self.phylome_id, self.gnmdf)
-        self.olist.append(odict)
+        trace = tree_trace(self.tree_row.split('\t', 1)[0],
+                           self.tlist is not None)
+        odict = get_ndists(self.tree_row, self.phylome_id, self.gnmdf, trace)
+        self.results.put(self.index, 0, {'dist': [odict]})
+        if trace.enabled:
+            self.tlist.append(trace.record())
+        if self.counters is not None:
+            self.counters.add('done')
 
 
 def main():
@@ -97,8 +128,13 @@ def main():
                       help='Default configurations to execute with our data.',
                       action='store_true')
     parser.add_option('-f', '--file', dest='ifile',
-                      help='In file',
+                      help='In file, it can be gzip (.gz) or zstandard '
+                      '(.zst) compressed or - for the standard input',
                       metavar='<path/to/file.txt>')
+    parser.add_option('--name', dest='name',
+                      help='Shard id (default: the input file name, it is '
+                      'needed for the standard input)',
+                      metavar='<0076_0>')
     parser.add_option('-g', '--groups', dest='groups',
                       help='Groups file (.csv)',
                       metavar='<path/to/file.csv>')
@@ -108,6 +144,42 @@ def main():
     parser.add_option('-c', '--cpu', dest='cpus',
                       help='Number of CPUs', type='int',
                       metavar='<N>')
+    parser.add_option('-t', '--trace', dest='trace',
+                      help='Write the per tree stage timings in json '
+                      '(Chrome trace) or csv format',
+                      choices=['json', 'csv'], metavar='<json|csv>')
+    parser.add_option('-m', '--metrics', dest='metrics',
+                      help='Prometheus textfile to write the progress metrics',
+                      metavar='<path/to/file.prom>')
+    parser.add_option('-M', '--mem', dest='mem',
+                      help='Memory budget in MB, the number of running trees '
+                      'is adapted to stay under it (up to -c)', type='int',
+                      metavar='<MB>')
+    parser.add_option('-l', '--lpt', dest='lpt',
+                      help='Process the trees largest first',
+                      action='store_true')
+    parser.add_option('--max-leaves', dest='max_leaves',
+                      help='Trees with more leaves are written to the heavy '
+                      'queue file (<file>_heavy.txt) instead', type='int',
+                      metavar='<N>')
+    parser.add_option('--max-time', dest='max_time',
+                      help='Trees running for longer are killed and written '
+                      'to the heavy queue file', type='float',
+                      metavar='<seconds>')
+    parser.add_option('-F', '--format', dest='format',
+                      help='Format of the output tables: csv or parquet '
+                      '(compressed and columnar, it needs pyarrow)',
+                      choices=['csv', 'parquet'], default='csv',
+                      metavar='<csv|parquet>')
+    parser.add_option('--float32', dest='float32',
+                      help='Comma separated float columns stored in single '
+                      'precision in the parquet tables, eg. '
+                      'vert_ndist,met_ndist',
+                      default='', metavar='<col,col,...>')
+    parser.add_option('--catalogue', dest='catalogue',
+                      help='Phylome catalogue (phylome_catalogue.py) to '
+                      'check the groups table against before starting',
+                      metavar='<path/to/catalogue.sqlite>')
     (options, args) = parser.parse_args()
 
     if options.default:
@@ -121,39 +193,104 @@ def main():
         outdir = options.output
         cpus = options.cpus
 
-    ofilenm = infile.rsplit('/', 1)[1].split('.', 1)[0]
-    ofile = '%s/%s_dist.csv' % (outdir, ofilenm)
+    mem_budget = None
+    if options.mem:
+        mem_budget = options.mem * 2 ** 20
+        cpus = cpus or os.cpu_count()
+
+    try:
+        ofilenm = shard_name(infile, options.name)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        check_format(options.format)
+    except ValueError as e:
+        parser.error(str(e))
+    float32 = [col for col in options.float32.split(',') if col]
+
+    ofile = '%s/%s_dist%s' % (outdir, ofilenm, FORMATS[options.format])
 
     if not file_exists(ofile):
         create_folder(outdir)
 
         gnmdf = pd.read_csv(gnmdffile)
-        phylome_id = infile.rsplit('/', 1)[1].split('_', 1)[0]
+        phylome_id = ofilenm.split('_', 1)[0]
+        if options.catalogue:
+            catalogue = phylome_catalogue(options.catalogue)
+            try:
+                catalogue.check_groups(phylome_id, gnmdf)
+            except catalogue_error as e:
+                parser.error(str(e))
+            finally:
+                catalogue.close()
 
         with Manager() as manager:
-            olist = manager.list()
-
-            processes = list()
-            for tree_row in open(infile, 'r'):
-                if tree_row != '':
-                    if len(processes) >= cpus:
-                        done = False
-                        while not done:
-                            for process in processes:
-                                if not process.is_alive():
-                                    processes.remove(process)
-                                    done = True
-
-                    process = dist_process(tree_row, phylome_id, gnmdf, olist)
-                    processes.append(process)
-                    process.start()
-
-            for process in processes:
-                process.join()
-
-            # Writing output files
-            odf = pd.DataFrame(list(olist))
-            odf.to_csv(ofile, index=False)
+            tlist = manager.list() if options.trace else None
+
+            heavy = heavy_queue('%s/%s_heavy.txt' % (outdir, ofilenm))
+            # The rows are read as the trees are started, unless they have
+            # to be sorted first
+            rows = plan_rows(read_rows(infile), options.lpt,
+                             options.max_leaves, heavy)
+
+            # The rows are written in input order whatever the order in
+            # which the trees finish
+            dist_out = table_stream(ofile, options.format, float32)
+            results = ordered_results(manager, [i for i, l, r in rows]
+                                      if options.lpt else (),
+                                      {'dist': dist_out})
+
+            def collect(item):
+                for index in item.indexes:
+                    results.collect(index)
+
+            counters = None
+            if options.metrics:
+                metrics = metrics_writer(options.metrics, 'clade_sp_dist',
+                                         ofilenm, 'trees',
+                                         len(rows) if options.lpt else 0,
+                                         cpus)
+                metrics.start()
+                counters = metrics.counters
+
+            def timeout(item):
+                # A worker killed after sending its results is not sent to
+                # the heavy queue, or the tree would be written twice
+                if not all(results.sent(index) for index in item.indexes):
+                    heavy.add(item.row)
+                collect(item)
+                if counters is not None:
+                    counters.add('done')
+
+            workers = scheduler(cpus, mem_budget, max_time=options.max_time,
+                                on_timeout=timeout, hold=results.hold)
+            if options.metrics:
+                metrics.processes = workers.processes
+
+            def tasks():
+                for index, leaves, tree_row in rows:
+                    results.expect(index)
+                    if options.metrics and not options.lpt:
+                        metrics.total += 1
+                    process = dist_process(tree_row, index, phylome_id,
+                                           gnmdf, results, tlist, counters)
+                    yield task(process, estimate_memory(leaves, False),
+                               tree_row, on_done=collect, indexes=(index,))
+
+            workers.run(tasks())
+            heavy.close()
+
+            if options.metrics:
+                metrics.stop()
+
+            # Writing what is left of the output
+            results.close()
+            dist_out.close()
+
+            if options.trace:
+                write_trace(list(tlist), '%s/%s_trace.%s' %
+                            (outdir, ofilenm, options.trace), options.trace)
 
     return 0
 
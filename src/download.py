@@ -4,15 +4,24 @@
 '''
 download.py -- Download trees and data from phylome db functions
 
+The files are downloaded to .part files that are resumed after a failure (ftp
+REST or http Range) and renamed when they are complete and valid (gzip CRC and
+length, rows format). The received blocks can also be passed to a sink as
+they arrive (ingest.py), to process the file while it is downloaded.
+
 Written by Moisès Bernabeu <mail@mail.com>
 January 2022
 '''
 
 # Import libraries ----
-from os.path import isfile
-from urllib.request import urlretrieve
+import ftplib
+import gzip
+import os
 import socket
-from utils import create_folder
+import zlib
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, unquote
+from urllib.request import Request, urlopen
 
 
 # Definitions ----
@@ -23,52 +32,224 @@ class download_error(Exception):
     pass
 
 
-class file_download(object):
+def tree_row(fields):
+    '''
+    Check a best_trees row: seed, model, likelihood and newick tree
+    '''
+
+    return len(fields) == 4 and fields[3].rstrip().endswith(';')
+
+
+def names_row(fields):
+    '''
+    Check a names row: PhylomeDB id and name
+    '''
+
+    return fields[0].startswith('#') or len(fields) >= 2
+
+
+def row_check(path):
+    '''
+    Get the rows check for a file from its name, None if rows are not checked
+    '''
+
+    if 'best_trees' in path:
+        return tree_row
+    elif '_names' in path:
+        return names_row
+
+    return None
+
+
+def validate(path, name=None, chunk=2 ** 20):
     '''
-    Tree download class
+    Check a downloaded file
+
+    Gzip files are decompressed to the end, so the CRC and length of the
+    trailer are checked (a truncated file fails), and the rows of the trees
+    and names files are checked to parse.
+
+    Args:
+        path (str): file to check
+        name (str): file name to choose the rows check, path if None
+
+    Raises:
+        download_error: the file is not valid
     '''
 
-    # Class constructor
-    def __init__(self, url, workdir, ofile, timeout=180):
-        '''
-        Construct the download_tree class with its own objects
-        '''
+    name = name or path
+    if not name.endswith('.gz'):
+        return
+
+    check = row_check(name)
+    try:
+        with gzip.open(path, 'rt') as ihandle:
+            if check is None:
+                while ihandle.read(chunk):
+                    pass
+            else:
+                for rowno, row in enumerate(ihandle, 1):
+                    if row.strip() and not check(row.rstrip('\n')
+                                                 .split('\t')):
+                        raise download_error('Wrong row %d in %s' %
+                                             (rowno, path))
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+        raise download_error('Corrupt file %s: %s' % (path, e))
+
+
+def fetch_ftp(url, part, offset, timeout, counters=None, sink=None):
+    '''
+    Download an ftp url to the part file from offset (REST)
 
-        self.url = url
-        self.timeout = timeout
-        self.workdir = workdir
-        self.ofile = ofile
+    Returns:
+        int: remote size, None if unknown
+    '''
 
-    # Make containing folder
-    def make_workdir(self, workdir):
-        create_folder(self.workdir)
+    parts = urlsplit(url)
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(parts.hostname, parts.port or 21)
+    ftp.login(unquote(parts.username or 'anonymous'),
+              unquote(parts.password or ''))
+    try:
+        ftp.voidcmd('TYPE I')
+        path = unquote(parts.path)
+        try:
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            size = None
+        if size is not None and offset > size:
+            offset = 0
+            if sink is not None:
+                sink.reset()
+        if size is None or offset < size:
+            with open(part, 'ab' if offset else 'wb') as ohandle:
+                def write(block):
+                    ohandle.write(block)
+                    if sink is not None:
+                        sink.write(block)
+                    if counters is not None:
+                        counters.add('bytes', len(block))
+                ftp.retrbinary('RETR %s' % path, write,
+                               rest=offset or None)
+    finally:
+        ftp.close()
+
+    return size
+
+
+def fetch_url(url, part, offset, timeout, counters=None, sink=None,
+              chunk=2 ** 20):
+    '''
+    Download an http (or other urllib) url to the part file from offset
+    (Range header)
 
-    # Download the item
-    def get_item(self):
-        '''
-        Download the tree from PhylomeDB if it is necessary
-        '''
+    Returns:
+        int: remote size, None if unknown
+    '''
 
-        # Create the directory
-        self.make_workdir(self.workdir)
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 416:
+            # Nothing left to download
+            return offset
+        raise
+
+    with response:
+        status = getattr(response, 'status', None)
+        if status == 206:
+            size = response.headers.get('Content-Range', '').rsplit('/', 1)
+            size = int(size[1]) if size[-1].isdigit() else None
+        else:
+            # The range was ignored, start again
+            if offset and sink is not None:
+                sink.reset()
+            offset = 0
+            length = response.headers.get('Content-Length')
+            size = int(length) if length and length.isdigit() else None
+        with open(part, 'ab' if offset else 'wb') as ohandle:
+            while True:
+                block = response.read(chunk)
+                if not block:
+                    break
+                ohandle.write(block)
+                if sink is not None:
+                    sink.write(block)
+                if counters is not None:
+                    counters.add('bytes', len(block))
+
+    return size
+
+
+def replay(part, sink, chunk=2 ** 20):
+    '''
+    Pass to the sink the blocks of the part file it has not received, as a
+    part file left by a previous run
+    '''
 
-        # Check the existence of the file and download if it is not created
-        dest = '/'.join([self.workdir, self.ofile])
+    with open(part, 'rb') as ihandle:
+        ihandle.seek(sink.offset)
+        for block in iter(lambda: ihandle.read(chunk), b''):
+            sink.write(block)
 
-        if not isfile(dest):
-            try:
-                socket.setdefaulttimeout(self.timeout)
-                urlretrieve(self.url, dest)
-            except socket.timeout:
-                raise download_error(('Timeout (%d): %s'
-                                      % (self.timeout, self.url)))
-            except Exception:
-                raise download_error('Cannot download %s' % self.url)
 
-    # Run the download
-    def run(self):
-        '''
-        Download
-        '''
+def fetch(url, dest, timeout=180, counters=None, sink=None):
+    '''
+    Download an url to a file
+
+    The file is written to <dest>.part, resuming it if it exists from a
+    previous attempt, and it is renamed to dest once the transfer is complete
+    and the file is valid, so dest is never a partial file.
+
+    Args:
+        url (str): ftp or http url
+        dest (str): destination file
+        timeout (float): seconds without response before failing, it is set
+        per request instead of for the whole process
+        counters (stage_counters): metrics counters for the received bytes
+        sink (object): gets the blocks in order with write(block) and
+        offset (bytes received), reset() to start again and close() when the
+        file is complete and valid
+
+    Raises:
+        download_error: timeout, incomplete, corrupt or any other failure
+    '''
 
-        self.get_item()
+    part = dest + '.part'
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    if sink is not None:
+        if sink.offset > offset:
+            sink.reset()
+        if sink.offset < offset:
+            replay(part, sink)
+
+    try:
+        if url.startswith('ftp://'):
+            size = fetch_ftp(url, part, offset, timeout, counters, sink)
+        else:
+            size = fetch_url(url, part, offset, timeout, counters, sink)
+    except socket.timeout:
+        raise download_error('Timeout (%d): %s' % (timeout, url))
+    except Exception as e:
+        raise download_error('Cannot download %s: %s' % (url, e))
+
+    received = os.path.getsize(part) if os.path.isfile(part) else 0
+    if size is not None and received < size:
+        # Kept to be resumed
+        raise download_error('Incomplete %s: %d of %d bytes' %
+                             (url, received, size))
+
+    try:
+        validate(part, dest)
+    except download_error:
+        os.remove(part)
+        if sink is not None:
+            sink.reset()
+        raise
+
+    os.replace(part, dest)
+    if sink is not None:
+        sink.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+download_manager.py -- Concurrent downloads with asyncio
+
+The downloads are scheduled by an asyncio event loop with a limit of
+downloads at once across all the hosts and per host. Each download is a
+blocking fetch (download.py) run in a worker thread with its own timeout, it
+is retried with exponential backoff when it fails and, when it ends, it is put
+in a completion queue, so the next one starts as soon as a slot is free.
+
+Requirements: download.py
+'''
+
+# Import libraries ----
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from download import fetch, download_error
+
+
+# Definitions ----
+class download_job(object):
+    '''
+    A file to download
+
+    Args:
+        dbid (str): phylome id
+        url (str): file url
+        dest (str): destination path
+        sink (object): gets the blocks as they arrive (see download.fetch)
+    '''
+
+    def __init__(self, dbid, url, dest, sink=None):
+        self.dbid = dbid
+        self.url = url
+        self.dest = dest
+        self.sink = sink
+        self.attempts = 0
+        self.error = None
+        self.running = False
+
+    def is_alive(self):
+        return self.running
+
+    def show(self):
+        '''
+        Prints the job status
+        '''
+
+        if self.error is not None:
+            print('Download: %s failed after %d attempts: %s' %
+                  (self.dbid, self.attempts, self.error))
+        else:
+            print('Download: %s ended successfully: %s' %
+                  (self.dbid, self.dest))
+
+
+class download_manager(object):
+    '''
+    Run the download jobs concurrently
+
+    Args:
+        workers (int): maximum downloads at once
+        per_host (int): maximum downloads at once from the same host
+        timeout (float): seconds without response before a request fails
+        retries (int): attempts after the first failure
+        backoff (float): seconds before the first retry, doubled each time
+        counters (stage_counters): metrics counters
+    '''
+
+    def __init__(self, workers=4, per_host=None, timeout=180, retries=3,
+                 backoff=2, counters=None):
+        self.workers = workers or 4
+        self.per_host = per_host or self.workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.counters = counters
+        self.running = list()
+
+    async def fetch(self, job, slots, hosts, executor, queue):
+        '''
+        Download a job with retries and put it in the completion queue
+        '''
+
+        loop = asyncio.get_running_loop()
+        host = urlsplit(job.url).netloc
+        if host not in hosts:
+            hosts[host] = asyncio.Semaphore(self.per_host)
+
+        for attempt in range(self.retries + 1):
+            # The host slot is taken first, so a job waiting for a busy
+            # host does not hold a global slot other hosts could use
+            async with hosts[host], slots:
+                job.attempts += 1
+                job.running = True
+                self.running.append(job)
+                try:
+                    await loop.run_in_executor(executor, fetch, job.url,
+                                               job.dest, self.timeout,
+                                               self.counters, job.sink)
+                    job.error = None
+                except download_error as e:
+                    job.error = e
+                finally:
+                    job.running = False
+                    self.running.remove(job)
+            if job.error is None:
+                break
+            if attempt < self.retries:
+                # The slot is released while waiting
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        await queue.put(job)
+
+    async def run(self, jobs, on_done=None):
+        '''
+        Download all the jobs
+
+        Args:
+            jobs (list): download_job objects
+            on_done (function): called with each job as it finishes
+
+        Returns:
+            list: the jobs in completion order
+        '''
+
+        slots = asyncio.Semaphore(self.workers)
+        hosts = dict()
+        queue = asyncio.Queue()
+        done = list()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            tasks = [asyncio.create_task(self.fetch(job, slots, hosts,
+                                                    executor, queue))
+                     for job in jobs]
+            for k in range(len(tasks)):
+                job = await queue.get()
+                done.append(job)
+                if on_done is not None:
+                    on_done(job)
+            await asyncio.gather(*tasks)
+
+        return done
+
+    def download(self, jobs, on_done=None):
+        '''
+        Run the event loop until all the jobs are finished
+        '''
+
+        return asyncio.run(self.run(jobs, on_done))
@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+gamma_mcmc.py -- Gamma posterior sampling for all species and events at once
+
+The model is the one of mcmc_sampling_function.R: the normalised distances of
+a species and event follow a gamma distribution with shape a and rate b, with
+uniform priors in (0, unifmax). As the likelihood only depends on the
+sufficient statistics (n, sum of x, sum of log x), the chains of all the
+species and events are run as numpy arrays: b is drawn from its truncated
+gamma full conditional and a with a random walk Metropolis step on log scale,
+tuned during the adaptation iterations. Each chain runs in its own process.
+
+The output is the long table of the R scripts, with the parameter (param), its
+value, the event and the species (spto), plus the chain and iteration.
+
+For screening, the mle mode fits the shape and rate by maximum likelihood
+(Newton iterations on the sufficient statistics of all the groups at once)
+with bootstrap confidence intervals, and the result can be used to start the
+chains.
+
+Requirements: numpy, scipy, pandas
+'''
+
+# Import libraries ----
+import os
+from optparse import OptionParser
+from multiprocessing import Process, Queue, Pipe
+from queue import Empty
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln, gammainc, gammaincinv, digamma, \
+    polygamma
+
+from gamma_stats import gamma_stats
+
+
+# Definitions ----
+PARAMS = ['a', 'b', 'm', 'v', 'mo']
+
+
+def load_stats(files, events):
+    '''
+    Get the sufficient statistics of each species and event
+
+    Args:
+        files (list): gamma_stats npz files or distances csv outputs
+        events (list): distance columns
+
+    Returns:
+        DataFrame: spto, event, n, sum_x, sum_log and values of the groups
+        with data
+    '''
+
+    stats = gamma_stats()
+    for file in files:
+        if file.endswith('.npz'):
+            # The species shared by several phylomes are pooled, as the
+            # rows of the csv inputs
+            stats.merge(gamma_stats.read(file))
+        else:
+            stats.add_shard(file, events)
+
+    arrs = stats.arrays()
+    rows = list()
+    for i, sp in enumerate(arrs['species']):
+        for j, event in enumerate(arrs['events']):
+            if event in events and arrs['n'][i, j]:
+                rows.append({'spto': str(sp), 'event': str(event),
+                             'n': arrs['n'][i, j],
+                             'sum_x': arrs['sum_x'][i, j],
+                             'sum_log': arrs['sum_log'][i, j],
+                             'values': stats.values(sp, event)})
+
+    return pd.DataFrame(rows, columns=['spto', 'event', 'n', 'sum_x',
+                                       'sum_log', 'values'])
+
+
+def moments_init(n, sum_x, sum_log, unifmax):
+    '''
+    Starting values from the mean and the log mean (a closed form
+    approximation of the maximum likelihood shape)
+    '''
+
+    mean = sum_x / n
+    s = np.maximum(np.log(mean) - sum_log / n, 1e-8)
+    a = (3 - s + np.sqrt((s - 3) ** 2 + 24 * s)) / (12 * s)
+    a = np.clip(a, 1e-3, unifmax * 0.99)
+    b = np.clip(a / mean, 1e-3, unifmax * 0.99)
+
+    return a, b
+
+
+def gamma_mle(n, sum_x, sum_log, unifmax=100, niter=20):
+    '''
+    Maximum likelihood shape and rate, restricted to the prior bounds
+
+    The shape solves log(a) - digamma(a) = log(mean) - mean of log x, with
+    Newton iterations for all the groups at once.
+
+    Args:
+        n, sum_x, sum_log (array): sufficient statistics per group
+
+    Returns:
+        tuple: shape and rate arrays
+    '''
+
+    n = np.asarray(n, dtype=np.float64)
+    sum_x = np.asarray(sum_x, dtype=np.float64)
+    sum_log = np.asarray(sum_log, dtype=np.float64)
+    mean = sum_x / n
+    s = np.maximum(np.log(mean) - sum_log / n, 1e-12)
+
+    a, b = moments_init(n, sum_x, sum_log, np.inf)
+    for it in range(niter):
+        step = (np.log(a) - digamma(a) - s) / (1 / a - polygamma(1, a))
+        a = np.where(a - step > 0, a - step, a / 2)
+
+    a = np.clip(a, 1e-8, unifmax * (1 - 1e-12))
+    b = np.clip(a / mean, 1e-8, unifmax * (1 - 1e-12))
+
+    return a, b
+
+
+def bootstrap(groups, nboot, parametric=False, unifmax=100, seed=None):
+    '''
+    Bootstrap replicates of the maximum likelihood estimates
+
+    The replicates of all the groups are fitted together.
+
+    Args:
+        groups (DataFrame): load_stats groups
+        nboot (int): number of replicates
+        parametric (bool): draw the replicates from the fitted gamma instead
+        of resampling the values
+
+    Returns:
+        tuple: shape and rate (replicates x groups) arrays
+    '''
+
+    rng = np.random.default_rng(seed)
+    a, b = gamma_mle(groups['n'], groups['sum_x'], groups['sum_log'],
+                     unifmax)
+    sum_x = np.zeros((nboot, len(groups)))
+    sum_log = np.zeros((nboot, len(groups)))
+    for k, values in enumerate(groups['values']):
+        if parametric:
+            rep = rng.gamma(a[k], 1 / b[k], (nboot, len(values)))
+        else:
+            rep = values[rng.integers(0, len(values), (nboot, len(values)))]
+        sum_x[:, k] = rep.sum(axis=1)
+        sum_log[:, k] = np.log(rep).sum(axis=1)
+
+    n = np.tile(groups['n'].to_numpy(dtype=np.float64), (nboot, 1))
+    boot_a, boot_b = gamma_mle(n.ravel(), sum_x.ravel(), sum_log.ravel(),
+                               unifmax)
+
+    return boot_a.reshape(nboot, -1), boot_b.reshape(nboot, -1)
+
+
+def derived(a, b):
+    '''
+    Shape, rate and the derived mean, variance and mode
+    '''
+
+    return {'a': a, 'b': b, 'm': a / b, 'v': a / b ** 2,
+            'mo': np.where(a <= 1, 0, (a - 1) / b)}
+
+
+def mle_summary(groups, estimate, boot, level=0.95):
+    '''
+    Table with the estimates and the bootstrap percentile intervals
+
+    Returns:
+        DataFrame: param, event, spto, estimate, sd, lower and upper
+    '''
+
+    tail = (1 - level) / 2 * 100
+    tables = list()
+    for param in PARAMS:
+        tables.append(pd.DataFrame({
+            'param': param,
+            'event': groups['event'].to_numpy(),
+            'spto': groups['spto'].to_numpy(),
+            'estimate': estimate[param],
+            'sd': boot[param].std(axis=0, ddof=1),
+            'lower': np.percentile(boot[param], tail, axis=0),
+            'upper': np.percentile(boot[param], 100 - tail, axis=0)}))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def log_post_a(a, b, n, sum_x, sum_log):
+    '''
+    Log posterior of the shape (up to a constant) on log scale, the last term
+    is the Jacobian of the log transformation
+    '''
+
+    return (n * a * np.log(b) - n * gammaln(a) + (a - 1) * sum_log +
+            np.log(a))
+
+
+def draw_rate(a, n, sum_x, unifmax, rng):
+    '''
+    Draw the rate from its full conditional, a gamma with shape n * a + 1 and
+    rate sum_x truncated to (0, unifmax)
+    '''
+
+    shape = n * a + 1
+    upper = gammainc(shape, unifmax * sum_x)
+    u = rng.uniform(0, 1, len(a)) * upper
+    b = gammaincinv(shape, np.maximum(u, 1e-300)) / sum_x
+
+    return np.clip(b, 1e-300, unifmax * (1 - 1e-12))
+
+
+class gamma_chain(object):
+    '''
+    Chains of all the groups as arrays
+
+    Args:
+        n, sum_x, sum_log (array): sufficient statistics per group
+        unifmax (float): upper bound of the uniform priors
+        seed (int): random seed
+        init (tuple): starting (a, b) arrays, moments based if None
+    '''
+
+    def __init__(self, n, sum_x, sum_log, unifmax=100, seed=None, init=None):
+        self.n = np.asarray(n, dtype=np.float64)
+        self.sum_x = np.asarray(sum_x, dtype=np.float64)
+        self.sum_log = np.asarray(sum_log, dtype=np.float64)
+        self.unifmax = unifmax
+        self.rng = np.random.default_rng(seed)
+        if init is None:
+            init = moments_init(self.n, self.sum_x, self.sum_log, unifmax)
+        # Overdispersed starts, so the chains can be compared
+        jitter = np.exp(self.rng.normal(0, 0.5, (2, len(self.n))))
+        self.a = np.clip(init[0] * jitter[0], 1e-3, unifmax * 0.99)
+        self.b = np.clip(init[1] * jitter[1], 1e-3, unifmax * 0.99)
+        self.step = np.full(len(self.n), 0.5)
+        self.active = np.arange(len(self.n))
+
+    def update(self):
+        '''
+        One iteration for the active groups
+        '''
+
+        idx = self.active
+        a = self.a[idx]
+        n, sum_x, sum_log = self.n[idx], self.sum_x[idx], self.sum_log[idx]
+        b = draw_rate(a, n, sum_x, self.unifmax, self.rng)
+
+        prop = a * np.exp(self.step[idx] * self.rng.normal(size=len(a)))
+        ratio = (log_post_a(prop, b, n, sum_x, sum_log) -
+                 log_post_a(a, b, n, sum_x, sum_log))
+        accept = ((prop < self.unifmax) &
+                  (np.log(self.rng.uniform(size=len(a))) < ratio))
+        self.a[idx] = np.where(accept, prop, a)
+        self.b[idx] = b
+
+        return accept
+
+    def adapt(self, niter, batch=50):
+        '''
+        Tune the proposal steps to an acceptance rate close to 0.44
+        '''
+
+        accepted = np.zeros(len(self.active))
+        for it in range(1, niter + 1):
+            accepted += self.update()
+            if it % batch == 0:
+                rate = accepted / batch
+                self.step[self.active] *= np.exp(
+                    np.where(rate > 0.44, 1, -1) * min(0.5, it ** -0.5))
+                accepted[:] = 0
+
+    def draws(self):
+        '''
+        Current values of the parameters of the active groups
+        '''
+
+        return derived(self.a[self.active], self.b[self.active])
+
+    def sample(self, niter, thin=1):
+        '''
+        Run niter iterations keeping one every thin
+
+        Returns:
+            dict: param to (kept iterations x active groups) arrays
+        '''
+
+        kept = {param: list() for param in PARAMS}
+        for it in range(1, niter + 1):
+            self.update()
+            if it % thin == 0:
+                for param, value in self.draws().items():
+                    kept[param].append(value)
+
+        return {param: np.array(values).reshape(-1, len(self.active))
+                for param, values in kept.items()}
+
+
+class chain_monitor(object):
+    '''
+    Online convergence diagnostics of the chains of all the groups
+
+    The draws are added in batches, keeping for each parameter, chain and
+    group the running count, mean and sum of squared deviations (for the
+    potential scale reduction factor, R-hat) and the batch means (for the
+    effective sample size, from the batch means variance).
+
+    Args:
+        ngroups (int): number of groups
+        nchains (int): number of chains
+        params (list): monitored parameters
+    '''
+
+    def __init__(self, ngroups, nchains, params=('a', 'b')):
+        self.params = list(params)
+        shape = (len(params), nchains, ngroups)
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.batches = list()
+        self.current = np.full(shape, np.nan)
+
+    def add(self, chain, active, draws):
+        '''
+        Add a batch of draws of a chain
+
+        Args:
+            chain (int): chain index (0 based)
+            active (array): groups of the draws columns
+            draws (dict): param to (kept iterations x active groups) arrays
+        '''
+
+        for k, param in enumerate(self.params):
+            values = draws[param]
+            nb = len(values)
+            if not nb:
+                continue
+            bmean = values.mean(axis=0)
+            bm2 = ((values - bmean) ** 2).sum(axis=0)
+            count = self.count[k, chain, active]
+            delta = bmean - self.mean[k, chain, active]
+            total = count + nb
+            self.mean[k, chain, active] += delta * nb / total
+            self.m2[k, chain, active] += bm2 + delta ** 2 * count * nb / total
+            self.count[k, chain, active] = total
+            self.current[k, chain, active] = bmean
+
+    def close_batch(self):
+        '''
+        Store the batch means once all the chains added the batch
+        '''
+
+        self.batches.append(self.current)
+        self.current = np.full(self.current.shape, np.nan)
+
+    def rhat(self):
+        '''
+        Potential scale reduction factor per group, the maximum of the
+        parameters
+        '''
+
+        n = self.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            within = (self.m2 / (n - 1)).mean(axis=1)
+            between = self.mean.var(axis=1, ddof=1)
+            nmin = n.min(axis=1)
+            var_plus = (nmin - 1) / nmin * within + between
+            rhat = np.sqrt(var_plus / within)
+
+        return np.nan_to_num(rhat, nan=np.inf).max(axis=0)
+
+    def ess(self, min_batches=4):
+        '''
+        Effective sample size per group (all the chains), the minimum of the
+        parameters
+        '''
+
+        if len(self.batches) < min_batches:
+            return np.zeros(self.count.shape[2])
+
+        means = np.array(self.batches)
+        nbatch = (~np.isnan(means)).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bvar = (self.count / nbatch) * np.nanvar(means, axis=0, ddof=1)
+            ess = self.count * (self.m2 / (self.count - 1)) / bvar
+        ess = np.where(nbatch >= min_batches,
+                       np.minimum(np.nan_to_num(ess), self.count), 0)
+
+        return ess.sum(axis=1).min(axis=0)
+
+    def table(self, groups, converged):
+        '''
+        Diagnostics table with a row per group and parameter
+
+        Returns:
+            DataFrame: spto, event, param, mean, sd, rhat, ess, draws and
+            converged
+        '''
+
+        rhat = self.rhat()
+        ess = self.ess()
+        tables = list()
+        for k, param in enumerate(self.params):
+            count = self.count[k].sum(axis=0)
+            mean = (self.mean[k] * self.count[k]).sum(axis=0) / count
+            ssq = (self.m2[k] + self.count[k] * (self.mean[k] - mean) ** 2)
+            tables.append(pd.DataFrame({
+                'spto': groups['spto'].to_numpy(),
+                'event': groups['event'].to_numpy(),
+                'param': param,
+                'mean': mean,
+                'sd': np.sqrt(ssq.sum(axis=0) / (count - 1)),
+                'rhat': rhat,
+                'ess': ess,
+                'draws': count,
+                'converged': converged}))
+
+        return pd.concat(tables, ignore_index=True)
+
+
+def long_table(draws, groups, chain, start=0):
+    '''
+    Draws as the long param, value, event, spto table
+
+    Args:
+        draws (dict): param to (iterations x groups) arrays
+        groups (DataFrame): spto and event of each group
+        chain (int): chain number
+        start (int): draws kept before these ones
+
+    Returns:
+        DataFrame: param, value, event, spto, chain and iter columns
+    '''
+
+    tables = list()
+    for param in PARAMS:
+        values = draws[param]
+        iters, ngroups = values.shape
+        tables.append(pd.DataFrame({
+            'param': param,
+            'value': values.T.ravel(),
+            'event': np.repeat(groups['event'].to_numpy(), iters),
+            'spto': np.repeat(groups['spto'].to_numpy(), iters),
+            'chain': chain,
+            'iter': np.tile(np.arange(start + 1, start + iters + 1),
+                            ngroups)}))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+class chain_process(Process):
+    '''
+    Run a chain for all the groups in batches
+
+    After each batch the kept draws are appended to ofile and sent to the main
+    process, which answers with the groups that are still active.
+    '''
+
+    def __init__(self, groups, chain, niter, thin, adapt, unifmax, seed,
+                 ofile, queue, conn, batch=1000, init=None):
+        Process.__init__(self)
+        self.groups = groups
+        self.chain = chain
+        self.niter = niter
+        self.thin = thin
+        self.nadapt = adapt
+        self.unifmax = unifmax
+        self.seed = seed
+        self.ofile = ofile
+        self.queue = queue
+        self.conn = conn
+        self.batch = batch
+        self.init = init
+
+    def run(self):
+        mc = gamma_chain(self.groups['n'], self.groups['sum_x'],
+                         self.groups['sum_log'], self.unifmax, self.seed,
+                         self.init)
+        mc.adapt(self.nadapt)
+
+        done = 0
+        kept = 0
+        while done < self.niter and len(mc.active):
+            niter = min(self.batch, self.niter - done)
+            draws = mc.sample(niter, self.thin)
+            table = long_table(draws, self.groups.iloc[mc.active],
+                               self.chain, kept)
+            table.to_csv(self.ofile, mode='a' if kept else 'w',
+                         header=not kept, index=False)
+            done += niter
+            kept += len(draws['a'])
+
+            self.queue.put((self.chain - 1, mc.active,
+                            {'a': draws['a'], 'b': draws['b']}))
+            mc.active = self.conn.recv()
+
+
+def run_chains(groups, nchains, niter, thin, unifmax, seed, ofile,
+               init=None, batch=1000, rhat=None, ess=None):
+    '''
+    Run the chains in parallel and join their tables in ofile
+
+    The convergence diagnostics are updated after each batch. If rhat or ess
+    targets are given, the groups that reach them are stopped. The
+    diagnostics are written to <ofile>_diagnostics.csv.
+
+    Returns:
+        DataFrame: diagnostics table
+    '''
+
+    adapt = round(niter * 0.1)
+    seeds = np.random.SeedSequence(seed).spawn(nchains)
+    parts = ['%s.chain%d.tmp' % (ofile, chain + 1) for chain in range(nchains)]
+    queue = Queue()
+    pipes = [Pipe() for chain in range(nchains)]
+    processes = [chain_process(groups, chain + 1, niter, thin, adapt,
+                               unifmax, seeds[chain], parts[chain], queue,
+                               pipes[chain][1], batch, init)
+                 for chain in range(nchains)]
+    for process in processes:
+        process.start()
+
+    monitor = chain_monitor(len(groups), nchains)
+    converged = np.zeros(len(groups), dtype=bool)
+    active = np.arange(len(groups))
+    early = rhat is not None or ess is not None
+    for nbatch in range(-(-niter // batch)):
+        for chain in range(nchains):
+            while True:
+                try:
+                    monitor.add(*queue.get(timeout=1))
+                    break
+                except Empty:
+                    if any(process.exitcode not in (None, 0)
+                           for process in processes):
+                        raise RuntimeError('A chain process failed')
+        monitor.close_batch()
+
+        if early:
+            done = np.ones(len(groups), dtype=bool)
+            if rhat is not None:
+                done &= monitor.rhat() < rhat
+            if ess is not None:
+                done &= monitor.ess() > ess
+            converged |= done
+            active = np.flatnonzero(~converged)
+        for conn, _ in pipes:
+            conn.send(active)
+        if not len(active):
+            break
+
+    for process in processes:
+        process.join()
+
+    with open(ofile, 'w') as ohandle:
+        for k, part in enumerate(parts):
+            with open(part) as phandle:
+                if k:
+                    phandle.readline()
+                for line in phandle:
+                    ohandle.write(line)
+            os.remove(part)
+
+    diag = monitor.table(groups, converged)
+    diag.to_csv('%s_diagnostics.csv' % ofile.rsplit('.', 1)[0], index=False)
+
+    return diag
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-f', '--files', dest='files',
+                      help='Comma separated distances outputs (csv) or '
+                      'gamma_stats.py files (npz)',
+                      metavar='<file,file,...>')
+    parser.add_option('-e', '--events', dest='events',
+                      help='Comma separated distance columns '
+                      '(default: event_ndist,seed_ndist)',
+                      default='event_ndist,seed_ndist',
+                      metavar='<col,col,...>')
+    parser.add_option('-o', '--output', dest='ofile',
+                      help='Output csv with the posterior samples',
+                      metavar='<path/to/file.csv>')
+    parser.add_option('-c', '--chains', dest='nchains',
+                      help='Number of chains, each in a process (default: 3)',
+                      type='int', default=3, metavar='<N>')
+    parser.add_option('-n', '--niter', dest='niter',
+                      help='Iterations per chain (default: 100000)',
+                      type='int', default=100000, metavar='<N>')
+    parser.add_option('-t', '--thin', dest='thin',
+                      help='Thinning interval (default: 3)',
+                      type='int', default=3, metavar='<N>')
+    parser.add_option('-u', '--unifmax', dest='unifmax',
+                      help='Upper bound of the uniform priors (default: 100)',
+                      type='float', default=100, metavar='<float>')
+    parser.add_option('-s', '--seed', dest='seed',
+                      help='Random seed', type='int', metavar='<N>')
+    parser.add_option('-m', '--mode', dest='mode',
+                      help='mcmc (posterior samples, default) or mle (maximum '
+                      'likelihood with bootstrap intervals)', default='mcmc',
+                      choices=['mcmc', 'mle'], metavar='<mcmc|mle>')
+    parser.add_option('-b', '--boot', dest='nboot',
+                      help='Bootstrap replicates in mle mode (default: 1000)',
+                      type='int', default=1000, metavar='<N>')
+    parser.add_option('--parametric', dest='parametric',
+                      help='Parametric bootstrap (from the fitted gamma)',
+                      action='store_true')
+    parser.add_option('--batch', dest='batch',
+                      help='Iterations between convergence checks '
+                      '(default: 1000)', type='int', default=1000,
+                      metavar='<N>')
+    parser.add_option('--rhat', dest='rhat',
+                      help='Stop the species and events with R-hat under '
+                      'this value (and --ess, if given)', type='float',
+                      metavar='<float>')
+    parser.add_option('--ess', dest='ess',
+                      help='Stop the species and events with an effective '
+                      'sample size over this value (and --rhat, if given)',
+                      type='float', metavar='<float>')
+    parser.add_option('--init-mle', dest='init_mle',
+                      help='Start the chains from the maximum likelihood '
+                      'estimates', action='store_true')
+    (options, args) = parser.parse_args()
+
+    groups = load_stats(options.files.split(','), options.events.split(','))
+
+    if options.mode == 'mle':
+        print('Fitting %d species and events' % len(groups))
+        estimate = derived(*gamma_mle(groups['n'], groups['sum_x'],
+                                      groups['sum_log'], options.unifmax))
+        boot = derived(*bootstrap(groups, options.nboot, options.parametric,
+                                  options.unifmax, options.seed))
+
+        # The replicates in the posterior samples format
+        long_table(boot, groups, 1).to_csv(options.ofile, index=False)
+        sfile = '%s_summary.csv' % options.ofile.rsplit('.', 1)[0]
+        mle_summary(groups, estimate, boot).to_csv(sfile, index=False)
+        print('Bootstrap replicates written to: %s' % options.ofile)
+        print('Estimates written to: %s' % sfile)
+        return 0
+
+    init = None
+    if options.init_mle:
+        init = gamma_mle(groups['n'], groups['sum_x'], groups['sum_log'],
+                         options.unifmax)
+
+    print('Sampling %d species and events' % len(groups))
+    diag = run_chains(groups, options.nchains, options.niter, options.thin,
+                      options.unifmax, options.seed, options.ofile, init,
+                      options.batch, options.rhat, options.ess)
+    if options.rhat is not None or options.ess is not None:
+        print('Converged: %d of %d' %
+              (diag['converged'].sum() // 2, len(groups)))
+    print('Posterior samples written to: %s' % options.ofile)
+
+
+if __name__ == '__main__':
+    main()
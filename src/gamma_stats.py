@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+gamma_stats.py -- Gamma sufficient statistics of the normalised distances
+
+For each species and event (distance column, eg. event_ndist or seed_ndist)
+the script gets the gamma sufficient statistics (n, sum of x and sum of log x)
+of the non zero distances and keeps the filtered values, which are the inputs
+of the gamma inference. As in event_data_parse.R, the rows with equal or zero
+vertebrate and metazoan distances are discarded (--no-event-filter keeps
+them). The shards outputs are read one at a time and only
+the needed columns, and the shards already in the output are not read again,
+so it can be run while new shards arrive.
+
+The output is a numpy npz file (<phylome>_gamma.npz) with the species, the
+events, the statistics matrices (species x event) and the values with their
+species and event codes, and a csv table with the statistics.
+
+Requirements: numpy, pandas (and pyarrow for the parquet outputs)
+'''
+
+# Import libraries ----
+import os
+from glob import glob
+from optparse import OptionParser
+import numpy as np
+import pandas as pd
+
+from ordered_output import read_table, table_columns
+from utils import file_exists
+
+
+# Definitions ----
+class gamma_stats(object):
+    '''
+    Sufficient statistics and values per (species, event)
+    '''
+
+    def __init__(self, events=None, max_ratio=None, event_filter=True):
+        self.groups = dict()
+        self.shards = dict()
+        # Options the statistics were built with
+        self.events_opt = events
+        self.max_ratio = max_ratio
+        self.event_filter = event_filter
+
+    def same_options(self, events, max_ratio, event_filter=True):
+        '''
+        Whether the statistics were built with these events, ratio and
+        event filter
+        '''
+
+        return (self.events_opt == list(events) and
+                self.max_ratio == max_ratio and
+                self.event_filter == event_filter)
+
+    def add(self, species, event, values):
+        '''
+        Add the values of a species and event, only the positive ones are
+        kept as the gamma density is not defined at 0
+        '''
+
+        values = np.asarray(values, dtype=np.float64)
+        values = values[values > 0]
+        group = self.groups.setdefault((species, event), list())
+        group.append(values)
+
+    def add_shard(self, file, events, spcol='species', max_ratio=None,
+                  event_filter=True):
+        '''
+        Read the events columns of a shard and add them
+
+        Args:
+            file (str): shard output, csv or parquet
+            events (list): distance columns
+            spcol (str): species column
+            max_ratio (float): maximum whole_width / norm_width, the trees
+            over it are discarded
+            event_filter (bool): discard the rows with equal or zero
+            vert_dist and met_dist (the events outputs), as
+            event_data_parse.R
+
+        Returns:
+            int: number of rows used
+        '''
+
+        header = table_columns(file)
+        events = [event for event in events if event in header]
+        cols = [spcol] + events
+        if max_ratio is not None:
+            cols += ['whole_width', 'norm_width']
+        event_filter = (event_filter and 'vert_dist' in header and
+                        'met_dist' in header)
+        if event_filter:
+            cols += [col for col in ['vert_dist', 'met_dist']
+                     if col not in cols]
+        df = read_table(file, cols)
+        if event_filter:
+            df = df[(df['vert_dist'] != df['met_dist']) &
+                    (df['vert_dist'] != 0) & (df['met_dist'] != 0)]
+        if max_ratio is not None:
+            df = df[df['whole_width'] / df['norm_width'] < max_ratio]
+
+        # The parquet species are categories, only the present ones
+        for species, sdf in df.groupby(spcol, observed=True):
+            for event in events:
+                self.add(species, event, sdf[event].to_numpy())
+
+        self.shards[os.path.basename(file)] = os.path.getmtime(file)
+
+        return len(df)
+
+    def merge(self, other):
+        '''
+        Pool the values of other statistics (eg. of another phylome) with
+        these, the species and events of both are added together
+        '''
+
+        for key, group in other.groups.items():
+            self.groups.setdefault(key, list()).extend(group)
+
+    def values(self, species, event):
+        group = self.groups.get((species, event), list())
+        if not group:
+            return np.zeros(0)
+        if len(group) > 1:
+            group[:] = [np.concatenate(group)]
+
+        return group[0]
+
+    def arrays(self):
+        '''
+        Get the statistics as arrays
+
+        Returns:
+            dict: species, events, n, sum_x and sum_log (species x event),
+            values with value_species and value_event indexes
+        '''
+
+        species = sorted(set(key[0] for key in self.groups))
+        events = sorted(set(key[1] for key in self.groups))
+        shape = (len(species), len(events))
+        out = {'species': np.array(species, dtype=str),
+               'events': np.array(events, dtype=str),
+               'n': np.zeros(shape, dtype=np.int64),
+               'sum_x': np.zeros(shape),
+               'sum_log': np.zeros(shape)}
+        values = list()
+        value_sp = list()
+        value_ev = list()
+        for i, sp in enumerate(species):
+            for j, event in enumerate(events):
+                vals = self.values(sp, event)
+                out['n'][i, j] = len(vals)
+                out['sum_x'][i, j] = vals.sum()
+                out['sum_log'][i, j] = np.log(vals).sum()
+                values.append(vals)
+                value_sp.append(np.full(len(vals), i, dtype=np.int32))
+                value_ev.append(np.full(len(vals), j, dtype=np.int32))
+        out['values'] = np.concatenate(values) if values else np.zeros(0)
+        out['value_species'] = np.concatenate(value_sp) if values else \
+            np.zeros(0, dtype=np.int32)
+        out['value_event'] = np.concatenate(value_ev) if values else \
+            np.zeros(0, dtype=np.int32)
+        out['shards'] = np.array(sorted(self.shards), dtype=str)
+        out['shard_mtimes'] = np.array([self.shards[shard]
+                                        for shard in sorted(self.shards)])
+        out['events_opt'] = np.array(self.events_opt or list(), dtype=str)
+        out['max_ratio'] = np.array(np.nan if self.max_ratio is None
+                                    else self.max_ratio)
+        out['event_filter'] = np.array(bool(self.event_filter))
+
+        return out
+
+    def write(self, ofile):
+        np.savez(ofile, **self.arrays())
+
+        return 0
+
+    @classmethod
+    def read(cls, ifile):
+        new = cls()
+        with np.load(ifile) as data:
+            for k, sp in enumerate(data['species']):
+                for j, event in enumerate(data['events']):
+                    sel = ((data['value_species'] == k) &
+                           (data['value_event'] == j))
+                    if data['n'][k, j]:
+                        new.groups[(str(sp), str(event))] = \
+                            [data['values'][sel]]
+            new.shards = dict(zip(data['shards'].tolist(),
+                                  data['shard_mtimes'].tolist()))
+            # The files written before the options were kept are rebuilt
+            if 'events_opt' in data:
+                new.events_opt = data['events_opt'].tolist()
+                ratio = float(data['max_ratio'])
+                new.max_ratio = None if np.isnan(ratio) else ratio
+            # The files written before the filter are rebuilt
+            new.event_filter = (bool(data['event_filter'])
+                                if 'event_filter' in data else None)
+
+        return new
+
+    def write_table(self, ofile):
+        '''
+        Write the statistics as a csv with a row per species and event
+        '''
+
+        arrs = self.arrays()
+        rows = list()
+        for i, sp in enumerate(arrs['species']):
+            for j, event in enumerate(arrs['events']):
+                n = arrs['n'][i, j]
+                rows.append({'species': sp, 'event': event, 'n': n,
+                             'sum_x': arrs['sum_x'][i, j],
+                             'sum_log': arrs['sum_log'][i, j],
+                             'mean': arrs['sum_x'][i, j] / n if n else None,
+                             'mean_log': (arrs['sum_log'][i, j] / n
+                                          if n else None)})
+        pd.DataFrame(rows).to_csv(ofile, index=False)
+
+        return 0
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='idir',
+                      help='Folder with the shards outputs',
+                      metavar='<path/to/outputs>', default='outputs')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Output folder (default: the input one)',
+                      metavar='<path/to/folder>')
+    parser.add_option('-e', '--events', dest='events',
+                      help='Comma separated distance columns (default: '
+                      'event_ndist,seed_ndist,vert_ndist,met_ndist, the ones '
+                      'in the outputs are used)',
+                      default='event_ndist,seed_ndist,vert_ndist,met_ndist',
+                      metavar='<col,col,...>')
+    parser.add_option('-r', '--max-ratio', dest='max_ratio',
+                      help='Discard the trees with whole_width / norm_width '
+                      'over this ratio', type='float', metavar='<float>')
+    parser.add_option('--no-event-filter', dest='event_filter',
+                      help='Keep the rows with equal or zero vert_dist and '
+                      'met_dist', action='store_false', default=True)
+    (options, args) = parser.parse_args()
+
+    odir = options.odir or options.idir
+    events = options.events.split(',')
+    files = sorted(glob('%s/*_*_dist.csv' % options.idir) +
+                   glob('%s/*_*_dist.parquet' % options.idir))
+    ids = sorted(set(os.path.basename(file).split('_', 1)[0]
+                     for file in files))
+
+    for phyid in ids:
+        ofile = '%s/%s_gamma.npz' % (odir, phyid)
+        stats = gamma_stats(events, options.max_ratio,
+                            options.event_filter)
+        if file_exists(ofile):
+            stats = gamma_stats.read(ofile)
+
+        shards = sorted(glob('%s/%s_*_dist.csv' % (options.idir, phyid)) +
+                        glob('%s/%s_*_dist.parquet' % (options.idir, phyid)))
+        changed = [file for file in shards
+                   if stats.shards.get(os.path.basename(file),
+                                       os.path.getmtime(file)) !=
+                   os.path.getmtime(file)]
+        # The shards removed (or written in the other format) are also
+        # changes
+        removed = set(stats.shards) - set(os.path.basename(file)
+                                          for file in shards)
+        if changed or removed:
+            print('Updated shards, rebuilding: ', phyid)
+            stats = gamma_stats(events, options.max_ratio,
+                                options.event_filter)
+        elif not stats.same_options(events, options.max_ratio,
+                                    options.event_filter):
+            print('Other events, ratio or filter, rebuilding: ', phyid)
+            stats = gamma_stats(events, options.max_ratio,
+                                options.event_filter)
+
+        new = [file for file in shards
+               if os.path.basename(file) not in stats.shards]
+        if not new:
+            print('Up to date: ', phyid)
+            continue
+
+        for file in new:
+            print('Parsing: ', file)
+            stats.add_shard(file, events, max_ratio=options.max_ratio,
+                            event_filter=options.event_filter)
+
+        stats.write(ofile)
+        stats.write_table('%s/%s_gamma.csv' % (odir, phyid))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,17 @@
 '''
 get_trees.py -- Get trees from phylome db
 
-This script runs in parallel threads the download of the phylomes data and
-trees. It requires a list in plain text format separated by line breaks.
+This script runs concurrently the download of the phylomes data and trees. It requires a list in plain text format separated by line breaks.
 
-Requirements: download.py and thread.py
+With --store, the files are first looked up in a local store shared by
+several working directories (artifact_store.py) and linked from it, and the
+new downloads are added to it.
+
+With --shards, the trees files are split in shards (ingest.py) while they are
+downloaded, instead of running split_trees.py after the download.
+
+Requirements: download.py, download_manager.py, artifact_store.py and
+ingest.py
 
 Written by Moisès Bernabeu <mail@mail.com>
 January 2022
@@ -15,18 +22,25 @@ January 2022
 
 # Import libraries ----
 from optparse import OptionParser
-from os.path import isfile
+from os.path import isfile, basename
 from os import stat
-from thread import thread
-import time
+import sys
 # import ftplib
 from rooted_phylomes import ROOTED_PHYLOMES
+from metrics import metrics_writer
+from download_manager import download_manager, download_job
+from download import validate, download_error
+from artifact_store import artifact_store
+from ingest import SHARD_SIZE, shard_writer, gzip_rows, split_file, \
+    split_marker
+from utils import create_folder
 
 
 # Definitions ----
-def yet_downloaded(dir, name):
+def yet_downloaded(dir, name, verify=False):
     '''
-    Check the existence and size of the file, returns True or False
+    Check the existence and size of the file, returns True or False. With
+    verify, the file has also to be complete and valid.
     '''
     fp = '/'.join([dir, name])
 
@@ -34,9 +48,14 @@ def yet_downloaded(dir, name):
     if isfile(fp):
         # Check the file is not empty
         if stat(fp).st_size != 0:
+            if verify:
+                try:
+                    validate(fp)
+                except download_error as e:
+                    print('Downloading again: %s' % e)
+                    return False
             return True
-    else:
-        return False
+    return False
 
 
 def main():
@@ -55,8 +74,43 @@ def main():
                       help='Working directory in which data will be stored',
                       metavar='<path/to/workdir>')
     parser.add_option('-t', '--th', dest='threads',
-                      help='Number of threads to be used.',
+                      help='Number of threads to be used (default: 4).',
                       metavar='<N>', type='int')
+    parser.add_option('-m', '--metrics', dest='metrics',
+                      help='Prometheus textfile to write the progress metrics',
+                      metavar='<path/to/file.prom>')
+    parser.add_option('--per-host', dest='per_host',
+                      help='Maximum downloads at once from the same host '
+                      '(default: the number of threads)', metavar='<N>',
+                      type='int')
+    parser.add_option('--timeout', dest='timeout',
+                      help='Seconds without response before a request is '
+                      'retried (default: 180)', metavar='<seconds>',
+                      type='float', default=180)
+    parser.add_option('--retries', dest='retries',
+                      help='Retries of a failed download (default: 3)',
+                      metavar='<N>', type='int', default=3)
+    parser.add_option('--verify', dest='verify',
+                      help='Check the integrity of the files already '
+                      'downloaded and download again the corrupt ones',
+                      action='store_true')
+    parser.add_option('--url', dest='url',
+                      help='Base url of the phylomes (default: PhylomeDB ftp)',
+                      metavar='<url>')
+    parser.add_option('-s', '--store', dest='store',
+                      help='Local store of the downloaded files, shared by '
+                      'several working directories', metavar='<path/to/store>')
+    parser.add_option('--store-size', dest='store_size',
+                      help='Maximum size of the store in GB, the least '
+                      'recently used files are removed (default: no limit)',
+                      metavar='<GB>', type='float')
+    parser.add_option('--shards', dest='shards',
+                      help='Split the trees files in shards in this folder '
+                      'while they are downloaded', metavar='<path/to/folder>')
+    parser.add_option('--shard-size', dest='shard_size',
+                      help='Maximum bytes of trees per shard (default: %d)' %
+                      SHARD_SIZE, metavar='<bytes>', type='int',
+                      default=SHARD_SIZE)
     (options, args) = parser.parse_args()
 
     # FTP initial direction
@@ -84,74 +138,84 @@ def main():
         workdir = '../outputs'
     else:
         workdir = options.workdir
-        threads = options.threads
+        threads = options.threads or 4
         ifile = options.ifile
         pdbids = open(ifile)
 
-    # Execution of all threads in the threadpool
-    sleeptime = 1
-    tasks = list()
+    if options.url:
+        ftp = options.url.rstrip('/') + '/phylome_'
+
+    store = None
+    if options.store:
+        max_size = None
+        if options.store_size is not None:
+            max_size = int(options.store_size * 1e9)
+        store = artifact_store(options.store, max_size)
+
+    create_folder(workdir)
 
+    # Files to download
+    jobs = list()
     for line in pdbids:
         line = line.replace('\n', '')
         if line != '':
-            if (len(tasks) >= threads):
-                # Wait for a process to finish
-                done = False
-                while not done:
-                    time.sleep(sleeptime)
-                    for task in tasks:
-                        if not task.is_alive():
-                            # With these conditions the thread is ended, print
-                            # and free a slot
-                            task.show()
-                            tasks.remove(task)
-                            done = True
-
-            # Downloading filenames
-            tree_url = ftp + line + '/' + trees
-            data_url = ftp + line + '/' + data
-            gene_url = ftp + line + '/' + gene
-            prot_url = ftp + line + '/' + prot
-
-            tree_ofile = line + '_' + trees
-            data_ofile = line + '_' + data
-            gene_ofile = line + '_' + gene
-            prot_ofile = line + '_' + prot
-
-            # Download trees
-            if not yet_downloaded(workdir, tree_ofile):
-                tree_thread = thread(line, tree_url, workdir, tree_ofile)
-                tree_thread.show()
-                tree_thread.start()
-                tasks.append(tree_thread)
-
-            # Download phylome data
-            if not yet_downloaded(workdir, data_ofile):
-                data_thread = thread(line, data_url, workdir, data_ofile)
-                data_thread.show()
-                data_thread.start()
-                tasks.append(data_thread)
-
-            # Download protein data
-            if not yet_downloaded(workdir, gene_ofile):
-                gene_thread = thread(line, gene_url, workdir, gene_ofile)
-                gene_thread.show()
-                gene_thread.start()
-                tasks.append(gene_thread)
-
-            # Download protein data
-            if not yet_downloaded(workdir, prot_ofile):
-                prot_thread = thread(line, prot_url, workdir, prot_ofile)
-                prot_thread.show()
-                prot_thread.start()
-                tasks.append(prot_thread)
-
-    for task in tasks:
-        # Finish remaining tasks
-        task.join()
-        task.show()
+            for fname in [trees, data, gene, prot]:
+                ofile = line + '_' + fname
+                dest = '/'.join([workdir, ofile])
+                local = yet_downloaded(workdir, ofile, options.verify)
+                if not local and store is not None and \
+                        store.get(line, fname, dest):
+                    local = not options.verify or \
+                        yet_downloaded(workdir, ofile, True)
+                    if local:
+                        print('From the store: %s' % dest)
+
+                sink = None
+                if options.shards and fname == trees:
+                    if not local:
+                        sink = gzip_rows(shard_writer(options.shards, line,
+                                                      options.shard_size))
+                    elif not isfile(split_marker(options.shards, line)):
+                        # A split interrupted before the last shard is
+                        # started again
+                        split_file(dest, options.shards, line,
+                                   options.shard_size)
+
+                if not local:
+                    jobs.append(download_job(line, ftp + line + '/' + fname,
+                                             dest, sink))
+
+    manager = download_manager(threads, options.per_host, options.timeout,
+                               options.retries)
+
+    if options.metrics:
+        metrics = metrics_writer(options.metrics, 'get_trees', 'download',
+                                 'files', len(jobs), threads)
+        metrics.processes = manager.running
+        metrics.start()
+        manager.counters = metrics.counters
+
+    def done(job):
+        job.show()
+        if store is not None and job.error is None:
+            # The workdir files are named <phylome>_<artifact>
+            artifact = basename(job.dest)[len(job.dbid) + 1:]
+            store.put(job.dbid, artifact, job.dest)
+        if manager.counters is not None:
+            manager.counters.add('done')
+
+    manager.download(jobs, done)
+
+    if options.metrics:
+        metrics.stop()
+
+    failed = [job for job in jobs if job.error is not None]
+    if failed:
+        print('Failed downloads: %d' % len(failed))
+        return 1
+
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
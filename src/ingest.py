@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+ingest.py -- Split the best trees files in shards as they are read
+
+The compressed bytes are decompressed, split in rows and written to the
+shards (<phylome>_<n>.txt) as they arrive, so the memory does not depend on
+the file size. A shard is written to <shard>.part and renamed when it is full,
+so the trees of the first shards can be processed while the file is still
+being downloaded (see get_trees.py --shards), and <phylome>.done is written
+with the shards names when the last one is.
+
+The compute stages read their shards with read_rows, which streams the rows
+of plain, gzip or zstandard files (or of the standard input) without loading
+the file, decompressing them in another process with pigz or zstd when they
+are installed.
+'''
+
+# Import libraries ----
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils import create_folder
+
+
+# Definitions ----
+# Bytes of trees per shard
+SHARD_SIZE = 500000
+
+
+def split_marker(odir, phylome_id):
+    '''
+    Marker written when all the shards of a phylome are written
+    '''
+
+    return '%s/%s.done' % (odir, phylome_id)
+
+
+class shard_writer(object):
+    '''
+    Write rows to shards of at most size bytes (a row is never split)
+
+    Args:
+        odir (str): shards folder
+        phylome_id (str): phylome id, the shards prefix
+        size (int): maximum bytes per shard
+    '''
+
+    def __init__(self, odir, phylome_id, size=SHARD_SIZE):
+        self.odir = odir
+        self.phylome_id = phylome_id
+        self.size = size
+        self.shards = list()
+        self.handle = None
+        self.written = 0
+        create_folder(odir)
+
+    def path(self, shardno):
+        return '%s/%s_%d.txt' % (self.odir, self.phylome_id, shardno)
+
+    def close(self):
+        '''
+        Close the last shard and write the marker of a complete split, with
+        the names of its shards
+        '''
+
+        self.flush()
+        with open(split_marker(self.odir, self.phylome_id), 'w') as ohandle:
+            for shard in self.shards:
+                ohandle.write(os.path.basename(shard) + '\n')
+
+    def write(self, row):
+        if self.handle is not None and self.written + len(row) > self.size:
+            self.flush()
+        if self.handle is None:
+            self.handle = open(self.path(len(self.shards)) + '.part', 'wb')
+            self.written = 0
+        self.handle.write(row)
+        self.written += len(row)
+
+    def flush(self):
+        '''
+        Close the current shard and give it its final name
+        '''
+
+        if self.handle is None:
+            return
+        self.handle.close()
+        self.handle = None
+        shard = self.path(len(self.shards))
+        os.replace(shard + '.part', shard)
+        self.shards.append(shard)
+        print('Shard written: %s' % shard)
+
+    def reset(self):
+        '''
+        Remove the shards written, to start again
+        '''
+
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+            os.remove(self.path(len(self.shards)) + '.part')
+        for shard in self.shards + [split_marker(self.odir,
+                                                 self.phylome_id)]:
+            if os.path.isfile(shard):
+                os.remove(shard)
+        self.shards = list()
+
+
+class gzip_rows(object):
+    '''
+    Decompress gzip blocks and pass the complete rows to a writer
+
+    It is the download sink of download.fetch: it gets the blocks in order
+    and counts them in offset, so after a failure the download can resume
+    from the same byte. A corrupt stream is not raised here, fetch validates
+    the whole file and calls reset.
+
+    Args:
+        writer (shard_writer): rows writer
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.reset()
+
+    def reset(self):
+        self.writer.reset()
+        self.decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.pending = b''
+        self.offset = 0
+        self.failed = False
+
+    def rows(self, data):
+        data = self.pending + data
+        end = data.rfind(b'\n') + 1
+        self.pending = data[end:]
+        for row in data[:end].split(b'\n')[:-1]:
+            if row.strip():
+                self.writer.write(row + b'\n')
+
+    def write(self, block):
+        self.offset += len(block)
+        if self.failed:
+            return
+        try:
+            data = self.decomp.decompress(block)
+            # Concatenated gzip members
+            while self.decomp.eof and self.decomp.unused_data:
+                rest = self.decomp.unused_data
+                self.decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                data += self.decomp.decompress(rest)
+        except zlib.error:
+            self.failed = True
+            return
+        self.rows(data)
+
+    def close(self):
+        '''
+        Write the last row and shard
+        '''
+
+        if self.pending.strip():
+            self.writer.write(self.pending + b'\n')
+        self.pending = b''
+        self.writer.close()
+
+        return self.writer.shards
+
+
+def split_file(path, odir, phylome_id, size=SHARD_SIZE, chunk=2 ** 20):
+    '''
+    Split a downloaded best trees file in shards
+
+    Returns:
+        list: shards paths
+    '''
+
+    sink = gzip_rows(shard_writer(odir, phylome_id, size))
+    with open(path, 'rb') as ihandle:
+        for block in iter(lambda: ihandle.read(chunk), b''):
+            sink.write(block)
+    if sink.failed:
+        sink.reset()
+        raise OSError('Corrupt file %s' % path)
+
+    return sink.close()
+
+
+def shard_name(path, name=None):
+    '''
+    Shard id of an input file (splitted/0005_19.txt.gz: 0005_19), name is
+    used when it is given and it is needed for the standard input
+    '''
+
+    if name is not None:
+        return name
+    if path == '-':
+        raise ValueError('The standard input needs a shard name')
+
+    return os.path.basename(path).split('.', 1)[0]
+
+
+def read_rows(path):
+    '''
+    Iterate the rows of a trees file as they are read
+
+    The files ending in .gz or .zst are decompressed by pigz or zstd in
+    another process when they are in the PATH, so the decompression runs in
+    parallel with the parsing, and otherwise by the gzip or zstandard
+    modules. - reads the standard input. The file is opened at once, so the
+    errors are raised before reading.
+
+    Args:
+        path (str): plain, .gz or .zst file, or -
+
+    Returns:
+        generator: the rows without the line break, the empty ones are
+        skipped
+
+    Raises:
+        OSError: the file can not be opened or decompressed
+        ValueError: a .zst file without zstd nor zstandard
+    '''
+
+    proc = None
+    if path == '-':
+        handle = sys.stdin
+    elif path.endswith(('.gz', '.zst')):
+        tool = 'pigz' if path.endswith('.gz') else 'zstd'
+        if not os.path.isfile(path):
+            raise FileNotFoundError('No such file: %s' % path)
+        if shutil.which(tool):
+            proc = subprocess.Popen([tool, '-dc', path],
+                                    stdout=subprocess.PIPE)
+            handle = io.TextIOWrapper(proc.stdout)
+        elif path.endswith('.gz'):
+            handle = gzip.open(path, 'rt')
+        elif zstandard is not None:
+            handle = io.TextIOWrapper(
+                zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+        else:
+            raise ValueError('Reading %s needs zstd or the zstandard module'
+                             % path)
+    else:
+        handle = open(path)
+
+    def rows():
+        complete = False
+        try:
+            for row in handle:
+                row = row.rstrip('\n')
+                if row.strip() != '':
+                    yield row
+            complete = True
+        finally:
+            if proc is not None and not complete:
+                proc.terminate()
+            if handle is not sys.stdin:
+                handle.close()
+            if proc is not None and proc.wait() != 0 and complete:
+                raise OSError('Could not decompress %s' % path)
+
+    return rows()
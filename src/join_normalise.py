@@ -6,19 +6,59 @@ join_normalise.py -- Phylome partitions join and calculate normalised distances
 
 
 
-Requirements: pandas
+Requirements: pandas (and pyarrow for the parquet format)
 
 Written by Moisès Bernabeu <moigil.bernabeu.sci@gmail.com>
 March 2022
 '''
 
 # Import libraries ----
+import re
 import pandas as pd
 from glob import glob
+from optparse import OptionParser
+from ordered_output import table_stream, read_table, check_format, FORMATS
+
+
+# Shard outputs: <phylome>_<shard>_dist.csv or <phylome>_<shard>_heavy_dist.csv
+# (or .parquet)
+SHARD = re.compile(r'^\d+_(\d+)(_heavy)?_dist\.(csv|parquet)$')
+
+
+def shard_key(file):
+    '''
+    Shard number of a file and whether it is the heavy queue output, so the
+    shards are joined in the same order in all the runs
+    '''
+
+    match = SHARD.match(file.rsplit('/', 1)[1])
+
+    return int(match.group(1)), match.group(2) is not None
+
 
 # Script
 def main():
-    files = glob('outputs/*.csv')
+    parser = OptionParser()
+    parser.add_option('-F', '--format', dest='format',
+                      help='Format of the joined tables: csv or parquet '
+                      '(compressed and columnar, it needs pyarrow), the '
+                      'shards can be in any of them',
+                      choices=['csv', 'parquet'], default='csv',
+                      metavar='<csv|parquet>')
+    parser.add_option('--float32', dest='float32',
+                      help='Comma separated float columns stored in single '
+                      'precision in the parquet tables',
+                      default='', metavar='<col,col,...>')
+    (options, args) = parser.parse_args()
+
+    try:
+        check_format(options.format)
+    except ValueError as e:
+        parser.error(str(e))
+    float32 = [col for col in options.float32.split(',') if col]
+    ext = FORMATS[options.format]
+
+    files = glob('outputs/*.csv') + glob('outputs/*.parquet')
     print(files)
 
     ids = list()
@@ -28,15 +68,24 @@ def main():
 
     for phyid in ids:
         print('Parsing: ', phyid)
-        distfiles = glob('outputs/%s*_dist.csv' % phyid)
+        # The joined file of a previous run is not a shard, and a shard
+        # written in both formats is read in the output one
+        shards = dict()
+        for file in sorted(glob('outputs/%s_*_dist.*' % phyid),
+                           key=lambda x: x.endswith(ext)):
+            if SHARD.match(file.rsplit('/', 1)[1]):
+                shards[shard_key(file)] = file
+        distfiles = [shards[key] for key in sorted(shards)]
 
-        for i, file in enumerate(distfiles):
-            if i == 0:
-                distdf = pd.read_csv(file)
-            else:
-                distdf = pd.concat([distdf, pd.read_csv(file)])
+        # The shards without trees passing the filters have no columns
+        frames = [read_table(file) for file in distfiles]
+        frames = [frame for frame in frames if len(frame.columns)]
+        distdf = pd.concat(frames) if frames else pd.DataFrame()
 
-        distdf.to_csv('outputs/%s_dist.csv' % phyid, index=False)
+        ofile = 'outputs/%s_dist%s' % (phyid, ext)
+        out = table_stream(ofile, options.format, float32)
+        out(distdf)
+        out.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+memo_cache.py -- Persistent cache of the per tree results
+
+Overlapping phylomes and seeds of the same family have the same best tree,
+so its results (normalisation factors, sequence pairs distances and
+events) are kept in a SQLite cache keyed by the hash of the rooted tree and
+of the order of its leaves (batchtrees.tree_hash) and the inputs the results
+depend on (the normalising groups, the query...). The values are zlib
+compressed json and the least recently used ones are removed when the cache
+goes over its size limit. Several worker processes can read and write the
+cache at once.
+'''
+
+# Import libraries ----
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+
+# Definitions ----
+def memo_key(*parts):
+    '''
+    Cache key of a result from the hashes and parameters it depends on
+    '''
+
+    return hashlib.sha256('\t'.join(str(part) for part in parts)
+                          .encode()).hexdigest()
+
+
+def frame_hash(df, columns):
+    '''
+    Hash of some columns of a table, to key the results that depend on it
+    '''
+
+    return hashlib.sha256(df[columns].to_csv(index=False).encode()) \
+        .hexdigest()
+
+
+class memo_cache(object):
+    '''
+    Results cache with size based eviction
+
+    Args:
+        path (str): SQLite database, it is created if it does not exist
+        max_size (int): maximum bytes of the values, None for no limit
+    '''
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS memo (
+                key TEXT PRIMARY KEY, value BLOB, size INTEGER,
+                used REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS memo_used ON memo '
+                          '(used)')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        '''
+        Get a cached value, None if it is not in the cache
+        '''
+
+        row = self.conn.execute('SELECT value FROM memo WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute('UPDATE memo SET used = ? WHERE key = ?',
+                              (time.time(), key))
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        '''
+        Cache a json serialisable value
+        '''
+
+        blob = zlib.compress(json.dumps(value).encode())
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO memo VALUES '
+                              '(?, ?, ?, ?)',
+                              (key, blob, len(blob), time.time()))
+
+    def size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM memo') \
+            .fetchone()[0]
+
+    def evict(self):
+        '''
+        Remove the least recently used values over the size limit
+
+        Returns:
+            int: values removed
+        '''
+
+        if self.max_size is None:
+            return 0
+
+        excess = self.size() - self.max_size
+        removed = list()
+        for key, size in self.conn.execute('SELECT key, size FROM memo '
+                                           'ORDER BY used'):
+            if excess <= 0:
+                break
+            removed.append((key,))
+            excess -= size
+        with self.conn:
+            self.conn.executemany('DELETE FROM memo WHERE key = ?', removed)
+
+        return len(removed)
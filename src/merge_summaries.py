@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+merge_summaries.py -- Merge the per species pair distance summaries
+
+The shards summaries written by seq2seq_cladenorm.py -a are merged one at a
+time per phylome, so the sequence pairs are never loaded. The merged summaries
+are written in json (to be merged again) and as a csv table with the counts,
+moments and quantiles per species pair, MRCA type and variable.
+
+Requirements: numpy, sketches
+'''
+
+# Import libraries ----
+from glob import glob
+from optparse import OptionParser
+from sketches import summary_table
+
+
+# Script
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='idir',
+                      help='Folder with the shards summaries',
+                      metavar='<path/to/outputs>', default='outputs')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Output folder (default: the input one)',
+                      metavar='<path/to/folder>')
+    (options, args) = parser.parse_args()
+
+    odir = options.odir or options.idir
+    files = sorted(glob('%s/*_*_summary.json' % options.idir))
+
+    ids = sorted(set(file.rsplit('/', 1)[1].split('_', 1)[0]
+                     for file in files))
+
+    for phyid in ids:
+        print('Parsing: ', phyid)
+        table = summary_table()
+        for file in sorted(glob('%s/%s_*_summary.json' %
+                                (options.idir, phyid))):
+            table.merge(summary_table.read(file))
+
+        table.write('%s/%s_summary.json' % (odir, phyid))
+        table.write_table('%s/%s_summary.csv' % (odir, phyid))
+
+
+if __name__ == '__main__':
+    main()
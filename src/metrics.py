@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+metrics.py -- Live progress and throughput metrics of the stage jobs
+
+A metrics_writer thread periodically rewrites a Prometheus textfile (to be
+picked by the node exporter textfile collector) with the progress of the job:
+items done and remaining, trees/pairs/bytes per second, busy workers and
+memory. The counters are shared memory values, so the worker processes and
+download threads update them directly.
+'''
+
+# Import libraries ----
+import os
+import threading
+import time
+from multiprocessing import Value
+
+
+# Definitions ----
+class stage_counters(object):
+    '''
+    Counters shared between the main process and the workers
+    '''
+
+    def __init__(self):
+        self.done = Value('q', 0)
+        self.pairs = Value('q', 0)
+        self.bytes = Value('q', 0)
+
+    def add(self, counter, n=1):
+        '''
+        Increase the counter (done, pairs or bytes) by n
+        '''
+
+        value = getattr(self, counter)
+        with value.get_lock():
+            value.value += n
+
+
+def rss(pid):
+    '''
+    Get the resident memory of a process in bytes, 0 if it is not available
+    '''
+
+    try:
+        with open('/proc/%d/statm' % pid) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def children(pid):
+    '''
+    Get the pids of all the descendant processes of a process
+    '''
+
+    pids = list()
+    stack = [pid]
+    while stack:
+        ppid = stack.pop()
+        try:
+            tasks = os.listdir('/proc/%d/task' % ppid)
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open('/proc/%d/task/%s/children' % (ppid, task)) as ch:
+                    kids = [int(kid) for kid in ch.read().split()]
+            except (OSError, ValueError):
+                kids = list()
+            pids.extend(kids)
+            stack.extend(kids)
+
+    return pids
+
+
+class metrics_writer(threading.Thread):
+    '''
+    Rewrite the metrics textfile every interval seconds
+
+    Args:
+        ofile (str): Prometheus textfile (.prom)
+        stage (str): stage name, eg. seq2seq_cladenorm
+        job (str): job name, eg. the shard id
+        unit (str): what is counted as done, trees or files
+        total (int): number of items to be done
+        workers (int): maximum number of workers
+        interval (float): seconds between rewrites
+    '''
+
+    def __init__(self, ofile, stage, job, unit, total, workers, interval=15):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ofile = ofile
+        self.labels = 'stage="%s",job="%s"' % (stage, job)
+        self.unit = unit
+        self.total = total
+        self.workers = workers
+        self.interval = interval
+        self.counters = stage_counters()
+        self.processes = list()
+        self.start_time = time.time()
+        self.last_done = 0
+        self.last_progress = self.start_time
+        self.finished = threading.Event()
+
+    def busy(self):
+        '''
+        Number of running workers, processes or threads
+        '''
+
+        return len([proc for proc in list(self.processes) if proc.is_alive()])
+
+    def text(self):
+        '''
+        Get the metrics in the Prometheus exposition format
+        '''
+
+        now = time.time()
+        elapsed = max(now - self.start_time, 1e-9)
+        done = self.counters.done.value
+        if done != self.last_done:
+            self.last_done = done
+            self.last_progress = now
+        busy = self.busy()
+        kids = children(os.getpid())
+
+        metrics = [
+            ('%s_total' % self.unit, 'gauge', 'Items to process', self.total),
+            ('%s_done' % self.unit, 'counter', 'Items processed', done),
+            ('%s_remaining' % self.unit, 'gauge', 'Items left',
+             max(self.total - done, 0)),
+            ('%s_per_second' % self.unit, 'gauge', 'Items processing rate',
+             done / elapsed),
+            ('pairs_done', 'counter', 'Sequence pairs computed',
+             self.counters.pairs.value),
+            ('pairs_per_second', 'gauge', 'Sequence pairs rate',
+             self.counters.pairs.value / elapsed),
+            ('download_bytes', 'counter', 'Bytes downloaded',
+             self.counters.bytes.value),
+            ('download_bytes_per_second', 'gauge', 'Download rate',
+             self.counters.bytes.value / elapsed),
+            ('workers_busy', 'gauge', 'Running workers', busy),
+            ('workers_max', 'gauge', 'Maximum number of workers',
+             self.workers),
+            ('worker_utilisation', 'gauge', 'Fraction of busy workers',
+             busy / self.workers if self.workers else 0),
+            ('memory_main_rss_bytes', 'gauge', 'Main process memory',
+             rss(os.getpid())),
+            ('memory_children_rss_bytes', 'gauge', 'Workers memory',
+             sum(rss(pid) for pid in kids)),
+            ('elapsed_seconds', 'gauge', 'Time since the job start', elapsed),
+            ('last_progress_timestamp_seconds', 'gauge',
+             'Time of the last processed item', self.last_progress),
+            ('last_update_timestamp_seconds', 'gauge',
+             'Time of the last metrics update', now)]
+
+        lines = list()
+        for name, mtype, mhelp, value in metrics:
+            lines.append('# HELP brlens_%s %s' % (name, mhelp))
+            lines.append('# TYPE brlens_%s %s' % (name, mtype))
+            lines.append('brlens_%s{%s} %s' % (name, self.labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        '''
+        Write the textfile atomically
+        '''
+
+        tmp = '%s.%d.tmp' % (self.ofile, os.getpid())
+        with open(tmp, 'w') as ohandle:
+            ohandle.write(self.text())
+        os.replace(tmp, self.ofile)
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        '''
+        Stop the thread writing the final metrics
+        '''
+
+        self.finished.set()
+        self.write()
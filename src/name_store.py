@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+name_store.py -- Indexed store of the PhylomeDB gene and protein names
+
+The *_all_gene_names.txt.gz and *_all_protein_names.txt.gz files downloaded
+by get_trees.py are compiled into a SQLite database with a table keyed by
+(id, kind, name), so the names of a sequence are read from the index (a few
+microseconds per id) instead of loading the names tables in memory. A
+sequence can have several names, they are joined with ';'.
+
+The script builds (or updates, only the new or changed files are read) the
+database and annotates the seed, from and to columns of the distances
+outputs with the names, reading and writing them by chunks:
+
+    name_store.py -i ../01_get_trees/outputs -d names.sqlite
+    name_store.py -d names.sqlite -a outputs/0005_dist.csv
+
+The parquet outputs (-F parquet) are annotated by row groups into
+<file>_names.parquet.
+
+Requirements: pandas (and pyarrow for the parquet outputs)
+'''
+
+# Import libraries ----
+import gzip
+import os
+import sqlite3
+from glob import glob
+from optparse import OptionParser
+import pandas as pd
+
+from ordered_output import check_format, table_stream
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+# Definitions ----
+KINDS = {'all_gene_names': 'gene', 'all_protein_names': 'protein'}
+ID_COLUMNS = ['seed', 'from', 'to']
+# Ids per query, under the SQLite variables limit
+BATCH = 900
+
+
+class name_store(object):
+    '''
+    PhylomeDB id to names lookups
+
+    Args:
+        path (str): SQLite database, it is created if it does not exist
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(names)')]
+        if columns and 'source' not in columns:
+            # Databases without the source of each name are rebuilt, their
+            # rows could not be replaced when a file changes
+            self.conn.executescript('''
+                DROP TABLE names;
+                DROP TABLE IF EXISTS sources;
+                ''')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS names (
+                id TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (id, kind, name, source)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS names_source ON names (source);
+            CREATE TABLE IF NOT EXISTS sources (
+                file TEXT PRIMARY KEY, mtime REAL, rows INTEGER);
+            ''')
+
+    def close(self):
+        self.conn.close()
+
+    def add_file(self, file, chunk=100000):
+        '''
+        Add a names file, it is skipped if it was added with the same mtime
+        and the rows of a previous version of the file are replaced
+
+        Returns:
+            int: rows read, None if it was up to date
+        '''
+
+        name = os.path.basename(file)
+        kind = KINDS[name.split('_', 1)[1].split('.', 1)[0]]
+        mtime = os.path.getmtime(file)
+        row = self.conn.execute('SELECT mtime FROM sources WHERE file = ?',
+                                (name,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return None
+
+        def rows(ihandle):
+            for line in ihandle:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) >= 2 and fields[1]:
+                    yield fields[0], kind, fields[1], name
+
+        nrows = 0
+        with self.conn, gzip.open(file, 'rt') as ihandle:
+            self.conn.execute('DELETE FROM names WHERE source = ?', (name,))
+            batch = list()
+            for row in rows(ihandle):
+                batch.append(row)
+                if len(batch) == chunk:
+                    self.conn.executemany('INSERT OR IGNORE INTO names '
+                                          'VALUES (?, ?, ?, ?)', batch)
+                    nrows += len(batch)
+                    batch = list()
+            self.conn.executemany('INSERT OR IGNORE INTO names '
+                                  'VALUES (?, ?, ?, ?)', batch)
+            nrows += len(batch)
+            self.conn.execute('INSERT OR REPLACE INTO sources '
+                              'VALUES (?, ?, ?)', (name, mtime, nrows))
+
+        return nrows
+
+    def lookup(self, ids, kind='protein'):
+        '''
+        Get the names of a batch of ids
+
+        Args:
+            ids (iterable): PhylomeDB ids (eg. Phy000CX7L_YEAST)
+            kind (str): gene or protein
+
+        Returns:
+            dict: id to its names joined with ';', the ids without names are
+            not in it
+        '''
+
+        ids = list(set(ids))
+        out = dict()
+        for start in range(0, len(ids), BATCH):
+            batch = ids[start:start + BATCH]
+            query = ('SELECT DISTINCT id, name FROM names WHERE kind = ? '
+                     'AND id IN '
+                     '(%s) ORDER BY id, name' % ','.join('?' * len(batch)))
+            for seqid, name in self.conn.execute(query, [kind] + batch):
+                if seqid in out:
+                    out[seqid] += ';' + name
+                else:
+                    out[seqid] = name
+
+        return out
+
+    def annotate(self, df, columns=ID_COLUMNS, kinds=('gene', 'protein')):
+        '''
+        Add a <column>_<kind> column with the names of each id column in df
+        '''
+
+        for col in [col for col in columns if col in df.columns]:
+            ids = df[col][df[col] != ''].unique()
+            for kind in kinds:
+                names = self.lookup(ids, kind)
+                df['%s_%s' % (col, kind)] = df[col].map(names)
+
+        return df
+
+
+def annotate_file(store, ifile, ofile, chunksize=100000):
+    '''
+    Annotate an output csv reading and writing it by chunks, the columns are
+    read as text so they are written unchanged. The parquet outputs are read
+    by batches of rows and written as parquet
+
+    Returns:
+        int: rows written
+    '''
+
+    if ifile.endswith('.parquet'):
+        return annotate_parquet(store, ifile, ofile, chunksize)
+
+    nrows = 0
+    chunks = pd.read_csv(ifile, chunksize=chunksize, dtype=str,
+                         keep_default_na=False)
+    for k, df in enumerate(chunks):
+        store.annotate(df).to_csv(ofile, index=False, header=k == 0,
+                                  mode='w' if k == 0 else 'a')
+        nrows += len(df)
+
+    return nrows
+
+
+def annotate_parquet(store, ifile, ofile, chunksize=100000):
+    '''
+    Annotate a parquet output by batches of rows, the ids are read as
+    strings (not categories) to be looked up
+
+    Raises:
+        ValueError: pyarrow is not installed
+
+    Returns:
+        int: rows written
+    '''
+
+    check_format('parquet')
+    stream = table_stream(ofile, 'parquet')
+    for batch in pq.ParquetFile(ifile).iter_batches(batch_size=chunksize):
+        df = batch.to_pandas()
+        for col in [col for col in ID_COLUMNS if col in df.columns]:
+            df[col] = df[col].astype(object).fillna('')
+        stream(store.annotate(df))
+    stream.close()
+
+    return stream.rows
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-d', '--db', dest='db',
+                      help='Names database (default: names.sqlite)',
+                      metavar='<path/to/names.sqlite>',
+                      default='names.sqlite')
+    parser.add_option('-i', '--input', dest='idir',
+                      help='Folder with the downloaded names files to add',
+                      metavar='<path/to/folder>')
+    parser.add_option('-a', '--annotate', dest='annotate',
+                      help='Comma separated outputs to annotate, the seed, '
+                      'from and to columns are looked up',
+                      metavar='<file.csv|parquet,...>')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Folder of the annotated outputs (<file>_names.csv'
+                      ' or .parquet, default: the input one)',
+                      metavar='<path/to/folder>')
+    (options, args) = parser.parse_args()
+
+    if not options.idir and not options.annotate:
+        parser.error('Nothing to do, give -i and/or -a')
+
+    store = name_store(options.db)
+
+    if options.idir:
+        files = sorted(glob('%s/*_all_gene_names.txt.gz' % options.idir) +
+                       glob('%s/*_all_protein_names.txt.gz' % options.idir))
+        for file in files:
+            nrows = store.add_file(file)
+            if nrows is None:
+                print('Up to date: ', file)
+            else:
+                print('Added: ', file, nrows)
+
+    if options.annotate:
+        for ifile in options.annotate.split(','):
+            odir = options.odir or os.path.dirname(ifile) or '.'
+            base, ext = os.path.splitext(os.path.basename(ifile))
+            ofile = '%s/%s_names%s' % (
+                odir, base, '.parquet' if ext == '.parquet' else '.csv')
+            print('Annotating: ', ifile)
+            annotate_file(store, ifile, ofile)
+
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
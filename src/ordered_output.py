@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+ordered_output.py -- Deterministic output of the tree worker processes
+
+The workers finish in any order, so their results are put in a manager
+dictionary keyed by the input index of the tree (and the part, for the
+blocks of a split tree) and the main process reassembles them in input order
+as the tasks finish: the results of the trees after a missing one are kept
+in a reorder buffer and written as soon as it arrives. When the buffer is
+full the scheduler only starts the tasks of the first missing tree (reading
+the next tasks until it finds them, when they are sorted by size), so the
+buffer holds at most its limit plus the results of the tasks already
+running when it filled.
+
+The outputs are written to <file>.part and renamed when they are complete,
+with their sha256 in <file>.sha256 (sha256sum format), so the next stages can
+skip the inputs that did not change.
+
+The tables can be written as csv or as Apache Parquet (with pyarrow), a
+compressed columnar format with dictionary encoded strings, single or double
+precision floats and the range of each column per row group, so the readers
+only load the columns they use.
+'''
+
+# Import libraries ----
+import os
+import pandas as pd
+
+from artifact_store import file_hash
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Definitions ----
+# Rows held in the reorder buffer before the scheduler is held back
+BUFFER_ROWS = 200000
+
+# Tables formats and their extensions
+FORMATS = {'csv': '.csv', 'parquet': '.parquet'}
+
+# Rows per row group of the parquet files
+GROUP_ROWS = 100000
+
+
+def write_hash(path):
+    '''
+    Write the sha256 of a file to <path>.sha256
+
+    Returns:
+        str: the hash
+    '''
+
+    sha = file_hash(path)
+    with open(path + '.sha256', 'w') as ohandle:
+        ohandle.write('%s  %s\n' % (sha, os.path.basename(path)))
+
+    return sha
+
+
+def read_hash(path):
+    '''
+    Read the sha256 of a file from its sidecar, None if there is none
+    '''
+
+    try:
+        with open(path + '.sha256') as ihandle:
+            return ihandle.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def finish_file(tmp, path):
+    '''
+    Give its name to a complete output and write its hash
+    '''
+
+    os.replace(tmp, path)
+
+    return write_hash(path)
+
+
+class csv_stream(object):
+    '''
+    csv output written by chunks of rows (dictionaries or a DataFrame) in
+    order
+
+    Args:
+        path (str): output csv
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = path + '.part'
+        self.rows = 0
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def __call__(self, rows):
+        if len(rows) == 0:
+            return
+        pd.DataFrame(rows).to_csv(self.tmp, index=False,
+                                  header=self.rows == 0,
+                                  mode='w' if self.rows == 0 else 'a')
+        self.rows += len(rows)
+
+    def close(self):
+        if self.rows == 0:
+            pd.DataFrame(list()).to_csv(self.tmp, index=False)
+
+        return finish_file(self.tmp, self.path)
+
+
+class parquet_stream(object):
+    '''
+    Parquet output written by row groups in order, from chunks of rows
+    (dictionaries or a DataFrame)
+
+    The schema is taken from the first row group: the strings are dictionary
+    encoded and the float32 columns are stored in single precision. The
+    columns are zstd compressed and have statistics per row group.
+
+    Args:
+        path (str): output parquet file
+        float32 (iterable): float columns stored in single precision
+        group_rows (int): rows per row group
+    '''
+
+    def __init__(self, path, float32=(), group_rows=GROUP_ROWS):
+        if pa is None:
+            raise ValueError('The parquet format needs the pyarrow module')
+        self.path = path
+        self.tmp = path + '.part'
+        self.float32 = set(float32)
+        self.group_rows = group_rows
+        self.pending = list()
+        self.buffered = 0
+        self.rows = 0
+        self.schema = None
+        self.writer = None
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+    def __call__(self, rows):
+        if len(rows) == 0:
+            return
+        self.pending.append(pd.DataFrame(rows))
+        self.buffered += len(rows)
+        if self.buffered >= self.group_rows:
+            self.write()
+
+    def table_schema(self, schema):
+        fields = list()
+        for field in schema:
+            ftype = field.type
+            if pa.types.is_floating(ftype) and field.name in self.float32:
+                ftype = pa.float32()
+            elif pa.types.is_string(ftype) or pa.types.is_large_string(ftype):
+                ftype = pa.dictionary(pa.int32(), pa.string())
+            fields.append(pa.field(field.name, ftype))
+
+        return pa.schema(fields)
+
+    def write(self):
+        table = pa.Table.from_pandas(pd.concat(self.pending),
+                                     preserve_index=False)
+        if self.writer is None:
+            self.schema = self.table_schema(table.schema)
+            self.writer = pq.ParquetWriter(self.tmp, self.schema,
+                                           compression='zstd')
+        self.writer.write_table(table.cast(self.schema),
+                                row_group_size=self.group_rows)
+        self.rows += self.buffered
+        self.pending = list()
+        self.buffered = 0
+
+    def close(self):
+        if self.pending:
+            self.write()
+        if self.writer is None:
+            pq.write_table(pa.table({}), self.tmp)
+        else:
+            self.writer.close()
+
+        return finish_file(self.tmp, self.path)
+
+
+def check_format(fmt):
+    '''
+    Check a tables format can be written
+
+    Raises:
+        ValueError: unknown format or parquet without pyarrow
+    '''
+
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s' % fmt)
+    if fmt == 'parquet' and pa is None:
+        raise ValueError('The parquet format needs the pyarrow module')
+
+
+def table_stream(path, fmt='csv', float32=()):
+    '''
+    Output table writer of a format, the float32 columns are only used by
+    the parquet files
+    '''
+
+    if fmt == 'parquet':
+        return parquet_stream(path, float32)
+
+    return csv_stream(path)
+
+
+def read_table(path, columns=None):
+    '''
+    Read some columns of a csv or parquet table, the parquet files are
+    memory mapped and the strings read as categories
+
+    Returns:
+        DataFrame: the table, empty for the outputs without rows
+    '''
+
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+
+    try:
+        return pd.read_csv(path, usecols=columns)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+
+def table_columns(path):
+    '''
+    Column names of a csv or parquet table
+    '''
+
+    if path.endswith('.parquet'):
+        return pq.read_schema(path).names
+
+    try:
+        return list(pd.read_csv(path, nrows=0).columns)
+    except pd.errors.EmptyDataError:
+        return list()
+
+
+class ordered_results(object):
+    '''
+    Reorder buffer of the results of the workers
+
+    The workers call put with the outputs of a tree, a dictionary of stream
+    name to rows, and the main process calls collect when a task finishes (or
+    is killed) with the keys it had to produce. The complete trees are passed
+    to the streams writers in input order.
+
+    Args:
+        manager (Manager): multiprocessing manager
+        indexes (iterable): input indexes of the trees to be run, the ones
+        of a stream of trees are given with expect as they are read
+        writers (dict): stream name to a function called with its rows
+        limit (int): buffered rows over which hold is True
+    '''
+
+    def __init__(self, manager, indexes, writers, limit=BUFFER_ROWS):
+        self.results = manager.dict()
+        self.order = sorted(indexes)
+        self.writers = writers
+        self.limit = limit
+        self.position = 0
+        self.parts = dict()
+        self.buffer = dict()
+        self.buffered = 0
+
+    def expect(self, index):
+        '''
+        Add a tree read after the buffer was created, the trees have to be
+        read in input order (the indexes already given are ignored)
+        '''
+
+        if not self.order or index > self.order[-1]:
+            self.order.append(index)
+
+    def put(self, index, part, outputs):
+        '''
+        Send the outputs of a tree part, from a worker
+        '''
+
+        self.results[(index, part)] = outputs
+
+    def sent(self, index, part=0):
+        '''
+        Whether a worker already sent the outputs of a tree part
+        '''
+
+        return (index, part) in self.results
+
+    def set_parts(self, index, parts):
+        '''
+        Set the number of parts of a tree (1 by default)
+        '''
+
+        self.parts[index] = parts
+        self.flush()
+
+    def collect(self, index, part=0, outputs=None):
+        '''
+        Move the outputs of a finished tree part to the buffer, they are read
+        from the workers results if they are not given
+        '''
+
+        if outputs is None:
+            outputs = self.results.pop((index, part), dict())
+        store = self.buffer.setdefault(index, dict())
+        store[part] = outputs
+        self.buffered += sum(len(rows) for rows in outputs.values())
+        self.flush()
+
+    def flush(self):
+        '''
+        Write the complete trees up to the first missing one
+        '''
+
+        while self.position < len(self.order):
+            index = self.order[self.position]
+            parts = self.parts.get(index, 1)
+            if len(self.buffer.get(index, ())) < parts:
+                break
+            store = self.buffer.pop(index, dict())
+            for part in sorted(store):
+                for stream, rows in store[part].items():
+                    self.writers[stream](rows)
+                    self.buffered -= len(rows)
+            self.parts.pop(index, None)
+            self.position += 1
+
+    def hold(self, item):
+        '''
+        Whether a task has to wait for the buffer to be written, the tasks of
+        the first missing tree are never held
+        '''
+
+        return (bool(item.indexes) and self.buffered > self.limit and
+                self.position < len(self.order) and
+                min(item.indexes) > self.order[self.position])
+
+    def close(self):
+        '''
+        Write what is left, the trees that did not finish are skipped
+        '''
+
+        for index in self.order[self.position:]:
+            self.parts[index] = len(self.buffer.get(index, ()))
+        self.flush()
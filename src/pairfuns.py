@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+pairfuns.py -- Array based sequence pair distances and events
+
+A rooted tree annotated with its evolutionary events is flattened in numpy
+arrays (branch lengths, parents, cumulative speciation and duplication counts
+and an Euler tour with a sparse table for the lowest common ancestor queries).
+With them the distance, the events and the MRCA type of any set of leaf pairs
+are computed at once, without walking the ete3 tree for each pair. The
+distances add the branch lengths one by one from each leaf up to the MRCA, in
+the order of ete3 get_distance, so they are the same to the last bit. The
+arrays can be placed in shared memory to be read by several worker processes.
+
+Requirements: numpy
+'''
+
+# Import libraries ----
+from multiprocessing import shared_memory
+import numpy as np
+
+
+# Definitions ----
+# Maximum number of sequence pairs in a row block
+BLOCK_PAIRS = 250000
+
+
+def lca_tables(parent, level):
+    '''
+    Euler tour first visits and sparse table of a tree in preorder
+
+    Args:
+        parent (array): parent index of each node, -1 for the root, the nodes
+        are in preorder
+        level (array): nodes levels
+
+    Returns:
+        tuple: (first, sparse) arrays, see lca
+    '''
+
+    # Euler tour, the node is visited again after each of its children
+    euler = list()
+    first = np.zeros(len(parent), dtype=np.int32)
+    stack = list()
+    for i, par in enumerate(parent.tolist()):
+        while stack and stack[-1] != par:
+            stack.pop()
+            euler.append(stack[-1])
+        first[i] = len(euler)
+        euler.append(i)
+        stack.append(i)
+    while len(stack) > 1:
+        stack.pop()
+        euler.append(stack[-1])
+    euler = np.array(euler, dtype=np.int32)
+
+    # Sparse table with the shallowest node of each 2^k window of the tour
+    table = [euler]
+    span = 1
+    while 2 * span <= len(euler):
+        prev = table[-1]
+        left = prev[:len(prev) - span]
+        right = prev[span:]
+        table.append(np.where(level[left] <= level[right], left, right))
+        span *= 2
+    sparse = np.zeros((len(table), len(euler)), dtype=np.int32)
+    for k, row in enumerate(table):
+        sparse[k, :len(row)] = row
+
+    return first, sparse
+
+
+def tree_arrays(tree, leaf_order):
+    '''
+    Flatten a rooted tree with evolutionary events into arrays
+
+    Args:
+        tree (PhyloTree): rooted tree after get_descendant_evol_events
+        leaf_order (list): leaves names, it sets the leaves indexes
+
+    Returns:
+        dict: numpy arrays, leaf is the node index of each leaf in leaf_order
+    '''
+
+    nodes = list(tree.traverse('preorder'))
+    index = {id(node): i for i, node in enumerate(nodes)}
+    nno = len(nodes)
+
+    parent = np.full(nno, -1, dtype=np.int32)
+    dist = np.zeros(nno, dtype=np.float64)
+    level = np.zeros(nno, dtype=np.int32)
+    is_dup = np.zeros(nno, dtype=np.int8)
+    cum_s = np.zeros(nno, dtype=np.int32)
+    cum_d = np.zeros(nno, dtype=np.int32)
+
+    for i, node in enumerate(nodes):
+        is_s = 0
+        if not node.is_leaf():
+            is_dup[i] = getattr(node, 'evoltype', 'S') == 'D'
+            is_s = 1 - is_dup[i]
+        if node.up is not None:
+            par = index[id(node.up)]
+            parent[i] = par
+            dist[i] = node.dist
+            level[i] = level[par] + 1
+            cum_s[i] = cum_s[par]
+            cum_d[i] = cum_d[par]
+        cum_s[i] += is_s
+        cum_d[i] += is_dup[i]
+
+    first, sparse = lca_tables(parent, level)
+
+    leaves = {node.name: index[id(node)] for node in nodes if node.is_leaf()}
+    leaf = np.array([leaves[name] for name in leaf_order], dtype=np.int32)
+
+    return {'parent': parent, 'dist': dist, 'level': level,
+            'is_dup': is_dup, 'cum_s': cum_s, 'cum_d': cum_d,
+            'first': first, 'sparse': sparse, 'leaf': leaf}
+
+
+def lca(arrays, nodes_a, nodes_b):
+    '''
+    Lowest common ancestors of pairs of nodes
+
+    Args:
+        arrays (dict): tree arrays, see tree_arrays
+        nodes_a (array): nodes indexes
+        nodes_b (array): nodes indexes
+
+    Returns:
+        array: the common ancestor node indexes
+    '''
+
+    first = arrays['first']
+    lo = np.minimum(first[nodes_a], first[nodes_b])
+    hi = np.maximum(first[nodes_a], first[nodes_b])
+    k = np.floor(np.log2(hi - lo + 1)).astype(np.int32)
+    cand_a = arrays['sparse'][k, lo]
+    cand_b = arrays['sparse'][k, hi - (1 << k) + 1]
+    level = arrays['level']
+
+    return np.where(level[cand_a] <= level[cand_b], cand_a, cand_b)
+
+
+def path_length(arrays, nodes, ancestors, start):
+    '''
+    Add the branch lengths from some nodes up to their ancestors, one by one
+    from the node upwards as ete3 get_distance does
+
+    Args:
+        arrays (dict): tree arrays, see tree_arrays
+        nodes (array): nodes indexes
+        ancestors (array): an ancestor (or the node itself) of each node
+        start (array): values the branch lengths are added to
+
+    Returns:
+        array: start plus the path lengths
+    '''
+
+    parent = arrays['parent']
+    dist = arrays['dist']
+    total = np.array(start, dtype=np.float64)
+    current = np.array(nodes, dtype=np.int64)
+    steps = arrays['level'][current] - arrays['level'][ancestors]
+    active = np.flatnonzero(steps > 0)
+    step = 0
+    while len(active):
+        total[active] += dist[current[active]]
+        current[active] = parent[current[active]]
+        step += 1
+        active = active[steps[active] > step]
+
+    return total
+
+
+def pair_values(arrays, leaves_a, leaves_b):
+    '''
+    Distances and events between pairs of leaves
+
+    The events are the speciation and duplication nodes in the path between
+    both leaves counting their MRCA once, as get_events does.
+
+    Args:
+        arrays (dict): tree arrays, see tree_arrays
+        leaves_a (array): leaves indexes (in the leaf_order)
+        leaves_b (array): leaves indexes (in the leaf_order)
+
+    Returns:
+        dict: dist, sp, dupl and is_dup (of the MRCA) arrays
+    '''
+
+    node_a = arrays['leaf'][leaves_a]
+    node_b = arrays['leaf'][leaves_b]
+    anc = lca(arrays, node_a, node_b)
+
+    # As get_distance(a, b): from b up to the MRCA and then from a
+    dist = path_length(arrays, node_b, anc, np.zeros(len(anc)))
+    dist = path_length(arrays, node_a, anc, dist)
+    cum_s = arrays['cum_s']
+    cum_d = arrays['cum_d']
+    is_dup = arrays['is_dup'][anc]
+
+    return {'dist': dist,
+            'sp': cum_s[node_a] + cum_s[node_b] - 2 * cum_s[anc] + 1 - is_dup,
+            'dupl': cum_d[node_a] + cum_d[node_b] - 2 * cum_d[anc] + is_dup,
+            'is_dup': is_dup}
+
+
+def seed_pairs(leaf_order, seed):
+    '''
+    Pairs between the seed and the rest of the leaves
+
+    Args:
+        leaf_order (list): leaves names
+        seed (str): seed sequence name
+
+    Returns:
+        tuple: from and to leaves indexes arrays, from < to
+    '''
+
+    if seed not in leaf_order:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    seed_idx = leaf_order.index(seed)
+    others = np.delete(np.arange(len(leaf_order)), seed_idx)
+
+    return np.minimum(others, seed_idx), np.maximum(others, seed_idx)
+
+
+def species_pairs(species, allowed):
+    '''
+    Pairs between the leaves of the allowed species pairs
+
+    Args:
+        species (list): species of each leaf
+        allowed (list): list of (species, species) tuples, unordered
+
+    Returns:
+        tuple: from and to leaves indexes arrays, from < to, sorted
+    '''
+
+    species = np.array(species)
+    wanted = set(tuple(sorted(pair)) for pair in allowed)
+    from_idx = [np.zeros(0, dtype=np.int64)]
+    to_idx = [np.zeros(0, dtype=np.int64)]
+    for sp_a, sp_b in wanted:
+        idx_a = np.flatnonzero(species == sp_a)
+        idx_b = np.flatnonzero(species == sp_b)
+        if sp_a == sp_b:
+            first, second = np.triu_indices(len(idx_a), 1)
+            from_idx.append(idx_a[first])
+            to_idx.append(idx_a[second])
+        else:
+            grid_a, grid_b = np.meshgrid(idx_a, idx_b, indexing='ij')
+            from_idx.append(np.minimum(grid_a, grid_b).ravel())
+            to_idx.append(np.maximum(grid_a, grid_b).ravel())
+    from_idx = np.concatenate(from_idx)
+    to_idx = np.concatenate(to_idx)
+    order = np.lexsort((to_idx, from_idx))
+
+    return from_idx[order], to_idx[order]
+
+
+def one_to_one_pairs(arrays, species):
+    '''
+    One-to-one ortholog pairs
+
+    Two leaves are one-to-one orthologs when their MRCA is a speciation node
+    and they are the only leaves of their species under it. The leaves
+    species are gathered from the tips to the root, so only the orthologs
+    are visited.
+
+    Args:
+        arrays (dict): tree arrays, see tree_arrays
+        species (list): species of each leaf (in the leaf_order)
+
+    Returns:
+        tuple: from and to leaves indexes arrays, from < to, sorted
+    '''
+
+    parent = arrays['parent']
+    is_dup = arrays['is_dup']
+    children = [list() for node in parent]
+    for node, par in enumerate(parent.tolist()):
+        if par >= 0:
+            children[par].append(node)
+
+    # Species under each node, to its leaf index or -1 if it is repeated
+    content = [None] * len(parent)
+    for leaf_idx, node in enumerate(arrays['leaf'].tolist()):
+        content[node] = {species[leaf_idx]: leaf_idx}
+
+    pairs = list()
+    for node in range(len(parent) - 1, -1, -1):
+        if not children[node]:
+            continue
+        kids = [content[kid] for kid in children[node]]
+        if not is_dup[node]:
+            single = list()
+            for k, kid in enumerate(kids):
+                others = kids[:k] + kids[k + 1:]
+                single.append([leaf_idx for sp, leaf_idx in kid.items()
+                               if leaf_idx >= 0 and
+                               not any(sp in other for other in others)])
+            for k, leaves_a in enumerate(single):
+                for leaves_b in single[k + 1:]:
+                    pairs.extend((a, b) for a in leaves_a for b in leaves_b)
+        kids.sort(key=len, reverse=True)
+        merged = kids[0]
+        for kid in kids[1:]:
+            for sp, leaf_idx in kid.items():
+                merged[sp] = -1 if sp in merged else leaf_idx
+        content[node] = merged
+        for kid in children[node]:
+            content[kid] = None
+
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    from_idx = pairs.min(axis=1)
+    to_idx = pairs.max(axis=1)
+    order = np.lexsort((to_idx, from_idx))
+
+    return from_idx[order], to_idx[order]
+
+
+def row_blocks(leafno, nblocks):
+    '''
+    Split the rows of the upper triangle of the pairs matrix in blocks with a
+    similar number of pairs
+
+    Args:
+        leafno (int): number of leaves
+        nblocks (int): minimum number of blocks, more are made to keep them
+        under BLOCK_PAIRS pairs
+
+    Returns:
+        list: list of (first row, last row + 1) tuples
+    '''
+
+    pairs = np.cumsum(np.arange(leafno - 1, -1, -1))
+    total = pairs[-1] if leafno else 0
+    nblocks = max(nblocks, -(-int(total) // BLOCK_PAIRS))
+    bounds = [0]
+    for k in range(1, nblocks):
+        row = int(np.searchsorted(pairs, total * k / nblocks)) + 1
+        if bounds[-1] < row < leafno:
+            bounds.append(row)
+    bounds.append(leafno)
+
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+class shared_arrays(object):
+    '''
+    Numpy arrays stored in a single shared memory block
+
+    The creator process builds it with the arrays and the workers attach to it
+    with its name and layout. The object has to be kept while its arrays are
+    used and the creator has to unlink it when it is no longer needed.
+    '''
+
+    def __init__(self, arrays=None, name=None, layout=None):
+        if arrays is not None:
+            layout = list()
+            offset = 0
+            for key, arr in arrays.items():
+                layout.append((key, arr.dtype.str, arr.shape, offset))
+                offset += (arr.nbytes + 7) // 8 * 8
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=max(offset, 8))
+            self.layout = layout
+            for key, dtype, shape, offset in layout:
+                self.view(key, dtype, shape, offset)[...] = arrays[key]
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.layout = layout
+        self.name = self.shm.name
+
+    def view(self, key, dtype, shape, offset):
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                          offset=offset)
+
+    def arrays(self):
+        '''
+        Get the arrays as views of the shared memory
+        '''
+
+        return {key: self.view(key, dtype, shape, offset)
+                for key, dtype, shape, offset in self.layout}
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
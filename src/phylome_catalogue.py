@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+phylome_catalogue.py -- Catalogue of the phylomes information
+
+The *_phylome_info.txt.gz files downloaded by get_trees.py ("Key: value"
+lines and the proteomes table) are parsed into a SQLite catalogue with a row
+per phylome (name, seed species, taxa id and proteome, creation date...) and
+a row per phylome proteome (species code, version, taxa id, date, longest
+isoforms, source and species name). Only the new or changed files are parsed
+when it is run again.
+
+The compute scripts check their normalising groups table against the
+catalogue (--catalogue) before reading the trees, so a species missing from
+the table is reported at startup instead of failing in annotate_tree, and
+seq2seq_cladenorm.py interns the catalogue species codes in its species
+registry (treefuns.species_registry.from_phylome).
+
+    phylome_catalogue.py -i ../01_get_trees/outputs -d catalogue.sqlite
+    phylome_catalogue.py -d catalogue.sqlite -t 0005 -o data
+
+Requirements: pandas
+'''
+
+# Import libraries ----
+import gzip
+import os
+import sqlite3
+from glob import glob
+from optparse import OptionParser
+import pandas as pd
+
+
+# Definitions ----
+# phylome_info keys to catalogue columns and types
+INFO_KEYS = {'Phylome Id': ('id', int),
+             'Phylome Name': ('name', str),
+             'Seed Species': ('seed_species', str),
+             'Seed Taxa Id': ('seed_taxid', int),
+             'Seed Proteome': ('seed_proteome', str),
+             'Creation date': ('created', str),
+             'Comments': ('comments', str),
+             'Longest isoforms': ('longest_isoforms', int),
+             'Seed proteins with aligments': ('seeds_aligned', int),
+             'Seed proteins with trees': ('seeds_with_trees', int)}
+PROTEOME_COLUMNS = ['taxid', 'code', 'version', 'date', 'longest', 'source',
+                    'species_name']
+# Columns of the normalising groups tables
+TABLE_COLUMNS = {'code': 'Proteome', 'taxid': 'TaxaID', 'date': 'Date',
+                 'longest': 'Longest', 'source': 'Source',
+                 'species_name': 'Species Name'}
+
+
+class catalogue_error(Exception):
+    '''
+    Wrong phylome_info file or input not matching the catalogue
+    '''
+    pass
+
+
+def parse_info(lines):
+    '''
+    Parse a phylome_info file
+
+    Args:
+        lines (iterable): file lines
+
+    Returns:
+        dict: phylome fields (INFO_KEYS columns) and proteomes, a list of
+        dictionaries with the PROTEOME_COLUMNS
+
+    Raises:
+        catalogue_error: the phylome id or the proteomes table are missing
+    '''
+
+    info = {'proteomes': list()}
+    header = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip() or line.startswith('-----'):
+            continue
+        fields = [field.strip() for field in line.split('\t')]
+
+        if header is not None:
+            if len(fields) < len(header):
+                raise catalogue_error('Wrong proteome row: %s' % line)
+            code, version = (fields[1].split('.', 1) + [''])[:2]
+            info['proteomes'].append({
+                'taxid': int(fields[0]), 'code': code,
+                'version': int(version) if version.isdigit() else None,
+                'date': fields[2], 'longest': int(fields[3]),
+                'source': fields[4], 'species_name': fields[5]})
+        elif fields[0] == 'TaxaID':
+            header = fields
+        elif fields[0].endswith(':'):
+            key = fields[0][:-1].strip()
+            if key in INFO_KEYS and len(fields) > 1:
+                col, kind = INFO_KEYS[key]
+                info[col] = kind(fields[1]) if fields[1] else None
+
+    if 'id' not in info or not info['proteomes']:
+        raise catalogue_error('No phylome id or proteomes table')
+
+    return info
+
+
+class phylome_catalogue(object):
+    '''
+    SQLite catalogue of the phylomes and their proteomes
+
+    Args:
+        path (str): database, it is created if it does not exist
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS phylomes (
+                id INTEGER PRIMARY KEY, name TEXT, seed_species TEXT,
+                seed_taxid INTEGER, seed_proteome TEXT, created TEXT,
+                comments TEXT, longest_isoforms INTEGER,
+                seeds_aligned INTEGER, seeds_with_trees INTEGER);
+            CREATE TABLE IF NOT EXISTS proteomes (
+                phylome INTEGER NOT NULL, code TEXT NOT NULL,
+                version INTEGER, taxid INTEGER, date TEXT, longest INTEGER,
+                source TEXT, species_name TEXT,
+                PRIMARY KEY (phylome, code)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS proteomes_code ON proteomes (code);
+            CREATE TABLE IF NOT EXISTS sources (
+                file TEXT PRIMARY KEY, mtime REAL);
+            ''')
+
+    def close(self):
+        self.conn.close()
+
+    def add_file(self, file):
+        '''
+        Parse and add a phylome_info file, it is skipped if it was added with
+        the same mtime
+
+        Returns:
+            int: phylome id, None if it was up to date
+        '''
+
+        name = os.path.basename(file)
+        mtime = os.path.getmtime(file)
+        row = self.conn.execute('SELECT mtime FROM sources WHERE file = ?',
+                                (name,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return None
+
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt') as ihandle:
+            info = parse_info(ihandle)
+
+        cols = [col for col, kind in INFO_KEYS.values()]
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO phylomes (%s) VALUES '
+                              '(%s)' % (','.join(cols),
+                                        ','.join('?' * len(cols))),
+                              [info.get(col) for col in cols])
+            self.conn.execute('DELETE FROM proteomes WHERE phylome = ?',
+                              (info['id'],))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO proteomes (phylome, %s) VALUES '
+                '(?, %s)' % (','.join(PROTEOME_COLUMNS),
+                             ','.join('?' * len(PROTEOME_COLUMNS))),
+                [[info['id']] + [prot[col] for col in PROTEOME_COLUMNS]
+                 for prot in info['proteomes']])
+            self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                              (name, mtime))
+
+        return info['id']
+
+    def phylome(self, phylome_id):
+        '''
+        Get the phylome fields, None if it is not in the catalogue
+        '''
+
+        cursor = self.conn.execute('SELECT * FROM phylomes WHERE id = ?',
+                                   (int(phylome_id),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return dict(zip([col[0] for col in cursor.description], row))
+
+    def proteomes(self, phylome_id):
+        '''
+        Get the proteomes of a phylome as a normalising groups table (without
+        the group column)
+        '''
+
+        df = pd.read_sql_query('SELECT %s FROM proteomes WHERE phylome = ? '
+                               'ORDER BY taxid' %
+                               ','.join(TABLE_COLUMNS), self.conn,
+                               params=(int(phylome_id),))
+
+        return df.rename(columns=TABLE_COLUMNS)
+
+    def species(self, phylome_id):
+        '''
+        Get the species codes of a phylome
+        '''
+
+        return [row[0] for row in
+                self.conn.execute('SELECT code FROM proteomes WHERE '
+                                  'phylome = ? ORDER BY code',
+                                  (int(phylome_id),))]
+
+    def check_groups(self, phylome_id, gnmdf, spcol='Proteome',
+                     taxcol='TaxaID'):
+        '''
+        Check a normalising groups table against the catalogue
+
+        Args:
+            phylome_id (str): phylome id
+            gnmdf (DataFrame): normalising groups table
+            spcol (str): species code column
+            taxcol (str): taxa id column, not checked if it is not in gnmdf
+
+        Raises:
+            catalogue_error: the phylome is not in the catalogue, or the
+            table misses species of the phylome, has repeated species or
+            their taxa ids differ
+        '''
+
+        cat = self.proteomes(phylome_id)
+        if cat.empty:
+            raise catalogue_error('Phylome %s is not in the catalogue %s' %
+                                  (phylome_id, self.path))
+
+        errors = list()
+        codes = gnmdf[spcol].astype(str)
+        missing = sorted(set(cat['Proteome']) - set(codes))
+        if missing:
+            errors.append('missing species: %s' % ', '.join(missing))
+        repeated = sorted(set(codes[codes.duplicated()]))
+        if repeated:
+            errors.append('repeated species: %s' % ', '.join(repeated))
+        if taxcol in gnmdf.columns:
+            taxids = dict(zip(cat['Proteome'], cat['TaxaID']))
+            wrong = sorted(code for code, taxid in zip(codes, gnmdf[taxcol])
+                           if code in taxids and taxids[code] != taxid)
+            if wrong:
+                errors.append('taxa ids differ: %s' % ', '.join(wrong))
+
+        if errors:
+            raise catalogue_error('Groups table of phylome %s: %s' %
+                                  (phylome_id, '; '.join(errors)))
+
+        return 0
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-d', '--db', dest='db',
+                      help='Catalogue database (default: catalogue.sqlite)',
+                      metavar='<path/to/catalogue.sqlite>',
+                      default='catalogue.sqlite')
+    parser.add_option('-i', '--input', dest='idir',
+                      help='Folder with the downloaded phylome_info files to '
+                      'add', metavar='<path/to/folder>')
+    parser.add_option('-t', '--table', dest='table',
+                      help='Comma separated phylome ids to write their '
+                      'proteomes table (<id>_proteomes.csv), the template of '
+                      'the normalising groups tables', metavar='<id,id,...>')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Folder of the proteomes tables (default: .)',
+                      metavar='<path/to/folder>', default='.')
+    (options, args) = parser.parse_args()
+
+    if not options.idir and not options.table:
+        parser.error('Nothing to do, give -i and/or -t')
+
+    catalogue = phylome_catalogue(options.db)
+
+    if options.idir:
+        for file in sorted(glob('%s/*_phylome_info.txt.gz' % options.idir)):
+            try:
+                phyid = catalogue.add_file(file)
+            except catalogue_error as e:
+                print('Skipping %s: %s' % (file, e))
+                continue
+            if phyid is None:
+                print('Up to date: ', file)
+            else:
+                print('Added: ', file)
+
+    if options.table:
+        for phyid in options.table.split(','):
+            ofile = '%s/%s_proteomes.csv' % (options.odir, phyid)
+            catalogue.proteomes(phyid).to_csv(ofile, index=False)
+
+    catalogue.close()
+
+
+if __name__ == '__main__':
+    main()
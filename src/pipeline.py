@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+pipeline.py -- Make-like runner of the pipeline stages
+
+The stages of 01_get_trees, 02_seed2sp_dist, 03_event_dist and
+04_gamma_inference (download, splitting, per shard distances, joins and
+gamma statistics) are declared with their inputs and outputs, one instance
+per phylome or shard. An instance is run again when the key of its inputs
+changes: the sha256 of its input files, its arguments, the code of its script
+and of the local modules it imports, and the ROOTED_PHYLOMES entry of its
+phylome. The keys of the last successful runs are kept in
+<root>/.pipeline/state.json, so a change in a normalising groups table only
+runs the shards of its phylome and, if their outputs changed, the joins and
+statistics that read them.
+
+The shards are only known once the trees are split, so the stages are
+planned again from the files on disk after each round, and the instances of
+a round whose inputs are up to date run in parallel with the local scheduler.
+
+Requirements: scheduler.py, artifact_store.py, ordered_output.py
+'''
+
+# Import libraries ----
+import ast
+import fcntl
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from glob import glob
+from multiprocessing import Process
+from optparse import OptionParser
+
+from artifact_store import file_hash
+from ingest import SHARD_SIZE
+from memo_cache import memo_key
+from ordered_output import read_hash, FORMATS
+from rooted_phylomes import ROOTED_PHYLOMES
+from scheduler import scheduler, task
+from utils import create_folder
+
+
+# Definitions ----
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules hashed as data: each stage depends on its phylome entry only
+DATA_MODULES = {'rooted_phylomes'}
+
+
+def code_files(script, srcdir=SRCDIR):
+    '''
+    Get the local modules imported by a script, recursively
+
+    Returns:
+        list: paths of the script and its local modules
+    '''
+
+    seen = set()
+    todo = [script[:-3]]
+    while todo:
+        name = todo.pop()
+        path = os.path.join(srcdir, name + '.py')
+        if name in seen or name in DATA_MODULES or not os.path.isfile(path):
+            continue
+        seen.add(name)
+        with open(path) as ihandle:
+            tree = ast.parse(ihandle.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                todo.append(node.module.split('.')[0])
+
+    return sorted(os.path.join(srcdir, name + '.py') for name in seen)
+
+
+class stage(object):
+    '''
+    Instance of a pipeline stage
+
+    The paths are relative to the pipeline root.
+
+    Args:
+        name (str): unique name, eg. dist/0005_19
+        script (str): script in src
+        args (list): script arguments
+        inputs (list): files read by the stage
+        outputs (list): files written by the stage
+        dynamic (list): glob patterns of outputs not known in advance
+        cwd (str): folder to run the script in (default: the root)
+        params (dict): other values the outputs depend on
+        clean (bool): remove the previous outputs before running, for the
+        scripts that skip the outputs that exist
+    '''
+
+    def __init__(self, name, script, args, inputs=(), outputs=(),
+                 dynamic=(), cwd='.', params=None, clean=True):
+        self.name = name
+        self.script = script
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.dynamic = list(dynamic)
+        self.cwd = cwd
+        self.params = params or dict()
+        self.clean = clean
+
+    def command(self):
+        return [sys.executable, os.path.join(SRCDIR, self.script)] + \
+            self.args
+
+    def produced(self, root):
+        '''
+        Outputs on disk, the declared ones and the dynamic matches
+        '''
+
+        files = list(self.outputs)
+        for pattern in self.dynamic:
+            files.extend(sorted(os.path.relpath(path, root) for path in
+                                glob(os.path.join(root, pattern))))
+
+        return files
+
+
+class stage_process(Process):
+    def __init__(self, item, key, root, log):
+        Process.__init__(self)
+        self.item = item
+        self.key = key
+        self.root = root
+        self.log = log
+
+    def run(self):
+        with open(self.log, 'w') as ohandle:
+            ohandle.write('$ %s\n' % ' '.join(self.item.command()))
+            ohandle.flush()
+            code = subprocess.call(self.item.command(),
+                                   cwd=os.path.join(self.root,
+                                                    self.item.cwd),
+                                   stdout=ohandle, stderr=subprocess.STDOUT)
+        sys.exit(code)
+
+
+class pipeline_state(object):
+    '''
+    Keys of the last successful runs and content hashes of the files
+
+    The hashes are read from the ordered_output.py sidecars when they are
+    newer than the file and otherwise kept with the file size and mtime, so
+    the big inputs are only hashed when they change.
+
+    Args:
+        root (str): pipeline root
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.folder = os.path.join(root, '.pipeline')
+        self.path = os.path.join(self.folder, 'state.json')
+        create_folder(self.folder)
+        create_folder(os.path.join(self.folder, 'logs'))
+        self.stages = dict()
+        self.files = dict()
+        if os.path.isfile(self.path):
+            with open(self.path) as ihandle:
+                state = json.load(ihandle)
+            self.stages = state['stages']
+            self.files = state['files']
+        self.code = dict()
+
+    def write(self):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as ohandle:
+            json.dump({'stages': self.stages, 'files': self.files}, ohandle,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def file_hash(self, path):
+        '''
+        Content hash of a file relative to the root, None if it is missing
+        '''
+
+        full = os.path.join(self.root, path)
+        if not os.path.isfile(full):
+            return None
+        info = os.stat(full)
+        if (os.path.isfile(full + '.sha256') and
+                os.stat(full + '.sha256').st_mtime_ns >= info.st_mtime_ns):
+            sha = read_hash(full)
+            if sha is not None:
+                return sha
+
+        cached = self.files.get(path)
+        if cached is not None and cached[:2] == [info.st_size,
+                                                 info.st_mtime_ns]:
+            return cached[2]
+        sha = file_hash(full)
+        self.files[path] = [info.st_size, info.st_mtime_ns, sha]
+
+        return sha
+
+    def code_hash(self, script):
+        if script not in self.code:
+            self.code[script] = memo_key(*[file_hash(path) for path in
+                                           code_files(script)])
+
+        return self.code[script]
+
+    def key(self, item):
+        '''
+        Key of the inputs of a stage, None if some input is missing
+        '''
+
+        hashes = [self.file_hash(path) for path in item.inputs]
+        if None in hashes:
+            return None
+
+        return memo_key(item.script, self.code_hash(item.script),
+                        json.dumps(item.args),
+                        json.dumps(item.params, sort_keys=True),
+                        *['%s=%s' % x for x in zip(item.inputs, hashes)])
+
+    def done(self, item, key):
+        self.stages[item.name] = {'key': key,
+                                  'outputs': item.produced(self.root),
+                                  'time': time.time()}
+
+    def up_to_date(self, item, key):
+        '''
+        Whether the stage ran with this key and its outputs are still there
+        '''
+
+        entry = self.stages.get(item.name)
+        if entry is None or key is None or entry['key'] != key:
+            return False
+
+        return all(os.path.isfile(os.path.join(self.root, path))
+                   for path in item.outputs + entry['outputs'])
+
+    def remove_outputs(self, item):
+        '''
+        Remove the outputs of a stage before running it again
+        '''
+
+        entry = self.stages.pop(item.name, dict())
+        for path in set(item.produced(self.root) +
+                        entry.get('outputs', list())):
+            for file in [path, path + '.sha256']:
+                full = os.path.join(self.root, file)
+                if os.path.isfile(full):
+                    os.remove(full)
+
+
+def table_format(args):
+    '''
+    Output tables format given in the arguments of a compute script
+    '''
+
+    fmt = 'csv'
+    for i, arg in enumerate(args):
+        if arg in ('-F', '--format') and i + 1 < len(args):
+            fmt = args[i + 1]
+        elif arg.startswith('--format='):
+            fmt = arg.split('=', 1)[1]
+
+    return fmt
+
+
+def write_list(path, lines):
+    '''
+    Write a file with a line per item, it is left untouched if it has them
+    '''
+
+    content = ''.join('%s\n' % line for line in lines)
+    if os.path.isfile(path):
+        with open(path) as ihandle:
+            if ihandle.read() == content:
+                return
+    create_folder(os.path.dirname(path))
+    with open(path, 'w') as ohandle:
+        ohandle.write(content)
+
+
+def phylome_stages(root, phylomes, cpus, dist_args=(), event_args=(),
+                   offline=False, shard_size=SHARD_SIZE, url=None):
+    '''
+    Stages of the pipeline, from the files on disk
+
+    Args:
+        root (str): pipeline root, with the 01 to 04 folders
+        phylomes (list): phylome ids
+        cpus (int): cores given to each distances stage, and downloads at
+        once
+        dist_args (list): other seq2seq_cladenorm.py arguments
+        event_args (list): other clade_sp_dist.py arguments
+        offline (bool): do not download, use the trees files on disk
+        shard_size (int): maximum bytes of trees per shard
+        url (str): base url of the phylomes (default: PhylomeDB ftp)
+
+    Returns:
+        list: stage objects
+    '''
+
+    stages = list()
+    aggregate = '-a' in dist_args
+    dist_fmt = table_format(dist_args)
+    event_fmt = table_format(event_args)
+    dist_ext = '_summary.json' if aggregate else '_dist' + FORMATS[dist_fmt]
+    # The downloads are the requested phylomes, not the whole list
+    plist = '.pipeline/phylome_list.txt'
+    dist_outs = list()
+    event_outs = list()
+    dist_joined = list()
+    event_joined = list()
+    gamma = list()
+
+    if not offline:
+        write_list(os.path.join(root, plist), phylomes)
+        args = ['-f', os.path.join(root, plist), '-w',
+                os.path.join(root, '01_get_trees/outputs'), '-t', str(cpus)]
+        if url:
+            args += ['--url', url]
+        stages.append(stage('get_trees', 'get_trees.py', args,
+                            inputs=[plist],
+                            outputs=['01_get_trees/outputs/%s_best_trees'
+                                     '.txt.gz' % phyid for phyid in phylomes],
+                            clean=False))
+
+    for phyid in phylomes:
+        trees = '01_get_trees/outputs/%s_best_trees.txt.gz' % phyid
+        shards = '01_get_trees/splitted/%s_*.txt' % phyid
+        params = {'root': ROOTED_PHYLOMES.get(int(phyid))}
+        stages.append(stage('split/%s' % phyid, 'split_trees.py',
+                            ['-i', os.path.join(root, trees), '-o',
+                             os.path.join(root, '01_get_trees/splitted'),
+                             '-s', str(shard_size)],
+                            inputs=[trees], dynamic=[shards]))
+
+        dist_groups = '02_seed2sp_dist/data/%s_norm_groups.csv' % phyid
+        event_groups = '03_event_dist/data/%s_norm_groups.csv' % phyid
+        for shard in sorted(glob(os.path.join(root, shards))):
+            shard = os.path.relpath(shard, root)
+            shard_id = os.path.basename(shard).split('.', 1)[0]
+
+            outs = ['02_seed2sp_dist/outputs/%s%s' % (shard_id, dist_ext),
+                    '02_seed2sp_dist/outputs/%s_norm%s' %
+                    (shard_id, FORMATS[dist_fmt])]
+            dist_outs.extend(outs)
+            stages.append(stage('dist/%s' % shard_id, 'seq2seq_cladenorm.py',
+                                ['-f', os.path.join(root, shard), '-o',
+                                 os.path.join(root,
+                                              '02_seed2sp_dist/outputs'),
+                                 '-p', os.path.join(root, dist_groups),
+                                 '-c', str(cpus)] + list(dist_args),
+                                inputs=[shard, dist_groups], outputs=outs,
+                                params=params))
+
+            out = '03_event_dist/outputs/%s_dist%s' % (shard_id,
+                                                       FORMATS[event_fmt])
+            event_outs.append(out)
+            stages.append(stage('events/%s' % shard_id, 'clade_sp_dist.py',
+                                ['-f', os.path.join(root, shard), '-g',
+                                 os.path.join(root, event_groups), '-o',
+                                 os.path.join(root, '03_event_dist/outputs'),
+                                 '-c', str(cpus)] + list(event_args),
+                                inputs=[shard, event_groups], outputs=[out],
+                                params=params))
+
+        if glob(os.path.join(root, shards)):
+            if aggregate:
+                dist_joined.extend(['02_seed2sp_dist/outputs/%s_summary.%s' %
+                                    (phyid, ext) for ext in ['json', 'csv']])
+            else:
+                dist_joined.append('02_seed2sp_dist/outputs/%s_dist%s' %
+                                   (phyid, FORMATS[dist_fmt]))
+            event_joined.append('03_event_dist/outputs/%s_dist%s' %
+                                (phyid, FORMATS[event_fmt]))
+            gamma.extend(['04_gamma_inference/data/%s_gamma.%s' %
+                          (phyid, ext) for ext in ['npz', 'csv']])
+
+    # The joins read the outputs of all the shards of the folder
+    if dist_outs:
+        join = 'merge_summaries.py' if aggregate else 'join_normalise.py'
+        join_args = [] if aggregate else ['-F', dist_fmt]
+        stages.append(stage('join/02_seed2sp_dist', join, join_args,
+                            inputs=dist_outs, outputs=dist_joined,
+                            cwd='02_seed2sp_dist'))
+    if event_outs:
+        stages.append(stage('join/03_event_dist', 'join_normalise.py',
+                            ['-F', event_fmt],
+                            inputs=event_outs, outputs=event_joined,
+                            cwd='03_event_dist'))
+        stages.append(stage('gamma_stats', 'gamma_stats.py',
+                            ['-i', os.path.join(root,
+                                                '03_event_dist/outputs'),
+                             '-o', os.path.join(root,
+                                                '04_gamma_inference/data')],
+                            inputs=event_outs, outputs=gamma, clean=False))
+
+    return stages
+
+
+class pipeline(object):
+    '''
+    Run the out of date stages in rounds until all are up to date or
+    blocked by a failed or missing input
+
+    Args:
+        root (str): pipeline root
+        plan (function): called without arguments, returns the stages
+        jobs (int): stages running at once
+    '''
+
+    def __init__(self, root, plan, jobs=1):
+        self.root = root
+        self.plan = plan
+        self.jobs = jobs
+        self.state = pipeline_state(root)
+        self.failed = set()
+        self.run_stages = list()
+
+    def outdated(self, stages):
+        '''
+        Check the stages and their inputs producers
+
+        Returns:
+            dict: stage name to its key, None for the stages with missing
+            inputs
+            set: names of the stages that are not up to date, or that read
+            the outputs of one that is not
+        '''
+
+        producers = dict()
+        for item in stages:
+            for path in item.produced(self.root):
+                producers[path] = item
+
+        keys = dict()
+        stale = set()
+        for item in stages:
+            keys[item.name] = self.state.key(item)
+            if not self.state.up_to_date(item, keys[item.name]):
+                stale.add(item.name)
+
+        # Spreading to the stages downstream
+        changed = True
+        while changed:
+            changed = False
+            for item in stages:
+                if item.name in stale:
+                    continue
+                if any(path in producers and
+                       producers[path].name in stale
+                       for path in item.inputs):
+                    stale.add(item.name)
+                    changed = True
+
+        return keys, stale, producers
+
+    def ready(self, stages):
+        '''
+        Out of date stages whose inputs are all on disk and up to date
+        '''
+
+        keys, stale, producers = self.outdated(stages)
+        ready = list()
+        for item in stages:
+            # A stage runs once per run, even if it is still out of date
+            if (item.name not in stale or item.name in self.failed or
+                    item.name in self.run_stages):
+                continue
+            if keys[item.name] is None:
+                continue
+            if any(path in producers and producers[path].name in stale
+                   for path in item.inputs):
+                continue
+            ready.append((item, keys[item.name]))
+
+        return ready, stale
+
+    def dry_run(self):
+        stages = self.plan()
+        ready, stale = self.ready(stages)
+        names = set(item.name for item, key in ready)
+        for item in stages:
+            if item.name in names:
+                print('run     %s' % item.name)
+            elif item.name in stale:
+                print('waiting %s' % item.name)
+
+        return 0
+
+    def run(self):
+        '''
+        Returns:
+            int: number of failed stages
+        '''
+
+        with open(os.path.join(self.state.folder, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            while True:
+                ready, stale = self.ready(self.plan())
+                if not ready:
+                    break
+                self.round(ready)
+            self.state.write()
+
+        for name in sorted(stale - self.failed):
+            print('Not run (missing or failed inputs): %s' % name)
+
+        return len(self.failed)
+
+    def round(self, ready):
+        workers = scheduler(self.jobs)
+
+        def done(item):
+            process = item.process
+            missing = [path for path in process.item.outputs
+                       if not os.path.isfile(os.path.join(self.root, path))]
+            if process.exitcode == 0 and not missing:
+                self.state.done(process.item, process.key)
+                print('Done: %s' % process.item.name)
+            else:
+                self.failed.add(process.item.name)
+                print('Failed: %s (see %s)' % (process.item.name,
+                                               process.log))
+            self.state.write()
+
+        def tasks():
+            for item, key in ready:
+                if item.clean:
+                    self.state.remove_outputs(item)
+                log = os.path.join(self.state.folder, 'logs', '%s.log' %
+                                   item.name.replace('/', '_'))
+                print('Running: %s' % item.name)
+                self.run_stages.append(item.name)
+                yield task(stage_process(item, key, self.root, log),
+                           on_done=done)
+
+        workers.run(tasks())
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-r', '--root', dest='root',
+                      help='Pipeline folder (default: the repository)',
+                      metavar='<path/to/folder>',
+                      default=os.path.dirname(SRCDIR))
+    parser.add_option('-p', '--phylomes', dest='phylomes',
+                      help='Comma separated phylome ids (default: the ones '
+                      'in 01_get_trees/data/phylome_list.txt)',
+                      metavar='<0005,0076,...>')
+    parser.add_option('-j', '--jobs', dest='jobs',
+                      help='Stages running at once (default: 1)', type='int',
+                      default=1, metavar='<N>')
+    parser.add_option('-c', '--cpu', dest='cpus',
+                      help='Number of CPUs of each distances stage and '
+                      'downloads at once (default: 4)', type='int',
+                      default=4, metavar='<N>')
+    parser.add_option('-n', '--dry-run', dest='dry_run',
+                      help='Print the stages that would run',
+                      action='store_true')
+    parser.add_option('--offline', dest='offline',
+                      help='Do not download, use the trees files on disk',
+                      action='store_true')
+    parser.add_option('--url', dest='url',
+                      help='Base url of the phylomes (default: PhylomeDB '
+                      'ftp)', metavar='<url>')
+    parser.add_option('-s', '--shard-size', dest='shard_size',
+                      help='Maximum bytes of trees per shard (default: %d)' %
+                      SHARD_SIZE, metavar='<bytes>', type='int',
+                      default=SHARD_SIZE)
+    parser.add_option('--dist-args', dest='dist_args',
+                      help='Other seq2seq_cladenorm.py arguments, eg. '
+                      '"-b 32 -q seed"', default='', metavar='<args>')
+    parser.add_option('--event-args', dest='event_args',
+                      help='Other clade_sp_dist.py arguments', default='',
+                      metavar='<args>')
+    (options, args) = parser.parse_args()
+
+    root = os.path.abspath(options.root)
+    if options.phylomes:
+        phylomes = options.phylomes.split(',')
+    else:
+        with open(os.path.join(root, '01_get_trees/data/'
+                               'phylome_list.txt')) as ihandle:
+            phylomes = [line.strip() for line in ihandle if line.strip()]
+
+    def plan():
+        return phylome_stages(root, phylomes, options.cpus,
+                              shlex.split(options.dist_args),
+                              shlex.split(options.event_args),
+                              options.offline, options.shard_size,
+                              options.url)
+
+    runner = pipeline(root, plan, options.jobs)
+    if options.dry_run:
+        return runner.dry_run()
+
+    failed = runner.run()
+    print('Stages run: %d, failed: %d' % (len(runner.run_stages), failed))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
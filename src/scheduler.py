@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+scheduler.py -- Memory aware scheduling of the tree worker processes
+
+The compute scripts start a process per tree. The scheduler keeps up to cpus
+of them running and, when a memory budget is given, it only starts a tree if
+its estimated memory fits in the budget left by the running ones (measured as
+the proportional set size of the main process, the manager and the workers).
+Trees that do not fit are held back while the following smaller ones run,
+until there is enough headroom for them.
+
+To shorten the tail of a shard the trees can be run largest first (longest
+processing time first) and the trees over a leaf count or running time cap can
+be diverted to a heavy queue file, to be processed apart.
+'''
+
+# Import libraries ----
+import os
+import time
+from collections import deque
+from multiprocessing.connection import wait
+from metrics import rss, children
+
+
+# Definitions ----
+# Memory of a worker before processing the tree and per tree element (leaf or
+# sequence pair dictionary in the manager list) in bytes
+WORKER_BASE = 60 * 2 ** 20
+LEAF_BYTES = 200 * 2 ** 10
+PAIR_BYTES = 1200
+
+
+def tree_leaves(tree_row):
+    '''
+    Cheap prescan of the number of leaves of a tree row
+
+    Args:
+        tree_row (str): best_trees row or newick tree
+
+    Returns:
+        int: number of leaves
+    '''
+
+    return tree_row.rsplit('\t', 1)[-1].count(',') + 1
+
+
+def plan_rows(rows, lpt=False, max_leaves=None, heavy=None):
+    '''
+    Prescan the tree rows to order them and divert the oversized ones
+
+    Without lpt the rows are read as the tasks are started, so the input is
+    never held in memory (see ingest.read_rows).
+
+    Args:
+        rows (iterable): tree rows
+        lpt (bool): sort the rows by decreasing number of leaves
+        max_leaves (int): rows with more leaves are sent to the heavy queue
+        heavy (heavy_queue): queue for the oversized rows
+
+    Returns:
+        list or generator: (input index, leaves, row) tuples to process, a
+        list sorted by leaves with lpt and a generator in input order
+        otherwise
+    '''
+
+    sized = stream_rows(rows, max_leaves, heavy)
+    if lpt:
+        return sorted(sized, key=lambda x: x[1], reverse=True)
+
+    return sized
+
+
+def stream_rows(rows, max_leaves=None, heavy=None):
+    '''
+    Generator of the (input index, leaves, row) tuples of plan_rows
+    '''
+
+    for index, row in enumerate(rows):
+        leaves = tree_leaves(row)
+        if max_leaves is not None and leaves > max_leaves:
+            heavy.add(row)
+        else:
+            yield index, leaves, row
+
+
+class heavy_queue(object):
+    '''
+    File collecting the tree rows over the cost caps, it has the format of the
+    input shards so it can be processed on its own. The file is only created
+    when a row is added.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+        self.rows = 0
+
+    def add(self, row):
+        if self.handle is None:
+            self.handle = open(self.path, 'w')
+        self.handle.write(row if row.endswith('\n') else row + '\n')
+        self.handle.flush()
+        self.rows += 1
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            print('Heavy trees (%d) written to: %s' % (self.rows, self.path))
+
+
+def estimate_memory(leaves, pairs=False):
+    '''
+    Estimate the memory needed to process a tree
+
+    Args:
+        leaves (int): number of leaves of the tree
+        pairs (bool): whether all the sequence pairs are stored
+
+    Returns:
+        int: estimated bytes
+    '''
+
+    mem = WORKER_BASE + leaves * LEAF_BYTES
+    if pairs:
+        mem += leaves * (leaves - 1) // 2 * PAIR_BYTES
+
+    return mem
+
+
+def estimate_batch_memory(leaves, pairs=False):
+    '''
+    Estimate the memory needed to process a batch of trees in one worker
+
+    Args:
+        leaves (list): number of leaves of each tree
+        pairs (bool): whether all the sequence pairs are stored
+
+    Returns:
+        int: estimated bytes
+    '''
+
+    return WORKER_BASE + sum(estimate_memory(tleaves, pairs) - WORKER_BASE
+                             for tleaves in leaves)
+
+
+def estimate_block_memory(pairs):
+    '''
+    Estimate the memory needed to process a block of sequence pairs of a
+    split tree, the tree arrays are shared so they are not counted
+
+    Args:
+        pairs (int): number of sequence pairs of the block
+
+    Returns:
+        int: estimated bytes
+    '''
+
+    return WORKER_BASE + pairs * PAIR_BYTES
+
+
+def pss(pid):
+    '''
+    Get the proportional set size of a process in bytes
+
+    Forked workers share most of their pages with the main process, so the
+    proportional set size is used to not count them several times. The
+    resident set size is used if it is not available.
+    '''
+
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return rss(pid)
+
+
+class task(object):
+    '''
+    Unit of work of the scheduler, a not started process, its estimated
+    memory, the tree row it processes, a function called with the task when
+    it finishes and the input indexes of its trees. Tasks without a row
+    (blocks of a split tree) are not killed by the running time cap.
+    '''
+
+    def __init__(self, process, mem=0, row=None, on_done=None, indexes=()):
+        self.process = process
+        self.mem = mem
+        self.row = row
+        self.on_done = on_done
+        self.indexes = indexes
+        self.skipped = 0
+        self.started = None
+
+
+class scheduler(object):
+    '''
+    Run the tasks processes with at most cpus at once under a memory budget
+
+    Args:
+        cpus (int): maximum number of running processes
+        mem_budget (int): memory budget in bytes, None for no limit
+        lookahead (int): number of tasks read ahead to find one that fits
+        max_skips (int): times a task can be overtaken before the scheduler
+        waits for headroom to start it
+        poll (float): seconds between memory checks while waiting
+        max_time (float): seconds after which a task is killed
+        on_timeout (function): called with the killed task
+        hold (function): called with a task, True to not start it yet (see
+        ordered_output.py); when all the read tasks are held the next ones
+        are read, and they are only started anyway if there are no more
+    '''
+
+    def __init__(self, cpus, mem_budget=None, lookahead=None, max_skips=None,
+                 poll=0.5, max_time=None, on_timeout=None, hold=None):
+        self.cpus = cpus
+        self.hold = hold
+        self.mem_budget = mem_budget
+        self.max_time = max_time
+        self.on_timeout = on_timeout
+        self.lookahead = lookahead or 4 * cpus
+        self.max_skips = max_skips or 2 * cpus
+        self.poll = poll
+        self.processes = list()
+        self.running = dict()
+        self.peak = dict()
+
+    def used_memory(self):
+        '''
+        Memory in use counting the running tasks estimates
+
+        Each worker counts as the maximum between its estimate and its
+        measured memory, so a worker that did not grow yet keeps its share.
+        '''
+
+        workers = set(self.running)
+        used = pss(os.getpid())
+        for pid in children(os.getpid()):
+            mem = pss(pid)
+            if pid in workers:
+                self.peak[pid] = max(self.peak.get(pid, 0), mem)
+                mem = max(mem, self.running[pid].mem)
+            used += mem
+
+        return used
+
+    def fits(self, item):
+        '''
+        Check whether the task can be started now
+        '''
+
+        if len(self.running) >= self.cpus:
+            return False
+        if not self.running or self.mem_budget is None:
+            return True
+
+        return self.used_memory() + item.mem <= self.mem_budget
+
+    def start(self, item):
+        item.started = time.time()
+        item.process.start()
+        self.processes.append(item.process)
+        self.running[item.process.pid] = item
+
+    def reap(self):
+        '''
+        Join the finished processes
+        '''
+
+        for process in list(self.processes):
+            if not process.is_alive():
+                process.join()
+                self.processes.remove(process)
+                item = self.running.pop(process.pid)
+                if item.on_done is not None:
+                    item.on_done(item)
+
+    def kill_slow(self):
+        '''
+        Kill the tasks running for longer than max_time
+        '''
+
+        now = time.time()
+        for pid, item in list(self.running.items()):
+            if (item.row is not None and
+                    now - item.started > self.max_time and
+                    item.process.is_alive()):
+                item.process.terminate()
+                item.process.join()
+                self.processes.remove(item.process)
+                del self.running[pid]
+                if self.on_timeout is not None:
+                    self.on_timeout(item)
+
+    def wait(self):
+        '''
+        Wait for a process to finish, for the poll time or for the next
+        running time cap
+        '''
+
+        timeout = self.poll if self.mem_budget is not None else None
+        capped = [item.started for item in self.running.values()
+                  if item.row is not None]
+        if self.max_time is not None and capped:
+            first = min(capped)
+            left = max(first + self.max_time - time.time(), 0)
+            timeout = left if timeout is None else min(timeout, left)
+
+        if self.processes:
+            wait([process.sentinel for process in self.processes],
+                 timeout=timeout)
+        if self.max_time is not None:
+            self.kill_slow()
+        self.reap()
+
+    def run(self, tasks):
+        '''
+        Run all the tasks
+
+        Args:
+            tasks (iterable): task objects, they are consumed lazily
+
+        Returns:
+            int: 0
+        '''
+
+        tasks = iter(tasks)
+        pending = deque()
+        exhausted = False
+        release = False
+
+        while True:
+            while not exhausted and len(pending) < self.lookahead:
+                try:
+                    pending.append(next(tasks))
+                except StopIteration:
+                    exhausted = True
+
+            if not pending and not self.processes:
+                break
+
+            started = False
+            head = pending[0] if pending else None
+            blocked = False
+            for item in list(pending):
+                if len(self.running) >= self.cpus:
+                    break
+                if blocked and head.skipped >= self.max_skips:
+                    # Waiting for headroom for the held back task
+                    break
+                if (not release and self.hold is not None and
+                        self.hold(item)):
+                    continue
+                if self.fits(item):
+                    self.start(item)
+                    pending.remove(item)
+                    started = True
+                    if blocked:
+                        head.skipped += 1
+                elif item is head:
+                    blocked = True
+
+            release = False
+            if not started and not self.running:
+                # All the read tasks are held, the ones they wait for are
+                # further in the tasks (eg. sorted by size) or, when all
+                # the tasks are read, not there and the held ones are run
+                if exhausted:
+                    release = True
+                else:
+                    try:
+                        pending.append(next(tasks))
+                    except StopIteration:
+                        exhausted = True
+            elif not started:
+                self.wait()
+            else:
+                self.reap()
+
+        return 0
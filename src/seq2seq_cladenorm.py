@@ -14,12 +14,28 @@ February 2022
 '''
 
 # Import libraries ----
+import os
 from optparse import OptionParser
 import ete3
 import pandas as pd
+import numpy as np
 from multiprocessing import Process, Manager
-from treefuns import tree_stats, get_group_mrca, annotate_tree
-
+from treefuns import tree_stats, get_group_mrca, annotate_tree, \
+    species_registry
+from pairfuns import tree_arrays, pair_values, row_blocks, shared_arrays, \
+    seed_pairs, species_pairs, one_to_one_pairs
+from stage_trace import tree_trace, write_trace
+from sketches import summary_table
+from metrics import metrics_writer
+from scheduler import scheduler, task, estimate_memory, \
+    estimate_block_memory, estimate_batch_memory, plan_rows, heavy_queue
+from batchtrees import tree_batch, tree_hash
+from memo_cache import memo_cache, memo_key, frame_hash
+from ordered_output import ordered_results, table_stream, finish_file, \
+    check_format, FORMATS
+from ingest import read_rows, shard_name
+
+from phylome_catalogue import phylome_catalogue, catalogue_error
 from utils import file_exists, create_folder
 
 
@@ -113,48 +129,538 @@ def get_dists(tree, from_seq, to_seq, seed_id, phylome_id, normfdic):
     return leafdistd
 
 
+class pair_sink(object):
+    '''
+    Destination of the results of the workers, the ordered results (see
+    ordered_output.py) with the pairs themselves or, when aggregating, with
+    their summaries per species pair and MRCA type (dist stream) and the
+    normalisation factors (norm stream) of each tree
+    '''
+
+    def __init__(self, results, aggregate=False):
+        self.results = results
+        self.aggregate = aggregate
+
+    def send(self, index, part, pairs, norm_row=None):
+        '''
+        Send the results of a tree (or of a block of a split tree)
+
+        Args:
+            index (int): input index of the tree
+            part (int): block of the tree, 0 if it is not split
+            pairs (list): sequence pairs dictionaries
+            norm_row (dict): normalisation factors row, None if not sent
+        '''
+
+        if self.aggregate:
+            pairs = [summary_table().add_pairs(pairs).to_dict()] \
+                if pairs else list()
+        outputs = {'dist': pairs}
+        if norm_row is not None:
+            outputs['norm'] = [norm_row]
+        self.results.put(index, part, outputs)
+
+
+def pair_rows(arrays, from_idx, to_idx, tname, tnames, phylome_id,
+              norm_stats, registry):
+    '''
+    Distances and events of a set of sequence pairs from the tree arrays
+
+    Args:
+        arrays (dict): tree arrays, see pairfuns.tree_arrays, with the leaves
+        species codes (species)
+        from_idx (array): from leaves indexes in tnames
+        to_idx (array): to leaves indexes in tnames
+        tname (str): tree (seed) name
+        tnames (list): leaves names
+        phylome_id (str): phylome id
+        norm_stats (dict): normalisation factors
+        registry (species_registry): species codes
+
+    Returns:
+        list: the get_dists dictionaries of the pairs
+    '''
+
+    values = pair_values(arrays, from_idx, to_idx)
+    mrca = np.where(values['is_dup'] == 1, 'D', 'S')
+    median = norm_stats['median']
+    # The species names are the registry strings, shared by all the pairs
+    names = registry.names
+    from_sp = arrays['species'][from_idx].tolist()
+    to_sp = arrays['species'][to_idx].tolist()
+
+    pairs = list()
+    for i, j, sp_i, sp_j, dist, sp, dupl, mrca_type in zip(
+            from_idx.tolist(), to_idx.tolist(), from_sp, to_sp,
+            values['dist'].tolist(), values['sp'].tolist(),
+            values['dupl'].tolist(), mrca.tolist()):
+        if tnames[i] != tnames[j]:
+            pairs.append({'id': phylome_id,
+                          'tree': tname,
+                          'from': tnames[i],
+                          'from_sp': names[sp_i],
+                          'to': tnames[j],
+                          'to_sp': names[sp_j],
+                          'sp': sp,
+                          'dupl': dupl,
+                          'mrca_type': mrca_type,
+                          'dist': dist,
+                          'ndist': dist / median})
+
+    return pairs
+
+
+def query_pairs(arrays, tname, tnames, query, allowed=None):
+    '''
+    Select the sequence pairs of a query
+
+    Args:
+        arrays (dict): tree arrays, see pairfuns.tree_arrays
+        tname (str): tree (seed) name
+        tnames (list): leaves names
+        query (str): seed (seed against all), species (species pairs in
+        allowed) or orthologs (one-to-one orthologs)
+        allowed (list): list of (species, species) codes tuples
+
+    Returns:
+        tuple: from and to leaves indexes arrays
+    '''
+
+    species = arrays['species'].tolist()
+    if query == 'seed':
+        return seed_pairs(tnames, tname)
+    elif query == 'species':
+        return species_pairs(species, allowed)
+
+    return one_to_one_pairs(arrays, species)
+
+
+# Version of the cached results, raised when the values of the outputs change
+# so the results of older versions are not read
+MEMO_VERSION = 2
+# Pairs columns kept in the results cache, the ids are added back
+MEMO_COLUMNS = ['from', 'from_sp', 'to', 'to_sp', 'sp', 'dupl', 'mrca_type',
+                'dist', 'ndist']
+
+
+class tree_memo(object):
+    '''
+    Per tree results cache of a run (see memo_cache.py), the keys are the
+    rooted tree and leaves order hash and the run parameters the results
+    depend on
+
+    Args:
+        path (str): cache database
+        gnmdf (DataFrame): phylome information with the normalising groups
+        query (str): pairs query, None for all the pairs
+        species_pairs (str): species pairs of the species query
+    '''
+
+    def __init__(self, path, gnmdf, query=None, species_pairs=None):
+        self.path = path
+        self.query = query
+        self.parts = ['seq2seq_cladenorm', MEMO_VERSION,
+                      frame_hash(gnmdf, ['Proteome', 'Normalising group']),
+                      query, species_pairs]
+        self.cache = None
+
+    def open(self):
+        '''
+        Connect to the cache, in each worker process
+        '''
+
+        self.cache = memo_cache(self.path)
+
+    def key(self, thash, tname):
+        # The seed query pairs depend on the seed, not only on the tree
+        return memo_key(thash, tname if self.query == 'seed' else '',
+                        *self.parts)
+
+    def get(self, key, tname, phylome_id):
+        '''
+        Get the results of a tree
+
+        Returns:
+            tuple: (normalisation factors, sequence pairs), the factors are
+            None if the tree gives no output, None if it is not cached
+        '''
+
+        value = self.cache.get(key)
+        if value is None:
+            return None
+
+        pairs = [{**{'id': phylome_id, 'tree': tname},
+                  **dict(zip(MEMO_COLUMNS, row))}
+                 for row in zip(*[value['pairs'][col]
+                                  for col in MEMO_COLUMNS])]
+
+        return value['norm'], pairs
+
+    def put(self, key, norm_stats, pairs):
+        self.cache.put(key, {'norm': norm_stats,
+                             'pairs': {col: [pair[col] for pair in pairs]
+                                       for col in MEMO_COLUMNS}})
+
+
+def row_name(tree_row):
+    '''
+    Name of a best_trees row, 'sp' for the newick trees as prepare_tree
+    '''
+
+    return tree_row.split('\t', 1)[0] if '\t' in tree_row else 'sp'
+
+
+def prepare_tree(tree_row, gnmdf, trace):
+    '''
+    Parse, root and annotate a tree and get its normalisation factors
+
+    Args:
+        tree_row (str): best_trees row or newick tree
+        gnmdf (DataFrame): phylome information with the normalising groups
+        trace (tree_trace): phase timer
+
+    Returns:
+        tuple: (tree, tree name, leaves names in the input order,
+        normalisation factors), None if the tree is filtered out
+    '''
+
+    if '\t' in tree_row:
+        tree = tree_row.split('\t')
+        t = ete3.PhyloTree(tree[3], sp_naming_function=get_species_tag)
+        tname = tree[0]
+    else:
+        t = ete3.PhyloTree(tree_row, sp_naming_function=get_species_tag)
+        tname = 'sp'
+    trace.mark('parse')
+    if trace.enabled:
+        trace.size(len(t), len(t.get_species()))
+
+    if (len(t.get_species()) > 10 and
+            len(t.get_leaf_names()) < 3 * len(t.get_species())):
+        print('Calculating: %s, species no.: %s, leaves no.: %s' %
+              (tname, len(t.get_species()), len(t.get_leaf_names())))
+
+        tnames = t.get_leaf_names()
+
+        t.set_outgroup(t.get_midpoint_outgroup())
+        trace.mark('root')
+        t.get_descendant_evol_events()
+        trace.mark('evol_events')
+
+        annotate_tree(t, gnmdf, 'Proteome', ['Normalising group'])
+        trace.mark('annotate')
+
+        norm_group = get_group_mrca(t, tname, 'Normalising group', 'A')
+        trace.mark('norm_mrca')
+        norm_stats = tree_stats(norm_group['node'])
+
+        trace.mark('norm_stats')
+
+        return t, tname, tnames, norm_stats
+
+    return None
+
+
 class dist_process(Process):
-    def __init__(self, tree_row, phylome_id, gnmdf, olist, nlist):
+    def __init__(self, tree_row, index, phylome_id, gnmdf, sink,
+                 tlist=None, counters=None, query=None, allowed=None,
+                 registry=None, memo=None):
         Process.__init__(self)
         self.tree_row = tree_row
+        self.index = index
+        self.registry = registry
+        self.memo = memo
+        self.query = query
+        self.allowed = allowed
         self.phylome_id = phylome_id
         self.gnmdf = gnmdf
-        self.olist = olist
-        self.nlist = nlist
+        self.sink = sink
+        self.tlist = tlist
+        self.counters = counters
 
     def run(self):
-        if '\t' in self.tree_row:
-            tree = self.tree_row.split('\t')
-            t = ete3.PhyloTree(tree[3], sp_naming_function=get_species_tag)
-            tname = tree[0]
+        trace = tree_trace(row_name(self.tree_row), self.tlist is not None)
+        if self.memo is not None:
+            fields = self.tree_row.split('\t')
+            tname, newick = (fields[0], fields[3]) if len(fields) > 1 \
+                else ('sp', fields[0])
+            self.memo.open()
+            key = self.memo.key(tree_hash(newick, ordered=True), tname)
+            cached = self.memo.get(key, tname, self.phylome_id)
+            trace.mark('memo')
+            if cached is not None:
+                if self.counters is not None:
+                    self.counters.add('pairs', len(cached[1]))
+                self.output(*cached, tname, trace)
+                return
+
+        prepared = prepare_tree(self.tree_row, self.gnmdf, trace)
+
+        if prepared is not None:
+            t, tname, tnames, norm_stats = prepared
+
+            if self.query is not None and len(set(tnames)) < len(tnames):
+                print('Skipping: %s, repeated leaf names' % tname)
+                prepared = None
+
+        if prepared is None:
+            if self.memo is not None:
+                self.memo.put(key, None, list())
+            self.output(None, list(), None, trace)
         else:
-            t = ete3.PhyloTree(self.tree_row, sp_naming_function=get_species_tag)
-            tname = 'sp'
+            # The pairs are sent at once when the tree is finished, so a
+            # killed tree does not leave partial outputs
+            if self.query is not None:
+                arrays = tree_arrays(t, tnames)
+                arrays['species'] = self.registry.leaf_codes(tnames)
+                from_idx, to_idx = query_pairs(arrays, tname, tnames,
+                                               self.query, self.allowed)
+                pairs = pair_rows(arrays, from_idx, to_idx, tname, tnames,
+                                  self.phylome_id, norm_stats,
+                                  self.registry)
+                if self.counters is not None:
+                    self.counters.add('pairs', len(pairs))
+            else:
+                pairs = list()
+                for i, from_seq in enumerate(tnames):
+                    for to_seq in tnames[i + 1:]:
+                        if from_seq != to_seq:
+                            leaf_dist = get_dists(t, from_seq, to_seq, tname,
+                                                  self.phylome_id, norm_stats)
+                            if leaf_dist is not None:
+                                pairs.append(leaf_dist)
+                    if self.counters is not None:
+                        self.counters.add('pairs', len(tnames) - i - 1)
+            trace.mark('pairs')
+
+            if self.memo is not None:
+                self.memo.put(key, norm_stats, pairs)
+            self.output(norm_stats, pairs, tname, trace)
+
+    def output(self, norm_stats, pairs, tname, trace):
+        '''
+        Send the results of the tree, nothing if norm_stats is None
+        '''
+
+        if norm_stats is not None:
+            self.sink.send(self.index, 0, pairs,
+                           {**{'tree': tname}, **norm_stats})
+            trace.mark('output')
+
+        if trace.enabled:
+            self.tlist.append(trace.record())
+        if self.counters is not None:
+            self.counters.add('done')
+
+
+class pair_block_process(Process):
+    '''
+    Sequence pairs of a block of rows (from sequences) of a split tree, the
+    tree arrays are read from shared memory
+    '''
 
-        if (len(t.get_species()) > 10 and
-                len(t.get_leaf_names()) < 3 * len(t.get_species())):
-            print('Calculating: %s, species no.: %s, leaves no.: %s' %
-                  (tname, len(t.get_species()), len(t.get_leaf_names())))
+    def __init__(self, tname, tnames, phylome_id, norm_stats, arrays, rows,
+                 sink, registry, index, part, tlist=None, counters=None):
+        Process.__init__(self)
+        self.tname = tname
+        self.index = index
+        self.part = part
+        self.registry = registry
+        self.tnames = tnames
+        self.phylome_id = phylome_id
+        self.norm_stats = norm_stats
+        self.shared = (arrays.name, arrays.layout)
+        self.rows = rows
+        self.sink = sink
+        self.tlist = tlist
+        self.counters = counters
 
-            tnames = t.get_leaf_names()
+    def run(self):
+        trace = tree_trace(self.tname, self.tlist is not None)
+        shared = shared_arrays(name=self.shared[0], layout=self.shared[1])
+        arrays = shared.arrays()
+        tnames = self.tnames
+
+        pairs = list()
+        for i in range(*self.rows):
+            to_idx = np.arange(i + 1, len(tnames))
+            pairs.extend(pair_rows(arrays, np.full(len(to_idx), i), to_idx,
+                                   self.tname, tnames, self.phylome_id,
+                                   self.norm_stats, self.registry))
+            if self.counters is not None:
+                self.counters.add('pairs', len(to_idx))
+        nspecies = len(np.unique(arrays['species']))
+        del arrays
+        shared.close()
+        trace.mark('pairs')
+
+        self.sink.send(self.index, self.part, pairs)
+        trace.mark('output')
+
+        if trace.enabled:
+            trace.size(len(tnames), nspecies)
+            self.tlist.append(trace.record())
+
+
+class batch_process(Process):
+    '''
+    Sequence pairs of a batch of small trees, rooted, annotated and normalised
+    all at once with batchtrees instead of one ete3 tree at a time
+    '''
 
-            t.set_outgroup(t.get_midpoint_outgroup())
-            t.get_descendant_evol_events()
+    def __init__(self, rows, indexes, phylome_id, gnmdf, sink, registry,
+                 tlist=None, counters=None, query=None, allowed=None,
+                 memo=None):
+        Process.__init__(self)
+        self.rows = rows
+        self.indexes = indexes
+        self.memo = memo
+        self.phylome_id = phylome_id
+        self.gnmdf = gnmdf
+        self.sink = sink
+        self.registry = registry
+        self.tlist = tlist
+        self.counters = counters
+        self.query = query
+        self.allowed = allowed
+
+    def run(self):
+        trace = tree_trace('%s+%d' % (row_name(self.rows[0]),
+                                      len(self.rows) - 1),
+                           self.tlist is not None)
+        batch = tree_batch(self.rows, self.registry)
+        trace.mark('root')
+        batch.evol_events()
+        trace.mark('evol_events')
+        norm = batch.norm_table(self.gnmdf)
+        trace.mark('norm_stats')
+        for tname, reason in batch.skipped:
+            if reason != 'filtered':
+                print('Skipping: %s, %s' % (tname, reason))
+
+        if self.memo is not None:
+            self.memo.open()
+
+        outputs = list()
+        for k, norm_stats in zip(norm.index, norm.to_dict('records')):
+            tname = norm_stats.pop('tree')
+            tnames = batch.tnames[k]
+            index = self.indexes[batch.positions[k]]
+            if self.memo is not None:
+                key = self.memo.key(batch.hashes[k], tname)
+                cached = self.memo.get(key, tname, self.phylome_id)
+                if cached is not None:
+                    if cached[0] is not None:
+                        outputs.append((index, cached[1],
+                                        {**{'tree': tname}, **cached[0]}))
+                    if self.counters is not None:
+                        self.counters.add('pairs', len(cached[1]))
+                    continue
+            if len(set(tnames)) < len(tnames):
+                print('Skipping: %s, repeated leaf names' % tname)
+                continue
+            print('Calculating: %s, leaves no.: %s' % (tname, len(tnames)))
+
+            arrays = batch.tree_arrays(k)
+            if self.query is not None:
+                from_idx, to_idx = query_pairs(arrays, tname, tnames,
+                                               self.query, self.allowed)
+            else:
+                from_idx, to_idx = np.triu_indices(len(tnames), 1)
+            tpairs = pair_rows(arrays, from_idx, to_idx, tname, tnames,
+                               self.phylome_id, norm_stats, self.registry)
+            if self.memo is not None:
+                self.memo.put(key, norm_stats, tpairs)
+            outputs.append((index, tpairs, {**{'tree': tname}, **norm_stats}))
+            if self.counters is not None:
+                self.counters.add('pairs', len(tpairs))
+        trace.mark('pairs')
+
+        for index, pairs, norm_row in outputs:
+            self.sink.send(index, 0, pairs, norm_row)
+        trace.mark('output')
+
+        if trace.enabled:
+            trace.size(int(batch.is_leaf.sum()), len(set(batch.species)) - 1)
+            self.tlist.append(trace.record())
+        if self.counters is not None:
+            self.counters.add('done', len(self.rows))
+
+
+def split_tasks(tree_row, index, phylome_id, gnmdf, sink, nblocks,
+                registry, tlist=None, counters=None):
+    '''
+    Split a big tree in blocks of sequence pairs to be run in parallel
 
-            annotate_tree(t, self.gnmdf, 'Proteome', ['Normalising group'])
+    The tree is prepared in the main process and its depth, events and LCA
+    arrays are placed in shared memory, which is released when the last block
+    finishes.
 
-            norm_group = get_group_mrca(t, tree[0], 'Normalising group', 'A')
-            norm_stats = tree_stats(norm_group['node'])
+    Args:
+        tree_row (str): best_trees row or newick tree
+        index (int): input index of the tree
+        phylome_id (str): phylome id
+        gnmdf (DataFrame): phylome information with the normalising groups
+        sink (pair_sink): destination of the results
+        nblocks (int): minimum number of blocks
+        registry (species_registry): species codes
+        tlist (list): manager list for the traces, None to not trace
+        counters (stage_counters): progress counters
 
-            self.nlist.append({**{'tree': tname}, **norm_stats})
+    Returns:
+        list: scheduler tasks, one per block
+    '''
 
-            for i, from_seq in enumerate(tnames):
-                for to_seq in tnames[i + 1:]:
-                    if from_seq != to_seq:
-                        leaf_dist = get_dists(t, from_seq, to_seq, tname,
-                                              self.phylome_id, norm_stats)
-                        if leaf_dist is not None:
-                            self.olist.append(leaf_dist)
+    trace = tree_trace(row_name(tree_row), tlist is not None)
+    prepared = prepare_tree(tree_row, gnmdf, trace)
+    if prepared is not None:
+        t, tname, tnames, norm_stats = prepared
+        if len(set(tnames)) < len(tnames):
+            print('Skipping: %s, repeated leaf names' % tname)
+            prepared = None
+
+    results = sink.results
+    if prepared is None:
+        results.collect(index)
+        if trace.enabled:
+            tlist.append(trace.record())
+        if counters is not None:
+            counters.add('done')
+        return list()
+
+    arrays = tree_arrays(t, tnames)
+    arrays['species'] = registry.leaf_codes(tnames)
+    arrays = shared_arrays(arrays)
+    trace.mark('arrays')
+    if trace.enabled:
+        tlist.append(trace.record())
+
+    blocks = row_blocks(len(tnames), nblocks)
+    left = [len(blocks)]
+    # The blocks pairs and, as the last part, the normalisation factors
+    results.set_parts(index, len(blocks) + 1)
+    results.collect(index, len(blocks),
+                    {'norm': [{**{'tree': tname}, **norm_stats}]})
+
+    def done(item, part):
+        results.collect(index, part)
+        left[0] -= 1
+        if left[0] == 0:
+            arrays.unlink()
+            if counters is not None:
+                counters.add('done')
+
+    tasks = list()
+    for part, (first, last) in enumerate(blocks):
+        npairs = (last - first) * (2 * len(tnames) - first - last - 1) // 2
+        process = pair_block_process(tname, tnames, phylome_id, norm_stats,
+                                     arrays, (first, last), sink, registry,
+                                     index, part, tlist, counters)
+        tasks.append(task(process, estimate_block_memory(npairs),
+                          on_done=lambda item, part=part: done(item, part),
+                          indexes=(index,)))
+
+    return tasks
 
 
 def main():
@@ -164,8 +670,13 @@ def main():
                       help='Default configurations to execute with our data.',
                       action='store_true')
     parser.add_option('-f', '--file', dest='ifile',
-                      help='In file',
+                      help='In file, it can be gzip (.gz) or zstandard '
+                      '(.zst) compressed or - for the standard input',
                       metavar='<path/to/file.txt>')
+    parser.add_option('--name', dest='name',
+                      help='Shard id (default: the input file name, it is '
+                      'needed for the standard input)',
+                      metavar='<0005_19>')
     parser.add_option('-o', '--output', dest='odir',
                       help='Output directory',
                       metavar='<path/to/output>')
@@ -175,6 +686,73 @@ def main():
     parser.add_option('-c', '--cpu', dest='cpus',
                       help='File with protein codes',
                       metavar='<path/to/file.txt>', type='int')
+    parser.add_option('-t', '--trace', dest='trace',
+                      help='Write the per tree stage timings in json '
+                      '(Chrome trace) or csv format',
+                      choices=['json', 'csv'], metavar='<json|csv>')
+    parser.add_option('-m', '--metrics', dest='metrics',
+                      help='Prometheus textfile to write the progress metrics',
+                      metavar='<path/to/file.prom>')
+    parser.add_option('-M', '--mem', dest='mem',
+                      help='Memory budget in MB, the number of running trees '
+                      'is adapted to stay under it (up to -c)', type='int',
+                      metavar='<MB>')
+    parser.add_option('-l', '--lpt', dest='lpt',
+                      help='Process the trees largest first',
+                      action='store_true')
+    parser.add_option('--max-leaves', dest='max_leaves',
+                      help='Trees with more leaves are written to the heavy '
+                      'queue file (<file>_heavy.txt) instead', type='int',
+                      metavar='<N>')
+    parser.add_option('--max-time', dest='max_time',
+                      help='Trees running for longer are killed and written '
+                      'to the heavy queue file', type='float',
+                      metavar='<seconds>')
+    parser.add_option('-s', '--split', dest='split',
+                      help='Trees with at least N leaves are split in blocks '
+                      'of sequence pairs run in parallel (default: 1000, 0 '
+                      'to not split)', type='int', default=1000,
+                      metavar='<N>')
+    parser.add_option('-q', '--query', dest='query',
+                      help='Sequence pairs to compute: all (default), seed '
+                      '(seed against all), species (--species-pairs) or '
+                      'orthologs (one-to-one orthologs)', default='all',
+                      choices=['all', 'seed', 'species', 'orthologs'],
+                      metavar='<all|seed|species|orthologs>')
+    parser.add_option('--species-pairs', dest='species_pairs',
+                      help='Comma separated species pairs for -q species',
+                      metavar='<YEAST:CANAL,...>')
+    parser.add_option('-a', '--aggregate', dest='aggregate',
+                      help='Write the distances summaries per species pair '
+                      'and MRCA type (<file>_summary.json) instead of the '
+                      'sequence pairs', action='store_true')
+    parser.add_option('-b', '--batch', dest='batch',
+                      help='Trees under the -s size are processed in batches '
+                      'of N trees per worker, rooted and normalised at once '
+                      '(not killed by --max-time)', type='int',
+                      metavar='<N>')
+    parser.add_option('--memo', dest='memo',
+                      help='Results cache shared by the runs, the trees '
+                      'already computed (same rooted tree, groups and query) '
+                      'are read from it (split trees are not cached)',
+                      metavar='<path/to/memo.sqlite>')
+    parser.add_option('--memo-size', dest='memo_size',
+                      help='Maximum size of the results cache in GB, the '
+                      'least recently used results are removed',
+                      type='float', metavar='<GB>')
+    parser.add_option('-F', '--format', dest='format',
+                      help='Format of the output tables: csv or parquet '
+                      '(compressed and columnar, it needs pyarrow)',
+                      choices=['csv', 'parquet'], default='csv',
+                      metavar='<csv|parquet>')
+    parser.add_option('--float32', dest='float32',
+                      help='Comma separated float columns stored in single '
+                      'precision in the parquet tables, eg. dist,ndist',
+                      default='', metavar='<col,col,...>')
+    parser.add_option('--catalogue', dest='catalogue',
+                      help='Phylome catalogue (phylome_catalogue.py) to '
+                      'check the groups table against before starting',
+                      metavar='<path/to/catalogue.sqlite>')
     (options, args) = parser.parse_args()
 
     if options.default:
@@ -188,48 +766,181 @@ def main():
         gnmdf = options.pinfo
         cpus = options.cpus
 
-    phylome_id = ifile.rsplit('/', 1)[1].split('_', 1)[0]
-    file_id = ifile.rsplit('/', 1)[1].split('.', 1)[0]
-
-    dist_fn = '/'.join([odir, (file_id + '_dist.csv')])
-    norm_fn = '/'.join([odir, (file_id + '_norm.csv')])
+    mem_budget = None
+    if options.mem:
+        mem_budget = options.mem * 2 ** 20
+        cpus = cpus or os.cpu_count()
+
+    query = None if options.query == 'all' else options.query
+    allowed = None
+    if query == 'species':
+        if not options.species_pairs:
+            parser.error('-q species needs --species-pairs')
+        allowed = [tuple(pair.split(':'))
+                   for pair in options.species_pairs.split(',')]
+
+    try:
+        file_id = shard_name(ifile, options.name)
+    except ValueError as e:
+        parser.error(str(e))
+    phylome_id = file_id.split('_', 1)[0]
+
+    try:
+        check_format(options.format)
+    except ValueError as e:
+        parser.error(str(e))
+    float32 = [col for col in options.float32.split(',') if col]
+
+    ext = FORMATS[options.format]
+    dist_fn = '/'.join([odir, (file_id + '_dist' + ext)])
+    if options.aggregate:
+        dist_fn = '/'.join([odir, (file_id + '_summary.json')])
+    norm_fn = '/'.join([odir, (file_id + '_norm' + ext)])
     if not file_exists(dist_fn) or not file_exists(norm_fn):
         print('Creating: ', dist_fn)
 
         create_folder(odir)
 
-        trees = open(ifile, 'r').read().split('\n')
         gnmdf = pd.read_csv(gnmdf)
+        catalogue = None
+        if options.catalogue:
+            catalogue = phylome_catalogue(options.catalogue)
+            try:
+                catalogue.check_groups(phylome_id, gnmdf)
+            except catalogue_error as e:
+                catalogue.close()
+                parser.error(str(e))
+
+        # The species are handled as integers from here, the catalogue
+        # proteomes are interned too
+        registry = species_registry.from_phylome(phylome_id, gnmdf,
+                                                 catalogue=catalogue)
+        if catalogue is not None:
+            catalogue.close()
+        if allowed is not None:
+            allowed = [(registry.code(sp_a), registry.code(sp_b))
+                       for sp_a, sp_b in allowed]
+
+        memo = None
+        if options.memo:
+            memo = tree_memo(options.memo, gnmdf, query,
+                             options.species_pairs)
 
         with Manager() as manager:
-            olist = manager.list()
-            nlist = manager.list()
-
-            processes = list()
-            for tree_row in trees:
-                if tree_row != '':
-                    if len(processes) >= cpus:
-                        done = False
-                        while not done:
-                            for process in processes:
-                                if not process.is_alive():
-                                    processes.remove(process)
-                                    done = True
-
-                    process = dist_process(tree_row, phylome_id, gnmdf,
-                                           olist, nlist)
-                    processes.append(process)
-                    process.start()
-
-            for process in processes:
-                process.join()
-
-            # Writing output files
-            odf = pd.DataFrame(list(olist))
-            odf.to_csv(dist_fn, index=False)
-
-            ndf = pd.DataFrame(list(nlist))
-            ndf.to_csv(norm_fn, index=False)
+            tlist = manager.list() if options.trace else None
+
+            heavy = heavy_queue('%s/%s_heavy.txt' % (odir, file_id))
+            # The rows are read as the trees are started, unless they have
+            # to be sorted first
+            rows = plan_rows(read_rows(ifile), options.lpt,
+                             options.max_leaves, heavy)
+
+            # The results are written in input order as the trees finish
+            summaries = summary_table()
+
+            def merge_summaries(data):
+                for summary in data:
+                    summaries.merge(summary_table.from_dict(summary))
+
+            dist_out = None
+            if not options.aggregate:
+                dist_out = table_stream(dist_fn, options.format, float32)
+            norm_out = table_stream(norm_fn, options.format, float32)
+            results = ordered_results(
+                manager, [index for index, leaves, row in rows]
+                if options.lpt else (),
+                {'dist': merge_summaries if options.aggregate else dist_out,
+                 'norm': norm_out})
+            sink = pair_sink(results, options.aggregate)
+
+            def collect(item):
+                for index in item.indexes:
+                    results.collect(index)
+
+            counters = None
+            if options.metrics:
+                metrics = metrics_writer(options.metrics, 'seq2seq_cladenorm',
+                                         file_id, 'trees',
+                                         len(rows) if options.lpt else 0,
+                                         cpus)
+                metrics.start()
+                counters = metrics.counters
+
+            def timeout(item):
+                # A worker killed after sending its results is not sent to
+                # the heavy queue, or the tree would be written twice
+                if not all(results.sent(index) for index in item.indexes):
+                    heavy.add(item.row)
+                collect(item)
+                if counters is not None:
+                    counters.add('done')
+
+            workers = scheduler(cpus, mem_budget, max_time=options.max_time,
+                                on_timeout=timeout, hold=results.hold)
+            if options.metrics:
+                metrics.processes = workers.processes
+
+            def batch_task(batch):
+                indexes = [index for index, leaves, row in batch]
+                process = batch_process([row for index, leaves, row in batch],
+                                        indexes, phylome_id, gnmdf, sink,
+                                        registry, tlist, counters, query,
+                                        allowed, memo)
+                return task(process, estimate_batch_memory(
+                    [leaves for index, leaves, row in batch], query is None),
+                    on_done=collect, indexes=indexes)
+
+            def tasks():
+                batch = list()
+                for index, leaves, tree_row in rows:
+                    results.expect(index)
+                    if options.metrics and not options.lpt:
+                        metrics.total += 1
+                    if (query is None and options.split and
+                            leaves >= options.split):
+                        yield from split_tasks(tree_row, index, phylome_id,
+                                               gnmdf, sink, cpus, registry,
+                                               tlist, counters)
+                        continue
+                    if options.batch:
+                        batch.append((index, leaves, tree_row))
+                        if len(batch) == options.batch:
+                            yield batch_task(batch)
+                            batch = list()
+                        continue
+                    process = dist_process(tree_row, index, phylome_id,
+                                           gnmdf, sink, tlist, counters,
+                                           query, allowed, registry, memo)
+                    yield task(process,
+                               estimate_memory(leaves, query is None),
+                               tree_row, on_done=collect, indexes=(index,))
+                if batch:
+                    yield batch_task(batch)
+
+            workers.run(tasks())
+            heavy.close()
+
+            if options.memo and options.memo_size:
+                cache = memo_cache(options.memo,
+                                   int(options.memo_size * 2 ** 30))
+                print('Results removed from the cache: %d' % cache.evict())
+                cache.close()
+
+            if options.metrics:
+                metrics.stop()
+
+            # Closing the output files, with their hashes
+            results.close()
+            if options.aggregate:
+                summaries.write(dist_fn + '.part')
+                finish_file(dist_fn + '.part', dist_fn)
+            else:
+                dist_out.close()
+            norm_out.close()
+
+            if options.trace:
+                write_trace(list(tlist), '%s/%s_trace.%s' %
+                            (odir, file_id, options.trace), options.trace)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+simulate_phylome.py -- Synthetic phylome generator
+
+The script simulates gene families along a species tree built from the
+species ages of a rooted phylome (ROOTED_PHYLOMES) with a birth-death
+(duplication-loss) process. It writes the trees in the best_trees format
+(seed, model, likelihood, newick) and a matching normalising groups table, so
+the rest of the pipeline can be run on families of any size.
+
+Requirements: rooted_phylomes.py
+'''
+
+# Import libraries ----
+from optparse import OptionParser
+from math import log
+import random
+from rooted_phylomes import ROOTED_PHYLOMES as root_dict
+from utils import create_folder
+
+
+# Definitions ----
+class sp_node(object):
+    '''
+    Species tree node
+    '''
+
+    def __init__(self, name=None, height=0.0, children=None):
+        self.name = name
+        self.height = height
+        self.children = children if children is not None else []
+
+
+class gene_tree(object):
+    '''
+    Flat gene tree, nodes are stored in creation order so a parent index is
+    always lower than its children indexes
+    '''
+
+    def __init__(self):
+        self.parent = list()
+        self.children = list()
+        self.height = list()
+        self.name = list()
+
+    def add_node(self, parent, height, name=None):
+        idx = len(self.parent)
+        self.parent.append(parent)
+        self.children.append(list())
+        self.height.append(height)
+        self.name.append(name)
+        if parent is not None:
+            self.children[parent].append(idx)
+
+        return idx
+
+
+def resolve_clade(species, upper, rng):
+    '''
+    Resolve a set of species of the same age with a random coalescent
+
+    Args:
+        species (list): species codes
+        upper (float): the maximum height of the coalescences
+        rng (Random): random number generator
+
+    Returns:
+        sp_node: the root of the resolved clade
+    '''
+
+    lineages = [sp_node(sp) for sp in species]
+    heights = sorted(rng.uniform(0, upper) for i in range(len(species) - 1))
+    for height in heights:
+        i, j = rng.sample(range(len(lineages)), 2)
+        node = sp_node(height=height, children=[lineages[i], lineages[j]])
+        lineages = [lin for k, lin in enumerate(lineages) if k not in (i, j)]
+        lineages.append(node)
+
+    return lineages[0]
+
+
+def species_tree(ages, height, rng):
+    '''
+    Build a species tree from a species age dictionary
+
+    Species of each age are joined to the clade of the younger ones at evenly
+    spaced heights, same age species are resolved randomly below it.
+
+    Args:
+        ages (dict): species to age dictionary as in ROOTED_PHYLOMES
+        height (float): the height of the species tree root
+        rng (Random): random number generator
+
+    Returns:
+        sp_node: the root of the species tree
+    '''
+
+    levels = sorted(set(ages.values()))
+    clade = None
+    for i, level in enumerate(levels):
+        top = height * (i + 1) / len(levels)
+        sps = sorted(sp for sp, age in ages.items() if age == level)
+        group = resolve_clade(sps, top, rng)
+        if clade is None:
+            clade = group
+        else:
+            clade = sp_node(height=top, children=[clade, group])
+
+    return clade
+
+
+def grow_family(sptree, dup, loss, cap, rng):
+    '''
+    Simulate a gene family along the species tree
+
+    Each gene lineage duplicates with rate dup and it is lost with rate loss,
+    when it reaches a species tree node it speciates.
+
+    Args:
+        sptree (sp_node): species tree root
+        dup (float): duplication rate per lineage and time unit
+        loss (float): loss rate per lineage and time unit
+        cap (int): maximum number of leaves, the simulation is aborted over it
+        rng (Random): random number generator
+
+    Returns:
+        tuple: the gene tree and the list of leaves indexes, None if the
+        family went extinct or it grew over the cap
+    '''
+
+    gtree = gene_tree()
+    leaves = list()
+    rate = dup + loss
+
+    root = gtree.add_node(None, sptree.height)
+    stack = [(child, root) for child in sptree.children]
+    if not sptree.children:
+        gtree.name[root] = sptree.name
+        return gtree, [root]
+
+    while stack:
+        spnode, gparent = stack.pop()
+        lineages = [(gparent, gtree.height[gparent])]
+        while lineages:
+            gpar, top = lineages.pop()
+            bottom = spnode.height
+            wait = rng.expovariate(rate) if rate > 0 else top
+            if top - wait > bottom:
+                if rng.random() < dup / rate:
+                    dnode = gtree.add_node(gpar, top - wait)
+                    lineages.append((dnode, top - wait))
+                    lineages.append((dnode, top - wait))
+                continue
+
+            node = gtree.add_node(gpar, bottom)
+            if spnode.children:
+                for child in spnode.children:
+                    stack.append((child, node))
+            else:
+                gtree.name[node] = spnode.name
+                leaves.append(node)
+                if len(leaves) > cap:
+                    return None
+
+    if not leaves:
+        return None
+
+    return gtree, leaves
+
+
+def alive_nodes(gtree, leaves):
+    '''
+    Mark the nodes with at least one surviving leaf below
+
+    Args:
+        gtree (gene_tree): the simulated gene tree
+        leaves (list): surviving leaves indexes
+
+    Returns:
+        list: boolean list indexed by node
+    '''
+
+    alive = [False] * len(gtree.parent)
+    for leaf in leaves:
+        alive[leaf] = True
+    for idx in range(len(alive) - 1, 0, -1):
+        if alive[idx]:
+            alive[gtree.parent[idx]] = True
+
+    return alive
+
+
+def to_newick(gtree, alive, names, brlen, shape, rng):
+    '''
+    Write the surviving gene tree in newick format
+
+    Unary nodes left by losses are suppressed and the root is left as a
+    trifurcation, as in the PhylomeDB best trees. Branch lengths are the
+    elapsed times multiplied by a rate drawn from the branch length
+    distribution.
+
+    Args:
+        gtree (gene_tree): the simulated gene tree
+        alive (list): surviving nodes, see alive_nodes
+        names (dict): leaf index to sequence name dictionary
+        brlen (str): branch rates distribution, clock, gamma, lognormal or
+        exponential
+        shape (float): the gamma shape or the lognormal sigma
+        rng (Random): random number generator
+
+    Returns:
+        str: the newick tree
+    '''
+
+    def kids(node):
+        out = list()
+        for child in gtree.children[node]:
+            if alive[child]:
+                while True:
+                    alive_kids = [c for c in gtree.children[child]
+                                  if alive[c]]
+                    if len(alive_kids) != 1:
+                        break
+                    child = alive_kids[0]
+                out.append(child)
+        return out
+
+    def rate():
+        if brlen == 'gamma':
+            return rng.gammavariate(shape, 1 / shape)
+        elif brlen == 'lognormal':
+            return rng.lognormvariate(-shape ** 2 / 2, shape)
+        elif brlen == 'exponential':
+            return rng.expovariate(1)
+        return 1.0
+
+    root = 0
+    root_kids = kids(root)
+    while len(root_kids) == 1:
+        root = root_kids[0]
+        root_kids = kids(root)
+
+    # Unrooting the tree leaving a trifurcation at the root
+    lengths = {child: gtree.height[root] - gtree.height[child]
+               for child in root_kids}
+    inner = [c for c in root_kids if gtree.name[c] is None]
+    if len(root_kids) == 2 and inner:
+        other = [c for c in root_kids if c != inner[0]][0]
+        lengths[other] += lengths[inner[0]]
+        root_kids = [other] + kids(inner[0])
+        for child in root_kids[1:]:
+            lengths[child] = gtree.height[inner[0]] - gtree.height[child]
+
+    if not root_kids:
+        return '%s;' % names[root]
+
+    out = ['(']
+    stack = [('close', root, None)]
+    for i, child in enumerate(reversed(root_kids)):
+        if i:
+            stack.append(('sep', None, None))
+        stack.append(('node', child, lengths[child]))
+
+    while stack:
+        action, node, length = stack.pop()
+        if action == 'sep':
+            out.append(',')
+        elif action == 'close':
+            out.append(');' if node == root else '):%f' % length)
+        else:
+            length = length * rate()
+            node_kids = kids(node)
+            if node_kids:
+                out.append('(')
+                stack.append(('close', node, length))
+                for i, child in enumerate(reversed(node_kids)):
+                    if i:
+                        stack.append(('sep', None, None))
+                    stack.append(('node', child, gtree.height[node] -
+                                  gtree.height[child]))
+            else:
+                out.append('%s:%f' % (names[node], length))
+
+    return ''.join(out)
+
+
+def seq_name(number, species):
+    '''
+    PhylomeDB like sequence name, eg. Phy000003A_YEAST
+    '''
+
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    code = ''
+    while number:
+        number, rest = divmod(number, 36)
+        code = digits[rest] + code
+
+    return 'Phy%s_%s' % (code.rjust(7, '0'), species)
+
+
+def simulate_tree(sptree, seed_sps, leafno, dup, loss, brlen, shape, rng,
+                  first_id, attempts=1000):
+    '''
+    Simulate a gene tree with an exact number of leaves
+
+    When no duplication rate is given it is calibrated so the expected number
+    of leaves is leafno. Families are simulated until they have at least
+    leafno leaves containing the seed species and the surplus leaves are
+    removed as random losses.
+
+    Args:
+        sptree (sp_node): species tree root
+        seed_sps (str): seed species code
+        leafno (int): number of leaves
+        dup (float): duplication rate, None to calibrate it
+        loss (float): loss rate
+        brlen (str): branch rates distribution, see to_newick
+        shape (float): branch rates distribution parameter
+        rng (Random): random number generator
+        first_id (int): first sequence number to name the leaves
+        attempts (int): maximum number of simulations
+
+    Returns:
+        tuple: the best_trees row and the next sequence number
+
+    Raises:
+        Exception: no family reached the number of leaves
+    '''
+
+    spno = len(sptree_species(sptree))
+    if dup is None:
+        dup = max(0.0, loss + log(leafno / spno) / sptree.height)
+
+    for attempt in range(attempts):
+        family = grow_family(sptree, dup, loss, 3 * leafno + spno, rng)
+        if family is None or len(family[1]) < leafno:
+            continue
+
+        gtree, leaves = family
+        seeds = [leaf for leaf in leaves if gtree.name[leaf] == seed_sps]
+        if not seeds:
+            continue
+
+        seed = rng.choice(seeds)
+        others = [leaf for leaf in leaves if leaf != seed]
+        kept = [seed] + rng.sample(others, leafno - 1)
+        alive = alive_nodes(gtree, kept)
+
+        names = dict()
+        for i, leaf in enumerate(sorted(kept)):
+            names[leaf] = seq_name(first_id + i, gtree.name[leaf])
+
+        newick = to_newick(gtree, alive, names, brlen, shape, rng)
+        row = '\t'.join([names[seed], rng.choice(['JTT', 'WAG', 'LG']),
+                         '%.2f' % (-rng.uniform(50, 150) * leafno), newick])
+
+        return row, first_id + leafno
+
+    raise Exception('No family with %d leaves after %d simulations, '
+                    'check the duplication and loss rates'
+                    % (leafno, attempts))
+
+
+def sptree_species(sptree):
+    '''
+    Get the species tree leaves names
+    '''
+
+    stack = [sptree]
+    sps = list()
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(node.children)
+        else:
+            sps.append(node.name)
+
+    return sps
+
+
+def write_groups(ofile, ages, norm_age, vert_age, met_age):
+    '''
+    Write the normalising groups table of the simulated phylome
+
+    Args:
+        ofile (str): output csv file
+        ages (dict): species to age dictionary
+        norm_age (int): species up to this age are in the normalising group
+        vert_age (int): species up to this age are vertebrates
+        met_age (int): species up to this age are metazoans
+
+    Returns:
+        int: 0
+    '''
+
+    header = ['Proteome', 'TaxaID', 'Date', 'Longest', 'Source',
+              'Species Name', 'Normalising group', 'Vertebrate', 'Metazoan']
+
+    with open(ofile, 'w') as ohandle:
+        ohandle.write(','.join(header) + '\n')
+        for i, (sp, age) in enumerate(sorted(ages.items(),
+                                             key=lambda x: (x[1], x[0]))):
+            row = [sp, str(900000 + i), '2000-01-01', 'NA', 'simulated',
+                   'Simulated %s' % sp,
+                   'A' if age <= norm_age else 'NA',
+                   'vertebrate' if age <= vert_age else 'NA',
+                   'metazoan' if age <= met_age else 'NA']
+            ohandle.write(','.join(row) + '\n')
+
+    return 0
+
+
+def main():
+    # Script options definition ----
+    parser = OptionParser()
+    parser.add_option('-p', '--phylome', dest='phylome',
+                      help='Rooted phylome id to get the species from',
+                      metavar='<N>', type='int')
+    parser.add_option('-n', '--leaves', dest='leaves',
+                      help='Comma separated numbers of leaves per tree',
+                      metavar='<N,N,...>', default='10,100,1000')
+    parser.add_option('-t', '--trees', dest='trees',
+                      help='Number of trees per number of leaves',
+                      metavar='<N>', type='int', default=10)
+    parser.add_option('-o', '--out', dest='output',
+                      help='output directory',
+                      metavar='<path/to/folder>')
+    parser.add_option('-s', '--seed', dest='seed',
+                      help='Random seed', metavar='<N>', type='int',
+                      default=1)
+    parser.add_option('--dup', dest='dup',
+                      help='Duplication rate (default: calibrated to the '
+                      'number of leaves)', metavar='<float>', type='float')
+    parser.add_option('--loss', dest='loss',
+                      help='Loss rate', metavar='<float>', type='float',
+                      default=0.5)
+    parser.add_option('--height', dest='height',
+                      help='Species tree height in substitutions per site',
+                      metavar='<float>', type='float', default=1.0)
+    parser.add_option('-b', '--brlen', dest='brlen',
+                      help='Branch rates distribution: clock, gamma, '
+                      'lognormal or exponential',
+                      choices=['clock', 'gamma', 'lognormal', 'exponential'],
+                      default='gamma')
+    parser.add_option('--shape', dest='shape',
+                      help='Gamma shape or lognormal sigma of the branch '
+                      'rates', metavar='<float>', type='float', default=2.0)
+    (options, args) = parser.parse_args()
+
+    ages = root_dict[options.phylome]
+    maxage = max(ages.values())
+    phylome_id = str(options.phylome).zfill(4)
+    seed_sps = [sp for sp, age in ages.items() if age == min(ages.values())][0]
+
+    create_folder(options.output)
+    write_groups('%s/%s_norm_groups.csv' % (options.output, phylome_id), ages,
+                 maxage - 2, maxage // 2 + 1, maxage - 2)
+
+    rng = random.Random(options.seed)
+    sptree = species_tree(ages, options.height, rng)
+
+    seq_id = 1
+    for leafno in [int(n) for n in options.leaves.split(',')]:
+        ofile = '%s/%s_sim%d.txt' % (options.output, phylome_id, leafno)
+        print('Simulating: ', ofile)
+        with open(ofile, 'w') as ohandle:
+            for i in range(options.trees):
+                row, seq_id = simulate_tree(sptree, seed_sps, leafno,
+                                            options.dup, options.loss,
+                                            options.brlen, options.shape,
+                                            rng, seq_id)
+                ohandle.write(row + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+sketches.py -- Mergeable per species pair distance summaries
+
+Instead of a row per sequence pair, the distances are summarised per species
+pair and MRCA type: count, moments (sum, sum of squares, sum of logarithms),
+range, a fixed bins histogram and a relative error quantile sketch (log
+buckets, as in DDSketch). All of them are merged by adding, so the summaries
+of trees, workers and shards can be combined in any order.
+
+Requirements: numpy
+'''
+
+# Import libraries ----
+import json
+import math
+import numpy as np
+
+
+# Definitions ----
+# Histogram bins in [0, HIST_MAX), the last bin counts the values over it
+HIST_BINS = 200
+HIST_MAX = 20.0
+# Relative accuracy of the quantile sketch
+SKETCH_ALPHA = 0.01
+VARIABLES = ['dist', 'ndist']
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class summary(object):
+    '''
+    Summary of the values of a variable
+
+    Args:
+        bins (int): histogram bins
+        hmax (float): histogram maximum
+        alpha (float): quantile sketch relative accuracy
+    '''
+
+    def __init__(self, bins=HIST_BINS, hmax=HIST_MAX, alpha=SKETCH_ALPHA):
+        self.bins = bins
+        self.hmax = hmax
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.total_log = 0.0
+        self.n_pos = 0
+        self.vmin = math.inf
+        self.vmax = -math.inf
+        self.hist = np.zeros(bins + 1, dtype=np.int64)
+        self.zeros = 0
+        self.buckets = dict()
+
+    def add(self, values):
+        '''
+        Add an array of values
+        '''
+
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+
+        pos = values[values > 0]
+        self.n += len(values)
+        self.total += float(values.sum())
+        self.total_sq += float(np.square(values).sum())
+        self.total_log += float(np.log(pos).sum())
+        self.n_pos += len(pos)
+        self.vmin = min(self.vmin, float(values.min()))
+        self.vmax = max(self.vmax, float(values.max()))
+
+        idx = np.floor(values / self.hmax * self.bins).astype(np.int64)
+        self.hist += np.bincount(np.clip(idx, 0, self.bins),
+                                 minlength=self.bins + 1)
+
+        self.zeros += len(values) - len(pos)
+        keys, counts = np.unique(np.ceil(np.log(pos) / np.log(self.gamma)),
+                                 return_counts=True)
+        for key, count in zip(keys.astype(np.int64).tolist(),
+                              counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+        return self
+
+    def merge(self, other):
+        '''
+        Add the values of another summary with the same settings
+        '''
+
+        if (self.bins, self.hmax, self.alpha) != \
+                (other.bins, other.hmax, other.alpha):
+            raise ValueError('The summaries have different settings')
+
+        self.n += other.n
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.total_log += other.total_log
+        self.n_pos += other.n_pos
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        self.hist += other.hist
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+        return self
+
+    def mean(self):
+        return self.total / self.n if self.n else math.nan
+
+    def var(self):
+        '''
+        Sample variance
+        '''
+
+        if self.n < 2:
+            return math.nan
+
+        return max(self.total_sq - self.total ** 2 / self.n, 0) / (self.n - 1)
+
+    def quantile(self, q):
+        '''
+        Quantile estimate, within alpha relative error
+        '''
+
+        if not self.n:
+            return math.nan
+
+        rank = q * (self.n - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.vmin), self.vmax)
+
+        return self.vmax
+
+    def to_dict(self):
+        return {'bins': self.bins, 'hmax': self.hmax, 'alpha': self.alpha,
+                'n': self.n, 'total': self.total, 'total_sq': self.total_sq,
+                'total_log': self.total_log, 'n_pos': self.n_pos,
+                'min': self.vmin if self.n else None,
+                'max': self.vmax if self.n else None,
+                'hist': {str(i): int(self.hist[i])
+                         for i in np.flatnonzero(self.hist)},
+                'zeros': self.zeros,
+                'buckets': {str(key): count
+                            for key, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        new = cls(data['bins'], data['hmax'], data['alpha'])
+        new.n = data['n']
+        new.total = data['total']
+        new.total_sq = data['total_sq']
+        new.total_log = data['total_log']
+        new.n_pos = data['n_pos']
+        if data['n']:
+            new.vmin = data['min']
+            new.vmax = data['max']
+        for i, count in data['hist'].items():
+            new.hist[int(i)] = count
+        new.zeros = data['zeros']
+        new.buckets = {int(key): count
+                       for key, count in data['buckets'].items()}
+
+        return new
+
+
+class summary_table(object):
+    '''
+    Summaries per (from_sp, to_sp, mrca_type) and variable
+
+    The species pair is sorted, as the orientation of the sequence pairs
+    depends on the leaves order.
+    '''
+
+    def __init__(self):
+        self.groups = dict()
+
+    def add(self, from_sp, to_sp, mrca_type, values):
+        '''
+        Add the values of a group
+
+        Args:
+            from_sp (str): species
+            to_sp (str): species
+            mrca_type (str): S or D
+            values (dict): variable to array of values
+        '''
+
+        key = tuple(sorted([from_sp, to_sp])) + (mrca_type,)
+        group = self.groups.setdefault(key, dict())
+        for var, vals in values.items():
+            group.setdefault(var, summary()).add(vals)
+
+        return self
+
+    def add_pairs(self, pairs, variables=VARIABLES):
+        '''
+        Add a list of get_dists dictionaries
+        '''
+
+        groups = dict()
+        for pair in pairs:
+            key = (pair['from_sp'], pair['to_sp'], pair['mrca_type'])
+            group = groups.setdefault(key, {var: list() for var in variables})
+            for var in variables:
+                group[var].append(pair[var])
+        for key, values in groups.items():
+            self.add(*key, values)
+
+        return self
+
+    def merge(self, other):
+        for key, group in other.groups.items():
+            mine = self.groups.setdefault(key, dict())
+            for var, summ in group.items():
+                if var in mine:
+                    mine[var].merge(summ)
+                else:
+                    mine[var] = summ
+
+        return self
+
+    def to_dict(self):
+        return {'groups': [{'from_sp': key[0], 'to_sp': key[1],
+                            'mrca_type': key[2],
+                            'summaries': {var: summ.to_dict()
+                                          for var, summ in group.items()}}
+                           for key, group in sorted(self.groups.items())]}
+
+    @classmethod
+    def from_dict(cls, data):
+        new = cls()
+        for group in data['groups']:
+            key = (group['from_sp'], group['to_sp'], group['mrca_type'])
+            new.groups[key] = {var: summary.from_dict(summ)
+                               for var, summ in group['summaries'].items()}
+
+        return new
+
+    def write(self, ofile):
+        '''
+        Write the summaries in json format, to be merged later
+        '''
+
+        with open(ofile, 'w') as ohandle:
+            json.dump(self.to_dict(), ohandle, separators=(',', ':'))
+
+        return 0
+
+    @classmethod
+    def read(cls, ifile):
+        with open(ifile) as ihandle:
+            return cls.from_dict(json.load(ihandle))
+
+    def write_table(self, ofile, quantiles=QUANTILES):
+        '''
+        Write a csv with a row per group and variable with the count, moments,
+        range and quantiles
+        '''
+
+        header = ['from_sp', 'to_sp', 'mrca_type', 'variable', 'n', 'mean',
+                  'var', 'sum', 'sum_log', 'n_pos', 'min', 'max']
+        header += ['q%g' % (q * 100) for q in quantiles]
+
+        with open(ofile, 'w') as ohandle:
+            ohandle.write(','.join(header) + '\n')
+            for key, group in sorted(self.groups.items()):
+                for var, summ in sorted(group.items()):
+                    row = list(key) + [var, summ.n, summ.mean(), summ.var(),
+                                       summ.total, summ.total_log,
+                                       summ.n_pos,
+                                       summ.vmin if summ.n else math.nan,
+                                       summ.vmax if summ.n else math.nan]
+                    row += [summ.quantile(q) for q in quantiles]
+                    ohandle.write(','.join(str(x) for x in row) + '\n')
+
+        return 0
@@ -1,39 +1,40 @@
 #!/usr/bin/env python3
 
-import sys
 from glob import glob
-from utils import create_folder
-import gzip
-
-create_folder('splitted')
-
-files = glob('outputs/*_best_trees.txt.gz')
-
-print(files)
-
-for file in files:
-    print(file)
-    ph_id = file.rsplit('/', 1)[1].split('_', 1)[0]
-    print(ph_id)
-    fs = sys.getsizeof(gzip.open(file, 'r').read())
-    opts = 500000
-    if fs > opts:
-        efno = fs / opts
-        fmaxsize = efno / int(efno) * opts + 100
-
-    olines = ''
-    ofileno = 0
-    for line in gzip.open(file, 'r'):
-        if sys.getsizeof(olines) < fmaxsize:
-            olines += line.decode('utf-8')
-        else:
-            print(ofileno, 'written')
-            ofile = open('splitted/%s_%s.txt' % (ph_id, ofileno), 'w')
-            ofile.write(olines)
-            ofile.close()
-            olines = ''
-            ofileno += 1
-
-    ofile = open('splitted/%s_%s.txt' % (ph_id, ofileno), 'w')
-    ofile.write(olines)
-    ofile.close()
+from optparse import OptionParser
+from ingest import SHARD_SIZE, split_file
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='ifiles',
+                      help='Comma separated best trees files (default: '
+                      'outputs/*_best_trees.txt.gz)',
+                      metavar='<file,file,...>')
+    parser.add_option('-o', '--output', dest='odir',
+                      help='Shards folder (default: splitted)',
+                      metavar='<path/to/folder>', default='splitted')
+    parser.add_option('-s', '--shard-size', dest='shard_size',
+                      help='Maximum bytes of trees per shard (default: %d)' %
+                      SHARD_SIZE, metavar='<bytes>', type='int',
+                      default=SHARD_SIZE)
+    (options, args) = parser.parse_args()
+
+    if options.ifiles:
+        files = options.ifiles.split(',')
+    else:
+        files = glob('outputs/*_best_trees.txt.gz')
+
+    print(files)
+
+    for file in files:
+        print(file)
+        ph_id = file.rsplit('/', 1)[1].split('_', 1)[0]
+        print(ph_id)
+        # The file is read in blocks and the shards written as they fill
+        shards = split_file(file, options.odir, ph_id, options.shard_size)
+        print(len(shards), 'written')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+stage_trace.py -- Per tree stage timing
+
+The compute scripts time each phase of each tree (parsing, rooting, events,
+annotation, MRCA search, distances) with a tree_trace object. The records are
+gathered by the main process and written as a Chrome trace (chrome://tracing,
+Perfetto) or as a table with a row per tree and a column per phase.
+'''
+
+# Import libraries ----
+import json
+import os
+from time import monotonic_ns
+
+
+# Definitions ----
+class tree_trace(object):
+    '''
+    Phase timer of a tree
+
+    Phases are consecutive, so each call to mark closes the current phase and
+    opens the next one. When it is not enabled the calls do nothing.
+    '''
+
+    def __init__(self, tree_id, enabled=True):
+        self.enabled = enabled
+        self.tree_id = tree_id
+        self.leaves = None
+        self.species = None
+        self.phases = list()
+        if enabled:
+            self.start = monotonic_ns()
+            self.last = self.start
+
+    def mark(self, phase):
+        '''
+        Close the current phase with the phase name
+        '''
+
+        if self.enabled:
+            now = monotonic_ns()
+            self.phases.append((phase, self.last, now - self.last))
+            self.last = now
+
+    def size(self, leaves, species):
+        '''
+        Store the tree size
+        '''
+
+        self.leaves = leaves
+        self.species = species
+
+    def record(self):
+        '''
+        Get the trace as a dictionary to be sent to the main process
+        '''
+
+        return {'tree': self.tree_id, 'pid': os.getpid(),
+                'leaves': self.leaves, 'species': self.species,
+                'phases': self.phases}
+
+
+def write_chrome_trace(records, ofile):
+    '''
+    Write the traces in the Chrome trace event format
+
+    Each phase is a complete event, the process is the worker and the tree
+    id, size and phase are in the event arguments.
+
+    Args:
+        records (list): list of tree_trace records
+        ofile (str): output json file
+
+    Returns:
+        int: 0
+    '''
+
+    events = list()
+    for rec in records:
+        args = {'tree': rec['tree'], 'leaves': rec['leaves'],
+                'species': rec['species']}
+        for phase, start, dur in rec['phases']:
+            events.append({'name': phase, 'cat': 'tree', 'ph': 'X',
+                           'ts': start / 1000, 'dur': dur / 1000,
+                           'pid': rec['pid'], 'tid': rec['pid'],
+                           'args': args})
+
+    with open(ofile, 'w') as ohandle:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, ohandle,
+                  separators=(',', ':'))
+
+    return 0
+
+
+def write_trace_table(records, ofile):
+    '''
+    Write the traces as a csv table with a row per tree
+
+    The phases are columns with the time in seconds.
+
+    Args:
+        records (list): list of tree_trace records
+        ofile (str): output csv file
+
+    Returns:
+        int: 0
+    '''
+
+    phases = list()
+    for rec in records:
+        for phase, start, dur in rec['phases']:
+            if phase not in phases:
+                phases.append(phase)
+
+    with open(ofile, 'w') as ohandle:
+        ohandle.write(','.join(['tree', 'pid', 'leaves', 'species', 'total'] +
+                               phases) + '\n')
+        for rec in records:
+            times = dict()
+            for phase, start, dur in rec['phases']:
+                times[phase] = times.get(phase, 0) + dur
+            secs = ['%.9f' % (sum(times.values()) / 1e9)]
+            secs += ['%.9f' % (times[phase] / 1e9) if phase in times else ''
+                     for phase in phases]
+            row = [str(rec[key]) for key in ['tree', 'pid', 'leaves',
+                                             'species']]
+            ohandle.write(','.join(row + secs) + '\n')
+
+    return 0
+
+
+def write_trace(records, ofile, fmt):
+    '''
+    Write the traces in json (Chrome trace) or csv format
+    '''
+
+    if fmt == 'csv':
+        return write_trace_table(records, ofile)
+
+    return write_chrome_trace(records, ofile)
@@ -4,10 +4,19 @@
 '''
 treefuns.py -- Functions useful to manipulate phylome trees
 
+Species are interned in a species_registry: each species code gets a dense
+integer once, and the leaves species are kept as an integer array in the
+leaves order, so the per pair operations compare and store small integers
+instead of strings. Only seq2seq_cladenorm.py and batchtrees.py use the
+codes: root, annotate_tree and get_group_mrca, and so event_dist.py and
+clade_sp_dist.py, still work on the ete3 species strings, as they run once
+per tree and not once per pair.
+
 Requirements:
  - operator
  - scipy
  - numpy
+ - rooted_phylomes.py
 
 Written by Moisès Bernabeu <moigil.bernabeu.sci@gmail.com>
 April 2022
@@ -17,6 +26,7 @@ April 2022
 from operator import itemgetter
 from scipy import stats
 import numpy as np
+from rooted_phylomes import ROOTED_PHYLOMES
 
 
 # Define functions ----
@@ -32,18 +42,91 @@ def get_species(node):
     '''
 
     if '_' in node:
-        return node.split("_")[1]
+        return node.split('_', 2)[1]
     else:
         return node
 
 
+class species_registry(object):
+    '''
+    Species codes to dense integers
+
+    Args:
+        species (iterable): species codes to register, in this order
+    '''
+
+    def __init__(self, species=()):
+        self.names = list()
+        self.index = dict()
+        for sp in species:
+            self.code(sp)
+
+    def __len__(self):
+        return len(self.names)
+
+    def code(self, sp):
+        '''
+        Get the integer of a species, it is registered if it is new
+        '''
+
+        code = self.index.get(sp)
+        if code is None:
+            code = len(self.names)
+            self.index[sp] = code
+            self.names.append(sp)
+
+        return code
+
+    def name(self, code):
+        return self.names[code]
+
+    def leaf_codes(self, leaf_names):
+        '''
+        Get the species integers of a list of leaves names
+
+        Returns:
+            array: int32 species codes in the leaves order
+        '''
+
+        return np.array([self.code(get_species(name))
+                         for name in leaf_names], dtype=np.int32)
+
+    @classmethod
+    def from_phylome(cls, phylome_id, gnmdf=None, spcol='Proteome',
+                     root_dict=ROOTED_PHYLOMES, catalogue=None):
+        '''
+        Registry of a phylome species, from its rooting ages, its normalising
+        groups table and its proteomes in the catalogue (phylome_catalogue)
+        if given, sorted so the codes are the same in all the runs of a
+        phylome
+        '''
+
+        try:
+            species = set(root_dict.get(int(phylome_id), dict()))
+        except ValueError:
+            # Shards without a phylome id prefix (eg. s40.txt) have no
+            # rooting species
+            species = set()
+        if gnmdf is not None:
+            species.update(gnmdf[spcol].astype(str))
+        if catalogue is not None:
+            species.update(catalogue.species(phylome_id))
+
+        return cls(sorted(species))
+
+
 def root(tree, root_dict):
     '''
     Root the tree according to a rooting dictionary
 
     The tree is rooted with a dictionary containing species-to-age information,
     the farthest sequence from an species in the tree which has maximum age is
-    selected to be the outgroup of the tree.
+    selected to be the outgroup of the tree. The outgroup sequences are the
+    ones whose species is exactly the outgroup species; they were the ones
+    containing it as a substring before, so a tree with a species code
+    inside another leaf name (eg. HUMAN in Phy0001_HUMAN2) can be rooted in
+    another leaf than with older versions of event_dist.py and
+    clade_sp_dist.py.
 
     Args:
         tree (PhyloTree): ete3 PhyloTree object with a get_species_tag function
@@ -62,17 +145,19 @@ def root(tree, root_dict):
     '''
 
     # Checking whether any species is in the tree
-    if any(sp in root_dict for sp in tree.get_species()):
+    tree_species = tree.get_species()
+    if any(sp in root_dict for sp in tree_species):
         # Getting the rooting subdictionary with the species in the tree
-        ogdval = max([root_dict.get(sp, 0) for sp in tree.get_species()])
+        ogdval = max([root_dict.get(sp, 0) for sp in tree_species])
 
         # Getting the outgroup species
         ogsps = [k for k, val in root_dict.items()
-                 if val == ogdval and k in tree.get_species()][0]
+                 if val == ogdval and k in tree_species][0]
 
-        # Getting the outgroup sequences dictionary
+        # Getting the outgroup sequences dictionary, the species has to be
+        # the leaf one and not a substring of its name
         ogseqdict = {seq: tree.get_distance(seq) for seq in
-                     tree.get_leaf_names() if ogsps in seq}
+                     tree.get_leaf_names() if get_species(seq) == ogsps}
 
         # Getting the farthest oldest leaf
         ogseq = max(ogseqdict)
@@ -85,7 +170,7 @@ def root(tree, root_dict):
     return ogseq
 
 
-def annotate_tree(tree, df, spcol, cols):
+def annotate_tree(tree, df, spcol, cols, registry=None):
     '''
     Tree leaves annotation
 
@@ -102,25 +187,35 @@ def annotate_tree(tree, df, spcol, cols):
         cols (string or list of strings): column or columns containing the
         annotations
 
+        registry (species_registry): if given, the leaves are also annotated
+        with their species integer (sp_code)
+
     Returns:
         string: the input tree is annotated, the funtion returns 0
 
     Raises:
-        Exception: description
+        KeyError: a leaf species is not in the dataframe
     '''
 
     # Converting string to single element list
-    if type(cols) == 'str':
+    if isinstance(cols, str):
         cols = [cols]
 
+    # Species to values of each column, the first row of a species is used
+    values = {col: dict(zip(df[spcol][::-1], df[col][::-1])) for col in cols}
+
     # Iterating the leaves
     for leaf in tree.get_leaves():
+        sp = list(leaf.get_species())[0]
+        if sp not in values[cols[0]]:
+            raise KeyError('Species %s of %s is not in the %s column' %
+                           (sp, leaf.name, spcol))
         # Iterating the dataframe columns
         for col in cols:
             # Annotating the leaf with its column feature
-            sp = list(leaf.get_species())[0]
-            feat_val = list(df[col][df[spcol] == sp])[0]
-            leaf.add_feature(col, feat_val)
+            leaf.add_feature(col, values[col][sp])
+        if registry is not None:
+            leaf.add_feature('sp_code', registry.code(sp))
 
     return 0
 
@@ -151,12 +246,27 @@ def tree_stats(tree):
     for leaf in ndlf:
         distl.append(tree.get_distance(leaf))
 
+    return dist_stats(distl, tree.get_farthest_leaf()[1])
+
+
+def dist_stats(distl, width):
+    '''
+    Root to tip distances statistics, see tree_stats
+
+    Args:
+        distl (list): root to tip distances, in the leaves order
+        width (float): distance to the farthest leaf
+
+    Returns:
+        dictionary: dictionary with the tree statistics
+    '''
+
     # Generating the output dictionary
     nodedict = dict()
     nodedict['leafno'] = len(distl)
     nodedict['median'] = np.median(distl)
     nodedict['mean'] = np.mean(distl)
-    nodedict['width'] = tree.get_farthest_leaf()[1]
+    nodedict['width'] = width
     nodedict['sum'] = sum(distl)
     nodedict['kurt'] = stats.kurtosis(distl)
     nodedict['skew'] = stats.skew(distl)
@@ -220,7 +330,9 @@ def get_group_mrca(tree, tree_id, feature, value, sp_in=None):
         else:
             sptoincl = sp_in
 
-        if (sptoincl in lnames and len(set(feat_list)) == 1 and stlno > 1 and
+        # The missing values (NaN, not equal to itself) are not a group
+        if (sptoincl in lnames and len(set(feat_list)) == 1 and
+                feat_list[0] == feat_list[0] and stlno > 1 and
                 stlno != tlno and stwdth != 0):
             # Appending to a list a dictionary with the basic information of
             # the group monophyletic group
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_memo.py -- Tests of the per tree results cache
+
+The outputs of seq2seq_cladenorm.py have to be the same with and without
+--memo, also for the trees written with their children in another order.
+
+    python -m unittest discover tests
+'''
+
+# Import libraries ----
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, 'src'))
+
+from batchtrees import parse_newick  # noqa: E402
+
+
+# Definitions ----
+SHARD = os.path.join(REPO, '01_get_trees/splitted/0005_0.txt')
+GROUPS = os.path.join(REPO, '02_seed2sp_dist/data/0005_norm_groups.csv')
+# Small trees of the shard that are not filtered out
+ROWS = [0, 3, 8]
+
+
+def swapped_newick(newick):
+    '''
+    Same tree with the children of each node in the reverse order
+    '''
+
+    parent, children, dist, names = parse_newick(newick)
+
+    def write(node):
+        if children[node]:
+            label = '(%s)' % ','.join(write(child)
+                                      for child in children[node][::-1])
+        else:
+            label = names[node]
+        return label if node == 0 else '%s:%r' % (label, dist[node])
+
+    return write(0) + ';'
+
+
+class memo_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        with open(SHARD) as ihandle:
+            rows = [row for k, row in enumerate(ihandle) if k in ROWS]
+        self.shard = os.path.join(self.tmp, '0005_t.txt')
+        with open(self.shard, 'w') as ohandle:
+            for row in rows:
+                ohandle.write(row)
+            for row in rows:
+                fields = row.rstrip('\n').split('\t')
+                fields[0] = 'SWAPPED_' + fields[0]
+                fields[3] = swapped_newick(fields[3])
+                ohandle.write('\t'.join(fields) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_dist(self, name, *args):
+        odir = os.path.join(self.tmp, name)
+        os.makedirs(odir)
+        subprocess.run([sys.executable,
+                        os.path.join(REPO, 'src/seq2seq_cladenorm.py'),
+                        '-f', self.shard, '-o', odir, '-p', GROUPS,
+                        '-c', '2'] + list(args), check=True,
+                       stdout=subprocess.DEVNULL)
+
+        return odir
+
+    def assert_same(self, odir_a, odir_b):
+        for fname in ['0005_t_dist.csv', '0005_t_norm.csv']:
+            self.assertTrue(filecmp.cmp(os.path.join(odir_a, fname),
+                                        os.path.join(odir_b, fname),
+                                        shallow=False), fname)
+
+    def test_permuted_trees(self):
+        plain = self.run_dist('plain')
+        memo = os.path.join(self.tmp, 'memo.sqlite')
+        # Empty cache, then the cache filled by the first run
+        self.assert_same(plain, self.run_dist('memo', '--memo', memo))
+        self.assert_same(plain, self.run_dist('again', '--memo', memo))
+        self.assert_same(plain, self.run_dist('batch', '-b', '4',
+                                              '--memo', memo))
+
+
+if __name__ == '__main__':
+    unittest.main()
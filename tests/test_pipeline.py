@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+test_pipeline.py -- Tests of the pipeline stages
+
+The get_trees stage is run as the pipeline runs it (without --offline)
+against a local http server mirroring the 0005 phylome files, and the whole
+pipeline is run on a few trees of 0005 and 0076 to check a change in a
+normalising groups table only runs the stages that depend on it.
+
+    python -m unittest discover tests
+'''
+
+# Import libraries ----
+import filecmp
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, 'src'))
+
+from pipeline import pipeline, phylome_stages  # noqa: E402
+
+
+# Definitions ----
+FILES = ['best_trees.txt.gz', 'phylome_info.txt.gz', 'all_gene_names.txt.gz',
+         'all_protein_names.txt.gz']
+PHYLOMES = ['0005', '0076']
+GROUPS = ['02_seed2sp_dist/data/0005_norm_groups.csv',
+          '02_seed2sp_dist/data/0076_norm_groups.csv',
+          '03_event_dist/data/0076_norm_groups.csv']
+
+
+class quiet_handler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class get_trees_stage_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.outputs = os.path.join(REPO, '01_get_trees/outputs')
+        mirror = os.path.join(self.tmp, 'mirror')
+        os.makedirs(os.path.join(mirror, 'phylome_0005'))
+        for fname in FILES:
+            shutil.copy(os.path.join(self.outputs, '0005_' + fname),
+                        os.path.join(mirror, 'phylome_0005', fname))
+
+        self.root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(self.root, '01_get_trees/data'))
+        with open(os.path.join(self.root, '01_get_trees/data/'
+                               'phylome_list.txt'), 'w') as ohandle:
+            ohandle.write('0005\n')
+
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), partial(quiet_handler, directory=mirror))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def plan(self):
+        return [item for item in
+                phylome_stages(self.root, ['0005'], 2, url=self.url)
+                if item.name == 'get_trees']
+
+    def test_arguments(self):
+        item = self.plan()[0]
+        self.assertEqual(item.args[item.args.index('-t') + 1], '2')
+        self.assertEqual(item.args[item.args.index('--url') + 1], self.url)
+
+    def test_requested_phylomes(self):
+        # The requested phylomes are downloaded, not the ones of the list
+        item = phylome_stages(self.root, ['0076', '0005'], 2)[0]
+        plist = item.args[item.args.index('-f') + 1]
+        with open(plist) as ihandle:
+            self.assertEqual(ihandle.read(), '0076\n0005\n')
+        self.assertEqual(item.inputs,
+                         [os.path.relpath(plist, self.root)])
+
+    def test_download(self):
+        runner = pipeline(self.root, self.plan, 1)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(runner.run_stages, ['get_trees'])
+        for fname in FILES:
+            self.assertTrue(filecmp.cmp(
+                os.path.join(self.outputs, '0005_' + fname),
+                os.path.join(self.root, '01_get_trees/outputs',
+                             '0005_' + fname), shallow=False), fname)
+
+        # The stage is up to date in the next run
+        runner = pipeline(self.root, self.plan, 1)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(runner.run_stages, [])
+
+
+class rebuild_test(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        outputs = os.path.join(self.root, '01_get_trees/outputs')
+        os.makedirs(outputs)
+        for phyid in PHYLOMES:
+            # The smallest trees of the first shard
+            with open(os.path.join(REPO, '01_get_trees/splitted/%s_0.txt' %
+                                   phyid)) as ihandle:
+                rows = [row for row in ihandle if len(row) < 6000][:6]
+            with gzip.open(os.path.join(outputs, '%s_best_trees.txt.gz' %
+                                        phyid), 'wt') as ohandle:
+                ohandle.writelines(rows)
+        for path in GROUPS:
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)),
+                        exist_ok=True)
+            shutil.copy(os.path.join(REPO, path),
+                        os.path.join(self.root, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def plan(self):
+        return phylome_stages(self.root, PHYLOMES, 2, offline=True,
+                              shard_size=4000)
+
+    def run_pipeline(self):
+        runner = pipeline(self.root, self.plan, 2)
+        runner.run()
+        self.assertEqual(runner.failed, set())
+
+        return runner
+
+    def test_groups_change(self):
+        first = self.run_pipeline()
+        shards = [name for name in first.run_stages
+                  if name.startswith('dist/0005_')]
+        self.assertGreater(len(shards), 1)
+        self.assertIn('events/0076_0', first.run_stages)
+        self.assertEqual(self.run_pipeline().run_stages, [])
+
+        # KLUWA out of the normalising group of 0005
+        path = os.path.join(self.root, GROUPS[0])
+        with open(path) as ihandle:
+            lines = ihandle.readlines()
+        with open(path, 'w') as ohandle:
+            for line in lines:
+                if line.startswith('KLUWA,'):
+                    line = line.replace(',A\n', ',NA\n')
+                ohandle.write(line)
+
+        # Only the 0005 distances shards and their join
+        again = self.run_pipeline()
+        self.assertEqual(sorted(again.run_stages),
+                         sorted(shards + ['join/02_seed2sp_dist']))
+
+
+if __name__ == '__main__':
+    unittest.main()